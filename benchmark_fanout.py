@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк рассылки сообщений в комнате: p99 времени доставки в очередь
+подключения и время блокировки отправителя в зависимости от размера комнаты.
+
+Сравнивает последовательную рассылку в потоке отправителя и пул FanoutPool.
+Запуск: python3 benchmark_fanout.py [сообщений] [размеры комнат через запятую]
+"""
+
+import sys
+import time
+import threading
+
+import server_production as chat
+
+class BenchConnection:
+    """Подключение-заглушка: запоминает время получения каждого сообщения"""
+    def __init__(self):
+        self.protocol = chat.PROTOCOL_FRAMED
+        self.received = []
+
+    def send(self, data, kind=chat.QUEUED_CONTROL):
+        self.received.append(time.perf_counter())
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(room_size: int, messages: int, pool):
+    """Разослать сообщения и вернуть (p99 доставки, среднее время блокировки отправителя) в мс"""
+    room = chat.ChatRoom('bench', 'bench', 'admin')
+    if pool:
+        room.attach_fanout(pool)
+    connections = [BenchConnection() for _ in range(room_size)]
+    for index, conn in enumerate(connections):
+        room.add_user(f"user{index}", conn, None)
+
+    latencies = []
+    blocked = []
+    for number in range(messages):
+        started = time.perf_counter()
+        room.deliver(f"[00:00:00] admin: сообщение {number}")
+        blocked.append(time.perf_counter() - started)
+
+        # Дождаться доставки всем участникам
+        while any(len(conn.received) <= number for conn in connections):
+            time.sleep(0.0005)
+        latencies.extend(conn.received[number] - started for conn in connections)
+
+    return percentile(latencies, 0.99) * 1000, sum(blocked) / len(blocked) * 1000
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    sizes = [int(size) for size in sys.argv[2].split(',')] if len(sys.argv) > 2 else [100, 1000, 5000, 10000]
+
+    chat.FANOUT_THRESHOLD = 0
+    pool = chat.FanoutPool(chat.FANOUT_WORKERS)
+
+    print(f"=== БЕНЧМАРК РАССЫЛКИ ({messages} сообщений, потоков пула: {pool.size}) ===")
+    print(f"{'Участников':>10} | {'p99 послед., мс':>16} | {'блок. послед., мс':>18} | {'p99 пул, мс':>12} | {'блок. пул, мс':>14}")
+    for size in sizes:
+        serial_p99, serial_blocked = run(size, messages, None)
+        pool_p99, pool_blocked = run(size, messages, pool)
+        print(f"{size:>10} | {serial_p99:>16.3f} | {serial_blocked:>18.3f} | {pool_p99:>12.3f} | {pool_blocked:>14.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,24 @@ import sys
 import re
 import os
 import getpass
+import struct
 
 HOST = '84.46.247.15'  # Для локального тестирования
 PORT = 12345
 
+# Протокол v2: кадр = заголовок (длина uint32, тип uint8) + текст UTF-8.
+# Клиент запрашивает его опциями в строке логина. Сервер без поддержки v2 считает
+# опции частью имени, поэтому на текстовый ответ клиент переподключается и входит
+# обычной строкой "LOGIN:<имя>" в текстовом режиме.
+PROTOCOL_LEGACY = 1
+PROTOCOL_FRAMED = 2
+FRAME_HEADER = struct.Struct('!IB')
+FRAME_TEXT = 1
+FRAME_AUTH = 2
+FRAME_PING = 3  # Проверка связи от сервера, ответ - FRAME_PONG
+FRAME_PONG = 4
+MAX_MESSAGE_LENGTH = 1024  # Лимит сервера на одно сообщение в байтах
+
 # ANSI цвета и форматирование
 RED = '\033[91m'
 GREEN = '\033[92m'
@@ -28,6 +42,9 @@ class ChatClient:
         self.username = ""
         self.connected = False
         self.current_room = None
+        self.protocol = PROTOCOL_LEGACY
+        self.buffer = bytearray()
+        self.send_lock = threading.Lock()  # Ответ на ping отправляет поток приема
         
     def colorize_message(self, message):
         """Раскрасить сообщения для лучшей читаемости"""
@@ -72,26 +89,104 @@ class ChatClient:
         sys.stdout.write(prompt)
         sys.stdout.flush()
         
+    def send_frame(self, text, frame_type=FRAME_TEXT):
+        """Отправить текст в текущей версии протокола"""
+        payload = text.encode('utf-8')
+        if self.protocol == PROTOCOL_FRAMED:
+            payload = FRAME_HEADER.pack(len(payload), frame_type) + payload
+        with self.send_lock:
+            self.socket.sendall(payload)
+        
+    def take_frame(self):
+        """Извлечь из буфера один полный текстовый кадр или None (на ping отвечает сразу)"""
+        while len(self.buffer) >= FRAME_HEADER.size:
+            length, frame_type = FRAME_HEADER.unpack_from(self.buffer)
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                return None
+            text = bytes(self.buffer[FRAME_HEADER.size:end]).decode('utf-8')
+            del self.buffer[:end]
+            if frame_type == FRAME_PING:
+                self.send_frame(text, FRAME_PONG)
+            elif frame_type != FRAME_PONG:
+                return text
+        return None
+        
+    def recv_frame(self):
+        """Дождаться следующего кадра, None при закрытии соединения"""
+        while True:
+            text = self.take_frame()
+            if text is not None:
+                return text
+            data = self.socket.recv(65536)
+            if not data:
+                return None
+            self.buffer += data
+            
+    def recv_messages(self):
+        """Получить очередную порцию сообщений, пустой список при закрытии соединения"""
+        if self.protocol == PROTOCOL_LEGACY:
+            data = self.socket.recv(4096)
+            return [data.decode('utf-8')] if data else []
+        
+        first = self.recv_frame()
+        if first is None:
+            return []
+        messages = [first]
+        while True:
+            text = self.take_frame()
+            if text is None:
+                return messages
+            messages.append(text)
+            
+    def recv_auth(self):
+        """Получить следующий шаг аутентификации"""
+        if self.protocol == PROTOCOL_FRAMED:
+            return self.recv_frame() or ""
+        return self.socket.recv(1024).decode('utf-8')
+        
+    def recv_login_response(self):
+        """Получить ответ на LOGIN и определить, принял ли сервер протокол v2"""
+        data = self.socket.recv(65536)
+        # Кадр начинается с длины uint32, текстовый ответ не может начинаться с нулевого байта
+        if data.startswith(b'\x00'):
+            self.protocol = PROTOCOL_FRAMED
+            self.buffer += data
+            return self.recv_frame() or ""
+        return data.decode('utf-8')
+        
+    def legacy_login(self):
+        """Переподключиться и войти без опций протокола (сервер без поддержки v2)"""
+        self.socket.close()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.connect((HOST, PORT))
+        auth_prompt = self.socket.recv(1024).decode('utf-8')
+        if auth_prompt != "AUTH_REQUIRED":
+            return auth_prompt
+        self.socket.send(f"LOGIN:{self.username}".encode('utf-8'))
+        return self.socket.recv(1024).decode('utf-8')
+        
     def receive_messages(self):
         """Получать сообщения от сервера"""
         while self.connected:
             try:
-                message = self.socket.recv(4096).decode('utf-8')
-                if message:
+                messages = self.recv_messages()
+                if messages:
                     # Очистить текущую строку ввода
                     self.clear_input_line()
                     
-                    # Обработать специальные сообщения
-                    if "Добро пожаловать в комнату" in message:
-                        # Извлечь ID комнаты
-                        room_match = re.search(r"ID: ([a-zA-Z0-9-]+)", message)
-                        if room_match:
-                            self.current_room = room_match.group(1)
-                    elif "Вы покинули комнату" in message:
-                        self.current_room = None
-                    
-                    # Показать сообщение
-                    print(self.colorize_message(message))
+                    for message in messages:
+                        # Обработать специальные сообщения
+                        if "Добро пожаловать в комнату" in message:
+                            # Извлечь ID комнаты
+                            room_match = re.search(r"ID: ([a-zA-Z0-9-]+)", message)
+                            if room_match:
+                                self.current_room = room_match.group(1)
+                        elif "Вы покинули комнату" in message:
+                            self.current_room = None
+                        
+                        # Показать сообщение
+                        print(self.colorize_message(message))
                     
                     # Восстановить приглашение для ввода
                     self.print_prompt()
@@ -107,8 +202,11 @@ class ChatClient:
         
     def send_message(self, message):
         """Отправить сообщение на сервер"""
+        if self.protocol == PROTOCOL_FRAMED and len(message.encode('utf-8')) > MAX_MESSAGE_LENGTH:
+            print(f"{RED}[!] Сообщение слишком длинное (максимум {MAX_MESSAGE_LENGTH} байт){RESET}")
+            return True
         try:
-            self.socket.send(message.encode('utf-8'))
+            self.send_frame(message)
             return True
         except Exception as e:
             print(f"{RED}[!] Ошибка отправки: {e}{RESET}")
@@ -254,12 +352,15 @@ class ChatClient:
             
             self.username = username.lower()
             
-            # Отправить логин
-            login_msg = f"LOGIN:{self.username}"
+            # Отправить логин и запросить протокол v2
+            login_msg = f"LOGIN:{self.username};proto={PROTOCOL_FRAMED};ping=1"
             self.socket.send(login_msg.encode('utf-8'))
             
             # Получить ответ сервера
-            response = self.socket.recv(1024).decode('utf-8')
+            response = self.recv_login_response()
+            if self.protocol == PROTOCOL_LEGACY:
+                # Текстовый ответ - сервер не знает v2 и принял опции за часть имени
+                response = self.legacy_login()
             
             if response.startswith("NEW_USER:"):
                 # Новый пользователь
@@ -267,11 +368,11 @@ class ChatClient:
                 print(f"{YELLOW}{message}{RESET}")
                 
                 confirm = input(f"{BOLD}Создать новый аккаунт? (y/n): {RESET}").strip().lower()
-                self.socket.send(confirm.encode('utf-8'))
+                self.send_frame(confirm, FRAME_AUTH)
                 
                 if confirm in ['y', 'yes']:
                     # Ждем запрос пароля
-                    pwd_prompt = self.socket.recv(1024).decode('utf-8')
+                    pwd_prompt = self.recv_auth()
                     if pwd_prompt.startswith("PASSWORD_NEW:"):
                         message = pwd_prompt[13:]
                         print(f"{CYAN}{message}{RESET}")
@@ -283,10 +384,10 @@ class ChatClient:
                             print(f"{RED}Пароль должен быть не менее 6 символов{RESET}")
                             return False
                         
-                        self.socket.send(password.encode('utf-8'))
+                        self.send_frame(password, FRAME_AUTH)
                         
                         # Получить результат
-                        result = self.socket.recv(1024).decode('utf-8')
+                        result = self.recv_auth()
                         if result.startswith("SUCCESS:"):
                             print(f"{GREEN}{result[8:]}{RESET}")
                             return True
@@ -304,10 +405,10 @@ class ChatClient:
                 import getpass
                 password = getpass.getpass(f"{BOLD}Пароль: {RESET}")
                 
-                self.socket.send(password.encode('utf-8'))
+                self.send_frame(password, FRAME_AUTH)
                 
                 # Получить результат
-                result = self.socket.recv(1024).decode('utf-8')
+                result = self.recv_auth()
                 if result.startswith("SUCCESS:"):
                     print(f"{GREEN}{result[8:]}{RESET}")
                     return True
@@ -331,7 +432,7 @@ class ChatClient:
         if self.connected:
             try:
                 goodbye_msg = f"{self.username} покинул чат."
-                self.socket.send(goodbye_msg.encode('utf-8'))
+                self.send_frame(goodbye_msg)
             except:
                 pass
             self.connected = False
@@ -13,9 +13,29 @@ MAX_USERNAME_LENGTH = 30           # Максимальная длина име
 HISTORY_MESSAGES_COUNT = 10        # Сколько сообщений показывать при входе
 
 # Файлы данных
-DATA_FILE = "chat_data.json"       # Файл хранения данных
+DATA_DB = "chat_data.db"           # База комнат SQLite
+DATA_FILE = "chat_data.json"       # Старый файл комнат, переносится в DATA_DB при первом запуске
 LOG_FILE = "chat_server.log"       # Файл логов
-BACKUP_INTERVAL = 3600             # Интервал бэкапа в секундах (1 час)
+USERS_DB = "users.db"              # База пользователей SQLite
+USERS_FILE = "users.json"          # Старый файл пользователей, переносится в USERS_DB при первом запуске
+USER_CACHE_SIZE = 10000            # Сколько отключившихся пользователей держать в памяти
+MESSAGE_LOG_DIR = "messages"       # Каталог журналов сообщений комнат
+MESSAGE_SEGMENT_BYTES = 8388608    # Размер сегмента журнала (8 МБ)
+MESSAGE_INDEX_INTERVAL = 64        # Шаг разреженного индекса журнала (каждое N-е сообщение)
+HISTORY_PAGE_SIZE = 30             # Сообщений на странице /chathistory
+ROOM_LIST_PAGE_SIZE = 20           # Комнат на странице /list
+SEARCH_RESULTS = 20                # Совпадений в ответе /search
+SEARCH_SEGMENT_MESSAGES = 16384    # Сообщений в сегменте поискового индекса
+SEARCH_INDEX_INTERVAL = 5          # Интервал дописывания поисковых индексов в секундах
+SEARCH_MAX_CANDIDATES = 2000       # Сообщений, которые проверяет один запрос /search (дальше - before:<номер>)
+ROOM_HISTORY_SIZE = 500            # Последних сообщений комнаты в памяти
+USER_HISTORY_SIZE = 1000           # Последних сообщений пользователя в памяти
+ROOM_HISTORY_STORE = "ring"        # Хранение истории комнат в памяти: "ring" или "columnar" (компактнее)
+FLUSH_INTERVAL = 1.0               # Интервал отложенной записи изменений на диск в секундах
+FLUSH_MAX_PENDING = 500            # Досрочная запись, когда накопилось столько изменений
+BACKUP_INTERVAL = 3600             # Интервал бэкапа в секундах (1 час), 0 - выключить
+BACKUP_DIR = "backups"             # Каталог резервных копий баз
+BACKUP_KEEP = 24                   # Сколько последних копий хранить
 
 # Безопасность
 ENABLE_PASSWORD_PROTECTION = True  # Разрешить пароли для комнат
@@ -24,8 +44,9 @@ ADMIN_PASSWORD = None             # Пароль администратора с
 
 # Производительность
 SOCKET_TIMEOUT = 30               # Таймаут сокета в секундах
-CLEANUP_INTERVAL = 300            # Интервал очистки отключенных пользователей (5 мин)
+CLEANUP_INTERVAL = 300            # Интервал проверки пустых комнат (5 мин)
 AUTO_SAVE_INTERVAL = 60           # Интервал автосохранения в секундах
+STATS_INTERVAL = 60               # Интервал записи статистики в лог
 
 # Логирование
 LOG_LEVEL = "INFO"                # DEBUG, INFO, WARNING, ERROR
@@ -38,7 +59,44 @@ ENABLE_ROOM_PERSISTENCE = True    # Сохранять комнаты между
 ENABLE_MESSAGE_HISTORY = True     # Сохранять историю сообщений
 ENABLE_USER_STATISTICS = False    # Собирать статистику пользователей
 AUTO_DELETE_EMPTY_ROOMS = False   # Автоматически удалять пустые комнаты
+EMPTY_ROOM_TTL = 86400            # Удалять комнату без участников и активности дольше N секунд
 
 # Лимиты
 MAX_ROOMS_PER_USER = 5            # Максимум комнат, которые может создать пользователь
-MAX_FAILED_LOGINS = 3             # Максимум неудачных попыток входа
\ No newline at end of file
+MAX_FAILED_LOGINS = 3             # Максимум неудачных попыток входа
+# Режим работы сервера (server_production.py)
+SERVER_MODE = "threaded"          # "threaded" - поток на подключение, "asyncio" - один event loop
+AUTH_TIMEOUT = 15                 # Таймаут на каждый шаг аутентификации в секундах
+HANDSHAKE_WORKERS = 16            # Одновременных диалогов аутентификации (потоков в потоковом режиме)
+MAX_PENDING_HANDSHAKES = 256      # Максимум подключений, ожидающих входа; сверх лимита - отказ
+MAX_HANDSHAKES_PER_IP = 8         # Максимум ожидающих входа подключений с одного IP
+PING_INTERVAL = 30                # Секунд тишины до ping клиенту (клиенты с протоколом v2)
+PING_TIMEOUT = 10                 # Отключить, если на ping нет ответа за столько секунд
+CLIENT_IDLE_TIMEOUT = 0           # Отключать старых клиентов без ping после N секунд тишины (0 - нет)
+HEARTBEAT_TICK = 1.0              # Шаг колеса таймеров бездействия в секундах
+KEEPALIVE_IDLE = 60               # TCP keepalive: секунд тишины до первой проверки (0 - выключен)
+KEEPALIVE_INTERVAL = 10           # TCP keepalive: интервал проверок
+KEEPALIVE_COUNT = 6               # TCP keepalive: проверок без ответа до разрыва
+PASSWORD_SCRYPT_N = 16384         # Параметры scrypt для хешей паролей; старые хеши обновляются при входе
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+HASH_WORKERS = 4                  # Процессов для хеширования паролей (по умолчанию - число ядер)
+HASH_QUEUE_SIZE = 64              # Максимум задач хеширования в очереди; сверх лимита - отказ во входе
+WORKERS = 1                       # Процессов-воркеров на одном порту (SO_REUSEPORT), >1 - по числу ядер
+BUS_SOCKET = "/tmp/terminal-chat-bus.sock"  # Unix сокет шины событий между воркерами
+OUTBOUND_MAX_BYTES = 256 * 1024   # Максимум неотправленных данных на клиента
+OUTBOUND_MAX_FRAMES = 1000        # Максимум неотправленных сообщений на клиента
+SLOW_CONSUMER_POLICY = "drop_oldest"  # "drop_oldest", "skip_to_latest" или "disconnect"
+FANOUT_WORKERS = 4                # Потоков параллельной рассылки для больших комнат (0 - выключить)
+FANOUT_THRESHOLD = 200            # С какого числа участников рассылка идет через пул
+ROOM_EXECUTORS = 8                # Потоков-владельцев комнат (каждая комната изменяется только своим потоком)
+METRICS_HOST = "127.0.0.1"        # Адрес HTTP метрик в формате Prometheus (GET /metrics)
+METRICS_PORT = 0                  # Порт метрик (0 - выключено), воркер N слушает METRICS_PORT + N
+SERVER_ADMINS = []                # Пользователи с доступом к командам администратора сервера (/perf)
+ACTION_LOG_FORMAT = "text"        # Журнал действий: "text" или "json" (JSON lines для сбора логов)
+RATE_LIMIT_USER = (10, 30)        # Сообщений и команд в секунду на пользователя и запас (None - без ограничения)
+RATE_LIMIT_IP = (50, 150)         # То же на один IP
+RATE_LIMIT_ROOM = (100, 300)      # Сообщений в секунду на комнату (в каждом воркере)
+RATE_LIMIT_BYTES = (65536, 262144)  # Байт в секунду и запас на пользователя и на IP
+RATE_LIMIT_MAX_DELAY = 1.0        # Задерживать сообщения сверх лимита до N секунд, дольше - отбрасывать
+COMMAND_COSTS = {"/list": 5, "/chathistory": 5, "/search": 5, "/history": 2, "/myrooms": 2, "/stats": 3, "/perf": 3, "/create": 5}
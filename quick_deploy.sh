@@ -39,7 +39,7 @@ tar -czf terminal-chat.tar.gz \
     config_example.py .env.example requirements.txt \
     terminal-chat.service manage_service.sh \
     docker-compose.yml Dockerfile \
-    --exclude='.git' --exclude='*.log' --exclude='chat_data.json'
+    --exclude='.git' --exclude='*.log' --exclude='chat_data.json' --exclude='*.db'
 
 # Копировать на сервер
 print_status "Копирование файлов на сервер..."
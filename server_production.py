@@ -6,18 +6,42 @@ Production-ready сервер для терминального чата с ул
 
 import socket
 import threading
+import asyncio
+import argparse
 import json
+import re
 import datetime
 import os
 import uuid
 import logging
 import logging.handlers
 import signal
+import atexit
 import sys
 import time
 import traceback
 import hashlib
-from typing import Dict, List, Optional
+import struct
+import collections
+import queue
+import functools
+import zlib
+import concurrent.futures
+import multiprocessing
+import secrets
+import hmac
+import sqlite3
+import mmap
+import shutil
+import unicodedata
+import bisect
+import heapq
+import random
+import array
+import math
+import itertools
+import http.server
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 
 # Попытаться импортировать конфигурацию
@@ -35,44 +59,1511 @@ except ImportError:
     AUTO_SAVE_INTERVAL = 60
     USERS_FILE = "/opt/terminal-chat/data/users.json"
 
+# Пользователи хранятся в SQLite; старый users.json переносится в базу при первом запуске
+USERS_FILE = globals().get('USERS_FILE', os.path.join(os.path.dirname(DATA_FILE), 'users.json'))
+USERS_DB = globals().get('USERS_DB', os.path.splitext(USERS_FILE)[0] + '.db')
+# Сколько отключившихся пользователей держать в памяти (подключенные не вытесняются)
+USER_CACHE_SIZE = globals().get('USER_CACHE_SIZE', 10000)
+# Комнаты хранятся в SQLite; старый DATA_FILE переносится в базу при первом запуске
+DATA_DB = globals().get('DATA_DB', os.path.splitext(DATA_FILE)[0] + '.db')
+# Журнал сообщений комнат: каталог, размер сегмента и шаг разреженного индекса
+MESSAGE_LOG_DIR = globals().get('MESSAGE_LOG_DIR', os.path.join(os.path.dirname(DATA_FILE), 'messages'))
+MESSAGE_SEGMENT_BYTES = globals().get('MESSAGE_SEGMENT_BYTES', 8 * 1024 * 1024)
+MESSAGE_INDEX_INTERVAL = globals().get('MESSAGE_INDEX_INTERVAL', 64)
+HISTORY_PAGE_SIZE = globals().get('HISTORY_PAGE_SIZE', 30)
+ROOM_LIST_PAGE_SIZE = globals().get('ROOM_LIST_PAGE_SIZE', 20)
+SEARCH_RESULTS = globals().get('SEARCH_RESULTS', 20)
+SEARCH_SEGMENT_MESSAGES = globals().get('SEARCH_SEGMENT_MESSAGES', 16384)
+SEARCH_INDEX_INTERVAL = globals().get('SEARCH_INDEX_INTERVAL', 5)
+SEARCH_MAX_CANDIDATES = globals().get('SEARCH_MAX_CANDIDATES', 2000)  # Сообщений, проверяемых одним запросом
+ROOM_HISTORY_SIZE = globals().get('ROOM_HISTORY_SIZE', 500)
+USER_HISTORY_SIZE = globals().get('USER_HISTORY_SIZE', 1000)
+ROOM_HISTORY_STORE = globals().get('ROOM_HISTORY_STORE', 'ring')
+# Отложенная запись: интервал сброса изменений в секундах и число изменений для досрочного сброса
+FLUSH_INTERVAL = globals().get('FLUSH_INTERVAL', 1.0)
+FLUSH_MAX_PENDING = globals().get('FLUSH_MAX_PENDING', 500)
+# Фоновые задачи планировщика (интервалы в секундах)
+AUTO_SAVE_INTERVAL = globals().get('AUTO_SAVE_INTERVAL', 60)
+STATS_INTERVAL = globals().get('STATS_INTERVAL', 60)
+# Резервные копии баз: интервал (0 - выключены), каталог и сколько копий хранить
+BACKUP_INTERVAL = globals().get('BACKUP_INTERVAL', 3600)
+BACKUP_DIR = globals().get('BACKUP_DIR', os.path.join(os.path.dirname(DATA_FILE), 'backups'))
+BACKUP_KEEP = globals().get('BACKUP_KEEP', 24)
+# Удаление комнат без участников и без активности дольше EMPTY_ROOM_TTL, проверка каждые CLEANUP_INTERVAL
+AUTO_DELETE_EMPTY_ROOMS = globals().get('AUTO_DELETE_EMPTY_ROOMS', False)
+EMPTY_ROOM_TTL = globals().get('EMPTY_ROOM_TTL', 24 * 3600)
+CLEANUP_INTERVAL = globals().get('CLEANUP_INTERVAL', 300)
+
+# Режим работы сервера: "threaded" (поток на подключение) или "asyncio" (event loop)
+SERVER_MODE = globals().get('SERVER_MODE', 'threaded')
+AUTH_TIMEOUT = globals().get('AUTH_TIMEOUT', 15)
+# Этап аутентификации: потоков-обработчиков, максимум ожидающих входа подключений и на один IP
+HANDSHAKE_WORKERS = globals().get('HANDSHAKE_WORKERS', 16)
+MAX_PENDING_HANDSHAKES = globals().get('MAX_PENDING_HANDSHAKES', 256)
+MAX_HANDSHAKES_PER_IP = globals().get('MAX_HANDSHAKES_PER_IP', 8)
+# Контроль живых соединений: ping после PING_INTERVAL секунд тишины, отключение без
+# ответа за PING_TIMEOUT; клиентов без ping - после CLIENT_IDLE_TIMEOUT (0 - не отключать)
+PING_INTERVAL = globals().get('PING_INTERVAL', 30)
+PING_TIMEOUT = globals().get('PING_TIMEOUT', 10)
+CLIENT_IDLE_TIMEOUT = globals().get('CLIENT_IDLE_TIMEOUT', 0)
+HEARTBEAT_TICK = globals().get('HEARTBEAT_TICK', 1.0)
+# TCP keepalive: начало проверок после KEEPALIVE_IDLE секунд тишины (0 - выключен)
+KEEPALIVE_IDLE = globals().get('KEEPALIVE_IDLE', 60)
+KEEPALIVE_INTERVAL = globals().get('KEEPALIVE_INTERVAL', 10)
+KEEPALIVE_COUNT = globals().get('KEEPALIVE_COUNT', 6)
+# Хеширование паролей: параметры scrypt, процессы пула и максимум задач в очереди пула
+PASSWORD_SCRYPT_N = globals().get('PASSWORD_SCRYPT_N', 2 ** 14)
+PASSWORD_SCRYPT_R = globals().get('PASSWORD_SCRYPT_R', 8)
+PASSWORD_SCRYPT_P = globals().get('PASSWORD_SCRYPT_P', 1)
+HASH_WORKERS = globals().get('HASH_WORKERS', os.cpu_count() or 1)
+HASH_QUEUE_SIZE = globals().get('HASH_QUEUE_SIZE', 64)
+# Количество процессов-воркеров на одном порту (SO_REUSEPORT) и путь к сокету шины событий
+WORKERS = globals().get('WORKERS', 1)
+BUS_SOCKET = globals().get('BUS_SOCKET', '/tmp/terminal-chat-bus.sock')
+# Ограничения очереди отправки на одного клиента и политика для медленных клиентов
+OUTBOUND_MAX_BYTES = globals().get('OUTBOUND_MAX_BYTES', 256 * 1024)
+OUTBOUND_MAX_FRAMES = globals().get('OUTBOUND_MAX_FRAMES', 1000)
+SLOW_CONSUMER_POLICY = globals().get('SLOW_CONSUMER_POLICY', 'drop_oldest')
+# Параллельная рассылка в больших комнатах (потоковый режим)
+FANOUT_WORKERS = globals().get('FANOUT_WORKERS', 4)
+FANOUT_THRESHOLD = globals().get('FANOUT_THRESHOLD', 200)
+# Количество потоков-владельцев комнат (модель акторов, потоковый режим)
+ROOM_EXECUTORS = globals().get('ROOM_EXECUTORS', 8)
+# Ограничение частоты (токенов в секунду, запас), None - без ограничения. Сообщение
+# стоит 1 токен, команда - COMMAND_COSTS (по умолчанию 1); байты считаются отдельно
+RATE_LIMIT_USER = globals().get('RATE_LIMIT_USER', (10, 30))
+RATE_LIMIT_IP = globals().get('RATE_LIMIT_IP', (50, 150))
+RATE_LIMIT_ROOM = globals().get('RATE_LIMIT_ROOM', (100, 300))
+RATE_LIMIT_BYTES = globals().get('RATE_LIMIT_BYTES', (64 * 1024, 256 * 1024))  # на пользователя и на IP
+RATE_LIMIT_MAX_DELAY = globals().get('RATE_LIMIT_MAX_DELAY', 1.0)  # Дольше - сообщение отбрасывается
+COMMAND_COSTS = globals().get('COMMAND_COSTS', {
+    '/list': 5, '/chathistory': 5, '/search': 5, '/history': 2, '/myrooms': 2, '/stats': 3, '/perf': 3, '/create': 5,
+})
+# HTTP метрики в формате Prometheus (0 - выключено); воркер N слушает METRICS_PORT + N
+METRICS_HOST = globals().get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = globals().get('METRICS_PORT', 0)
+# Пользователи, которым доступны команды администратора сервера (/perf)
+SERVER_ADMINS = globals().get('SERVER_ADMINS', [])
+# Формат журнала действий пользователей: "text" или "json" (одна JSON запись на строку)
+ACTION_LOG_FORMAT = globals().get('ACTION_LOG_FORMAT', 'text')
+
+# Протокол v2: кадр = заголовок (длина полезной нагрузки uint32, тип uint8) + текст UTF-8.
+# Клиент запрашивает его при входе строкой "LOGIN:<имя>;proto=2", после чего все
+# дальнейшие сообщения в обе стороны передаются кадрами. Старые клиенты работают
+# в текстовом режиме без изменений.
+PROTOCOL_LEGACY = 1
+PROTOCOL_FRAMED = 2
+FRAME_HEADER = struct.Struct('!IB')
+FRAME_TEXT = 1  # Сообщение чата, команда или ответ сервера
+FRAME_AUTH = 2  # Шаг аутентификации
+FRAME_PING = 3  # Проверка связи, получатель отвечает FRAME_PONG с тем же содержимым
+FRAME_PONG = 4
+
+class ProtocolError(Exception):
+    """Нарушение формата протокола v2"""
+
+def encode_message(text, protocol: int, frame_type: int = FRAME_TEXT) -> bytes:
+    """Закодировать одно сообщение для указанной версии протокола
+    (text - строка или уже закодированный UTF-8)"""
+    payload = text if isinstance(text, bytes) else text.encode('utf-8')
+    if protocol == PROTOCOL_FRAMED:
+        return FRAME_HEADER.pack(len(payload), frame_type) + payload
+    return payload
+
+def encode_messages(texts: List, protocol: int) -> bytes:
+    """Закодировать несколько сообщений для отправки одной записью"""
+    if protocol == PROTOCOL_FRAMED:
+        return b''.join(encode_message(text, protocol) for text in texts)
+    if all(isinstance(text, str) for text in texts):
+        return '\n'.join(texts).encode('utf-8')
+    return b'\n'.join(encode_message(text, protocol) for text in texts)
+
+def take_frame(buffer: bytearray, limit: int) -> Optional[Tuple[int, str]]:
+    """Извлечь из буфера один полный кадр (тип, текст) или None если данных мало"""
+    if len(buffer) < FRAME_HEADER.size:
+        return None
+    length, frame_type = FRAME_HEADER.unpack_from(buffer)
+    if length > limit:
+        raise ProtocolError(f"Кадр слишком большой: {length} байт")
+    end = FRAME_HEADER.size + length
+    if len(buffer) < end:
+        return None
+    payload = bytes(buffer[FRAME_HEADER.size:end])
+    del buffer[:end]
+    return frame_type, payload.decode('utf-8')
+
+def negotiate_protocol(conn, login_data: str) -> str:
+    """Выбрать версию протокола по опциям строки логина и вернуть строку без опций.
+    Опция ping=1 (только с proto=2) - клиент отвечает на FRAME_PING."""
+    if not login_data.startswith("LOGIN:") or ';' not in login_data:
+        return login_data
+    login, *options = login_data.split(';')
+    heartbeat = False
+    for option in options:
+        key, _, value = option.strip().partition('=')
+        if key.lower() == 'proto' and value == str(PROTOCOL_FRAMED):
+            conn.protocol = PROTOCOL_FRAMED
+        elif key.lower() == 'ping' and value == '1':
+            heartbeat = True
+    conn.heartbeat = heartbeat and conn.protocol == PROTOCOL_FRAMED
+    return login
+
+def configure_keepalive(sock):
+    """Включить TCP keepalive, чтобы ядро обнаруживало полуоткрытые соединения.
+    TCP_USER_TIMEOUT закрывает соединение, если отправленные данные не
+    подтверждаются столько же времени (keepalive в этом случае не работает)."""
+    if not KEEPALIVE_IDLE or sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                            ('TCP_KEEPCNT', KEEPALIVE_COUNT),
+                            ('TCP_USER_TIMEOUT', (KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT) * 1000)):
+            option = getattr(socket, name, None)
+            if option is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+    except OSError as e:
+        logging.getLogger('ChatServer').debug("Не удалось настроить TCP keepalive: %s", e)
+
+# Количество частей, на которые делятся счетчики метрик между потоками
+METRIC_SHARDS = 16
+metric_thread = threading.local()
+metric_thread_numbers = itertools.count()
+
+def metric_shard() -> int:
+    """Часть счетчиков, закрепленная за текущим потоком (потоки распределяются по кругу)"""
+    try:
+        return metric_thread.shard
+    except AttributeError:
+        metric_thread.shard = next(metric_thread_numbers) % METRIC_SHARDS
+        return metric_thread.shard
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+class Counter:
+    """Счетчик, который увеличивают многие потоки.
+
+    Значение разделено на METRIC_SHARDS частей со своими блокировками: поток
+    всегда увеличивает свою часть, поэтому потоки почти не ждут друг друга,
+    а части складываются только при чтении.
+    """
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.locks = [threading.Lock() for _ in range(METRIC_SHARDS)]
+        self.values = [0] * METRIC_SHARDS
+        
+    def inc(self, amount: int = 1):
+        shard = metric_shard()
+        with self.locks[shard]:
+            self.values[shard] += amount
+            
+    def value(self) -> int:
+        return sum(self.values)
+    
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+    
+    def samples(self, labels: Dict[str, str] = None) -> List[str]:
+        return [f"{self.name}{format_labels(labels)} {self.value()}"]
+    
+    def expose(self) -> List[str]:
+        return self.header() + self.samples()
+
+class Histogram:
+    """Гистограмма с логарифмическими ячейками в духе HdrHistogram.
+
+    Каждый интервал [lowest * 2^k, lowest * 2^(k+1)) делится на SUB_BUCKETS
+    равных ячеек, поэтому относительная погрешность не превышает 1/SUB_BUCKETS
+    на любом масштабе, а запись значения - это frexp и увеличение счетчика
+    ячейки. Последняя ячейка собирает значения больше lowest * 2^octaves.
+    Ячейки разделены между потоками, как у Counter.
+    """
+    SUB_BUCKETS = 4
+    
+    def __init__(self, name: str, help_text: str, lowest: float = 1e-5, octaves: int = 24):
+        self.name = name
+        self.help = help_text
+        self.lowest = lowest
+        self.size = octaves * self.SUB_BUCKETS + 1
+        self.locks = [threading.Lock() for _ in range(METRIC_SHARDS)]
+        self.counts = [[0] * self.size for _ in range(METRIC_SHARDS)]
+        self.sums = [0.0] * METRIC_SHARDS
+        
+    def index(self, value: float) -> int:
+        mantissa, exponent = math.frexp(value / self.lowest)
+        index = (exponent - 1) * self.SUB_BUCKETS + int((mantissa - 0.5) * 2 * self.SUB_BUCKETS)
+        return min(max(index, 0), self.size - 1)
+    
+    def upper_bound(self, index: int) -> float:
+        """Верхняя граница ячейки"""
+        if index == self.size - 1:
+            return math.inf
+        octave, sub = divmod(index, self.SUB_BUCKETS)
+        return self.lowest * 2 ** octave * (1 + (sub + 1) / self.SUB_BUCKETS)
+        
+    def observe(self, value: float):
+        index = self.index(value)
+        shard = metric_shard()
+        with self.locks[shard]:
+            self.counts[shard][index] += 1
+            self.sums[shard] += value
+            
+    def snapshot(self) -> Tuple[List[int], float]:
+        """Сложить части: (счетчики ячеек, сумма значений)"""
+        counts = [0] * self.size
+        total = 0.0
+        for shard in range(METRIC_SHARDS):
+            with self.locks[shard]:
+                counts = [a + b for a, b in zip(counts, self.counts[shard])]
+                total += self.sums[shard]
+        return counts, total
+    
+    def quantile(self, fraction: float) -> float:
+        """Оценка квантиля сверху (граница ячейки), 0 если значений нет"""
+        counts, _ = self.snapshot()
+        rank = fraction * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.upper_bound(index), self.lowest * 2 ** (self.size // self.SUB_BUCKETS))
+        return 0.0
+    
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+    
+    def samples(self, labels: Dict[str, str] = None) -> List[str]:
+        """Накопительные ячейки le до последней непустой: набор границ только
+        растет, поэтому между опросами он стабилен"""
+        labels = labels or {}
+        counts, total = self.snapshot()
+        last = max((index for index, count in enumerate(counts[:-1]) if count), default=0)
+        lines = []
+        cumulative = 0
+        for index in range(last + 1):
+            cumulative += counts[index]
+            bucket = format_labels({**labels, 'le': f"{self.upper_bound(index):.6g}"})
+            lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+        lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': '+Inf'})} {sum(counts)}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {total:.6f}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {sum(counts)}")
+        return lines
+    
+    def expose(self) -> List[str]:
+        return self.header() + self.samples()
+
+class Gauge:
+    """Метрика, значение которой вычисляется при опросе.
+
+    func возвращает число или словарь {значение метки: число}; при нескольких
+    метках label - кортеж имен, а ключи словаря - кортежи значений. kind='counter'
+    для уже существующих счетчиков (например, словарей counters компонентов).
+    """
+    def __init__(self, name: str, help_text: str, func, kind: str = 'gauge', label=None):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.kind = kind
+        self.label = label
+        
+    def expose(self) -> List[str]:
+        value = self.func()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if isinstance(value, dict):
+            for key, item in value.items():
+                labels = dict(zip(self.label, key)) if isinstance(self.label, tuple) else {self.label: key}
+                lines.append(f"{self.name}{format_labels(labels)} {item}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+# Метка для всех неизвестных команд
+UNKNOWN_COMMAND = 'unknown'
+
+class CommandStats:
+    """Стоимость одной команды: вызовы, ошибки, время выполнения и объем ответов"""
+    def __init__(self, command: str):
+        self.command = command
+        self.calls = Counter('chat_command_calls_total', 'Вызовов команды')
+        self.errors = Counter('chat_command_errors_total', 'Команд, завершившихся исключением')
+        self.response_bytes = Counter('chat_command_response_bytes_total', 'Байт в ответах команды')
+        self.duration = Histogram('chat_command_duration_seconds', 'Время выполнения команды')
+        
+class CommandMetrics:
+    """Метрики команд чата с меткой command"""
+    name = 'chat_command'
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands: Dict[str, CommandStats] = {}
+        
+    def get(self, command: str) -> CommandStats:
+        stats = self.commands.get(command)
+        if stats is None:
+            with self.lock:
+                stats = self.commands.setdefault(command, CommandStats(command))
+        return stats
+    
+    def top(self, limit: int) -> List[CommandStats]:
+        """Команды с наибольшим суммарным временем выполнения"""
+        with self.lock:
+            commands = list(self.commands.values())
+        commands = [stats for stats in commands if stats.calls.value()]
+        commands.sort(key=lambda stats: stats.duration.snapshot()[1], reverse=True)
+        return commands[:limit]
+    
+    def expose(self) -> List[str]:
+        with self.lock:
+            commands = sorted(self.commands.values(), key=lambda stats: stats.command)
+        lines = []
+        for field in ('calls', 'errors', 'response_bytes', 'duration'):
+            if not commands:
+                break
+            lines.extend(getattr(commands[0], field).header())
+            for stats in commands:
+                lines.extend(getattr(stats, field).samples({'command': stats.command}))
+        return lines
+
+class MetricsRegistry:
+    """Метрики процесса и их вывод в текстовом формате Prometheus"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: Dict[str, object] = {}
+        
+    def register(self, metric):
+        """Добавить метрику; метрика с тем же именем заменяется"""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+        
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self.register(Counter(name, help_text))
+    
+    def histogram(self, name: str, help_text: str, lowest: float = 1e-5, octaves: int = 24) -> Histogram:
+        return self.register(Histogram(name, help_text, lowest, octaves))
+    
+    def gauge(self, name: str, help_text: str, func, kind: str = 'gauge', label=None) -> Gauge:
+        return self.register(Gauge(name, help_text, func, kind, label))
+    
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.expose())
+            except Exception as e:
+                logging.getLogger('ChatServer').error("Ошибка метрики %s: %s", metric.name, e)
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+FANOUT_LATENCY = METRICS.histogram(
+    'chat_fanout_latency_seconds', 'Время от получения сообщения до постановки в очереди получателей')
+FANOUT_DURATION = METRICS.histogram(
+    'chat_fanout_duration_seconds', 'Длительность рассылки сообщения (в пуле - одного потока рассылки)')
+SEND_QUEUE_DEPTH = METRICS.histogram(
+    'chat_send_queue_depth', 'Кадров в очереди отправки подключения перед записью в сокет', lowest=1, octaves=16)
+SAVE_DURATION = METRICS.histogram('chat_save_duration_seconds', 'Длительность записи пачки изменений в базу')
+LOGIN_DURATION = METRICS.histogram(
+    'chat_login_duration_seconds', 'Время от принятия подключения до входа пользователя')
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """GET /metrics - метрики процесса в текстовом формате Prometheus"""
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def log_message(self, format, *args):
+        logging.getLogger('ChatServer').debug("Метрики: %s " + format, self.address_string(), *args)
+
+# Максимум буферов в одном вызове sendmsg (ограничение IOV_MAX)
+try:
+    WRITE_BATCH_BUFFERS = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    WRITE_BATCH_BUFFERS = 1024
+
+# Виды записей в очереди исходящих данных
+QUEUED_CONTROL = 0  # Ответы команд, аутентификация - никогда не отбрасываются
+QUEUED_CHAT = 1     # Сообщения комнаты - могут быть отброшены у медленного клиента
+QUEUED_MARKER = 2   # Отметка "пропущено N сообщений"
+
+class OutboundPolicy:
+    """Ограничения очереди исходящих данных и поведение при медленном получателе.
+
+    drop_oldest - отбросить самые старые сообщения чата,
+    skip_to_latest - оставить только последнее сообщение с отметкой о пропуске,
+    disconnect - отключить клиента.
+    """
+    POLICIES = ('drop_oldest', 'skip_to_latest', 'disconnect')
+    
+    def __init__(self, max_bytes: int, max_frames: int, policy: str):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Неизвестная политика медленного клиента: {policy}")
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.counters = {'dropped': 0, 'skipped': 0, 'disconnected': 0}
+        
+    def count(self, key: str, amount: int = 1):
+        with self.lock:
+            self.counters[key] += amount
+
+class BaseConnection:
+    """Общая часть подключений: версия протокола и очередь исходящих кадров.
+
+    send() только ставит данные в очередь подключения и не блокирует вызывающий
+    поток. Очередь опустошает собственный писатель подключения, объединяя все
+    накопленные кадры в один системный вызов записи. Размер очереди ограничен
+    политикой OutboundPolicy.
+    """
+    def __init__(self, address, policy: OutboundPolicy):
+        self.address = address
+        self.policy = policy
+        self.protocol = PROTOCOL_LEGACY
+        self.lock = threading.Lock()
+        self.pending = collections.deque()  # (данные, вид записи)
+        self.pending_bytes = 0
+        self.pending_skipped = 0  # Сколько сообщений учтено в отметке о пропуске в очереди
+        self.closing = False
+        self.closed = False
+        self.heartbeat = False  # Клиент отвечает на FRAME_PING
+        self.last_seen = time.monotonic()  # Когда от клиента последний раз пришли данные
+        self.ping_sent = 0.0
+        self.accepted_at = time.monotonic()  # Для метрики времени входа
+        self.throttle_notice = 0.0  # Когда клиенту последний раз сообщили об отброшенном сообщении
+        
+    def send(self, data: bytes, kind: int = QUEUED_CONTROL):
+        """Поставить данные в очередь на отправку"""
+        with self.lock:
+            if self.closing or self.closed:
+                raise ConnectionResetError("Соединение закрыто")
+            self.pending.append((data, kind))
+            self.pending_bytes += len(data)
+            overflow = self.over_limit() and not self.relieve_pressure()
+        if overflow:
+            self.policy.count('disconnected')
+            logging.getLogger('ChatServer').warning("Отключение медленного клиента %s: переполнена очередь отправки", self.address)
+            self.abort()
+            return
+        self.wake_writer()
+        
+    def send_text(self, text: str, frame_type: int = FRAME_TEXT):
+        self.send(encode_message(text, self.protocol, frame_type))
+        
+    def send_texts(self, texts: List[str]):
+        """Отправить несколько сообщений одной записью"""
+        self.send(encode_messages(texts, self.protocol))
+        
+    def control_frame(self, frame_type: int, payload: str) -> bool:
+        """Обработать служебный кадр, False - кадр не служебный"""
+        if frame_type == FRAME_PING:
+            self.send(encode_message(payload, self.protocol, FRAME_PONG))
+        elif frame_type != FRAME_PONG:
+            return False
+        return True
+        
+    def over_limit(self) -> bool:
+        return self.pending_bytes > self.policy.max_bytes or len(self.pending) > self.policy.max_frames
+        
+    def relieve_pressure(self) -> bool:
+        """Применить политику к переполненной очереди, False если нужно отключение"""
+        if self.policy.policy == 'drop_oldest':
+            dropped = 0
+            # Обычно в начале очереди лежат сообщения чата - O(1) на отброшенное сообщение
+            while self.pending and self.pending[0][1] != QUEUED_CONTROL and self.over_limit():
+                data, kind = self.pending.popleft()
+                self.pending_bytes -= len(data)
+                dropped += kind == QUEUED_CHAT
+            if self.over_limit():
+                kept = collections.deque()
+                frames = len(self.pending)
+                for data, kind in self.pending:
+                    over = self.pending_bytes > self.policy.max_bytes or frames > self.policy.max_frames
+                    if kind != QUEUED_CONTROL and over:
+                        self.pending_bytes -= len(data)
+                        frames -= 1
+                        dropped += kind == QUEUED_CHAT
+                        continue
+                    kept.append((data, kind))
+                self.pending = kept
+            self.policy.count('dropped', dropped)
+            
+        elif self.policy.policy == 'skip_to_latest':
+            chat = [entry for entry in self.pending if entry[1] == QUEUED_CHAT]
+            if len(chat) > 1:
+                latest = chat[-1]
+                skipped = len(chat) - 1
+                self.pending_skipped += skipped
+                marker = encode_message(f"[SYSTEM] Пропущено сообщений: {self.pending_skipped}", self.protocol)
+                self.pending = collections.deque(
+                    entry for entry in self.pending if entry[1] == QUEUED_CONTROL
+                )
+                self.pending.append((marker, QUEUED_MARKER))
+                self.pending.append(latest)
+                self.pending_bytes = sum(len(data) for data, _ in self.pending)
+                self.policy.count('skipped', skipped)
+                
+        return not self.over_limit()
+        
+    def take_batch(self) -> List[bytes]:
+        """Забрать из очереди накопленные кадры для одной записи"""
+        batch = []
+        with self.lock:
+            if self.pending:
+                SEND_QUEUE_DEPTH.observe(len(self.pending))
+            while self.pending and len(batch) < WRITE_BATCH_BUFFERS:
+                data, kind = self.pending.popleft()
+                self.pending_bytes -= len(data)
+                if kind == QUEUED_MARKER:
+                    self.pending_skipped = 0
+                batch.append(data)
+        if self.protocol == PROTOCOL_LEGACY and len(batch) > 1:
+            # В текстовом режиме у сообщений нет границ: разделить их переводом
+            # строки, как это делает encode_messages, иначе клиент получит их слитно
+            batch = [b'\n'.join(batch)]
+        return batch
+        
+    def close(self):
+        """Закрыть подключение после отправки уже поставленных в очередь данных"""
+        if not self.closing:
+            self.closing = True
+            self.wake_writer()
+            
+    def abort(self):
+        """Немедленно разорвать подключение, отбросив очередь"""
+        with self.lock:
+            self.closing = True
+            self.pending.clear()
+            self.pending_bytes = 0
+        self.abort_transport()
+        self.wake_writer()
+            
+    def wake_writer(self):
+        raise NotImplementedError
+        
+    def abort_transport(self):
+        raise NotImplementedError
+
+class ClientConnection(BaseConnection):
+    """Подключение клиента в потоковом режиме.
+
+    Чтение выполняет поток обработчика клиента, запись - отдельный поток
+    подключения, поэтому медленный получатель не задерживает отправителей.
+    """
+    def __init__(self, sock: socket.socket, address, policy: OutboundPolicy):
+        super().__init__(address, policy)
+        self.sock = sock
+        self.buffer = bytearray()
+        self.wakeup = threading.Event()
+        threading.Thread(target=self.writer_worker, daemon=True).start()
+        
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+        
+    def fileno(self) -> int:
+        return self.sock.fileno()
+        
+    def wake_writer(self):
+        self.wakeup.set()
+        
+    def abort_transport(self):
+        try:
+            # Прерывает и заблокированный sendmsg() писателя, и recv() обработчика
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+            
+    def writer_worker(self):
+        """Поток записи: отправляет накопленные кадры одним вызовом sendmsg"""
+        try:
+            while True:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                batch = self.take_batch()
+                while batch:
+                    self.write_batch(batch)
+                    batch = self.take_batch()
+                if self.closing and not self.pending:
+                    break
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            try:
+                # shutdown() будит поток, заблокированный в recv()
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            
+    def write_batch(self, batch: List[bytes]):
+        """Записать пакет буферов, досылая остаток при частичной записи"""
+        if not hasattr(self.sock, 'sendmsg'):
+            self.sock.sendall(b''.join(batch))
+            return
+        buffers = [memoryview(data) for data in batch]
+        while buffers:
+            sent = self.sock.sendmsg(buffers)
+            index = 0
+            while index < len(buffers) and sent >= len(buffers[index]):
+                sent -= len(buffers[index])
+                index += 1
+            buffers = buffers[index:]
+            if buffers and sent:
+                buffers[0] = buffers[0][sent:]
+        
+    def apply_deadline(self, deadline: Optional[float]):
+        """Ограничить ожидание recv() оставшимся до срока временем"""
+        if deadline is None:
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("timed out")
+        self.sock.settimeout(remaining)
+        
+    def recv_message(self, limit: int, deadline: Optional[float] = None) -> Optional[str]:
+        """Получить следующее сообщение клиента, None при закрытии соединения.
+        
+        deadline (time.monotonic()) ограничивает ожидание всего сообщения, а не
+        одного recv(), чтобы клиент не продлевал его, присылая данные по байту.
+        """
+        if self.protocol == PROTOCOL_LEGACY:
+            self.apply_deadline(deadline)
+            data = self.sock.recv(limit)
+            self.last_seen = time.monotonic()
+            return data.decode('utf-8') if data else None
+        
+        while True:
+            frame = take_frame(self.buffer, limit)
+            if frame:
+                frame_type, text = frame
+                if frame_type in (FRAME_TEXT, FRAME_AUTH):
+                    return text
+                self.control_frame(frame_type, text)
+                continue
+            self.apply_deadline(deadline)
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.last_seen = time.monotonic()
+            self.buffer += data
+
+class FanoutPool:
+    """Пул потоков рассылки для больших комнат.
+
+    Сообщение кодируется один раз, а участники комнаты распределены по потокам
+    по подключению: одно подключение всегда обслуживает один и тот же поток,
+    поэтому порядок сообщений для каждого получателя сохраняется.
+    """
+    def __init__(self, workers: int):
+        self.size = workers
+        self.queues = [queue.SimpleQueue() for _ in range(workers)]
+        for work_queue in self.queues:
+            threading.Thread(target=self.sender_worker, args=(work_queue,), daemon=True).start()
+            
+    def shard_of(self, conn) -> int:
+        return hash(conn) % self.size
+        
+    def submit(self, shards: List[List], encoded: Dict[int, bytes], received: float = None):
+        """Передать каждому потоку его часть получателей"""
+        for work_queue, members in zip(self.queues, shards):
+            if members:
+                work_queue.put((members, encoded, received))
+                
+    def sender_worker(self, work_queue: queue.SimpleQueue):
+        while True:
+            members, encoded, received = work_queue.get()
+            started = time.perf_counter()
+            for conn in members:
+                try:
+                    conn.send(encoded[conn.protocol], QUEUED_CHAT)
+                except Exception:
+                    # Подключение уже закрывается, пользователя удалит cleanup_user
+                    pass
+            finished = time.perf_counter()
+            FANOUT_DURATION.observe(finished - started)
+            if received is not None:
+                FANOUT_LATENCY.observe(finished - received)
+
+class HandshakeAdmission:
+    """Допуск подключений на этап аутентификации.
+
+    Считает подключения, которые еще не вошли в систему (в очереди и в процессе
+    диалога), и отклоняет новые сверх общего лимита и лимита на один IP до того,
+    как для них будет создан обработчик.
+    """
+    def __init__(self, max_pending: int, per_ip: int):
+        self.max_pending = max_pending
+        self.per_ip = per_ip
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.by_ip: Dict[str, int] = {}
+        self.counters = {'rejected_busy': 0, 'rejected_ip': 0, 'timeouts': 0}
+        
+    def admit(self, ip: str) -> Optional[str]:
+        """Занять место в очереди, иначе вернуть причину отказа для клиента"""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.counters['rejected_busy'] += 1
+                return "Сервер перегружен. Попробуйте позже."
+            if self.by_ip.get(ip, 0) >= self.per_ip:
+                self.counters['rejected_ip'] += 1
+                return "Слишком много подключений с вашего адреса. Попробуйте позже."
+            self.pending += 1
+            self.by_ip[ip] = self.by_ip.get(ip, 0) + 1
+            return None
+            
+    def release(self, ip: str):
+        with self.lock:
+            self.pending -= 1
+            count = self.by_ip.get(ip, 0) - 1
+            if count > 0:
+                self.by_ip[ip] = count
+            else:
+                self.by_ip.pop(ip, None)
+                
+    def count_timeout(self):
+        with self.lock:
+            self.counters['timeouts'] += 1
+
+class TokenBucket:
+    """Ведро токенов: пополняется на rate токенов в секунду, вмещает не больше burst"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        
+    def wait_time(self, cost: float) -> float:
+        """Через сколько секунд в ведре будет cost токенов"""
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+class RateLimiter:
+    """Ограничение частоты действий клиентов ведрами токенов.
+
+    Ведро заводится на каждую пару (область, ключ): пользователь, IP, комната,
+    байты пользователя и IP. Действие списывает стоимость сразу из всех своих
+    ведер. Если токенов не хватает, но они накопятся за max_delay секунд,
+    действие выполняется с задержкой (ведра уходят в долг, поэтому следующие
+    действия ждут дольше), иначе действие отбрасывается без списания токенов.
+    """
+    SCOPES = ('user', 'ip', 'room', 'user_bytes', 'ip_bytes')
+    
+    def __init__(self, limits: Dict[str, Optional[Tuple[float, float]]], max_delay: float):
+        self.limits = {scope: limit for scope, limit in limits.items() if limit}
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self.counters = {(scope, action): 0 for scope in self.SCOPES for action in ('delayed', 'dropped')}
+        
+    def acquire(self, costs: List[Tuple[str, str, float]]) -> Optional[float]:
+        """costs - (область, ключ, стоимость). Вернуть задержку в секундах
+        перед выполнением действия или None, если действие отброшено"""
+        now = time.monotonic()
+        wait = 0.0
+        limiting = None
+        charges = []
+        with self.lock:
+            for scope, key, cost in costs:
+                limit = self.limits.get(scope)
+                if not limit or not cost:
+                    continue
+                bucket = self.buckets.get((scope, key))
+                if bucket is None:
+                    bucket = self.buckets[(scope, key)] = TokenBucket(limit[0], limit[1], now)
+                bucket.refill(now)
+                # Действие дороже запаса ведра иначе не выполнилось бы никогда
+                cost = min(cost, bucket.burst)
+                charges.append((bucket, cost))
+                bucket_wait = bucket.wait_time(cost)
+                if bucket_wait > wait:
+                    wait, limiting = bucket_wait, scope
+            if wait > self.max_delay:
+                self.counters[(limiting, 'dropped')] += 1
+                return None
+            for bucket, cost in charges:
+                bucket.tokens -= cost
+            if wait:
+                self.counters[(limiting, 'delayed')] += 1
+            return wait
+        
+    def prune(self):
+        """Удалить заполненные ведра: новое ведро будет в том же состоянии"""
+        now = time.monotonic()
+        with self.lock:
+            for key, bucket in list(self.buckets.items()):
+                bucket.refill(now)
+                if bucket.tokens >= bucket.burst:
+                    del self.buckets[key]
+                    
+    def totals(self, action: str) -> Dict[str, int]:
+        with self.lock:
+            return {scope: self.counters[(scope, action)] for scope in self.SCOPES}
+
+class TimingWheel:
+    """Иерархическое колесо таймеров.
+
+    Срок ключа попадает в ячейку уровня, соответствующего его удаленности:
+    уровень 0 - по ячейке на тик, каждый следующий в slots раз грубее. Тик
+    обрабатывает одну ячейку уровня 0; ячейки верхних уровней раз в оборот
+    нижнего переносятся вниз. Установка и отмена срока - O(1), тик - O(1)
+    плюс истекшие ключи, без просмотра всех отслеживаемых.
+    """
+    def __init__(self, tick: float, slots: int = 64, levels: int = 4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.where: Dict[object, Tuple[int, int, int]] = {}  # ключ: (уровень, ячейка, тик срока)
+        self.current = int(time.monotonic() / tick)
+        self.lock = threading.Lock()
+        
+    def schedule(self, key, deadline: float):
+        """Назначить (или перенести) срок ключа, deadline - time.monotonic()"""
+        with self.lock:
+            self.remove(key)
+            self.place(key, max(int(deadline / self.tick), self.current + 1))
+            
+    def cancel(self, key):
+        with self.lock:
+            self.remove(key)
+            
+    def remove(self, key):
+        location = self.where.pop(key, None)
+        if location:
+            self.wheels[location[0]][location[1]].discard(key)
+            
+    def place(self, key, when: int):
+        level = 0
+        span = self.slots
+        while when - self.current >= span and level < self.levels - 1:
+            level += 1
+            span *= self.slots
+        slot = (when // (span // self.slots)) % self.slots
+        self.wheels[level][slot].add(key)
+        self.where[key] = (level, slot, when)
+        
+    def advance(self, now: float) -> List:
+        """Провернуть колесо до момента now и вернуть ключи с истекшим сроком"""
+        expired = []
+        target = int(now / self.tick)
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                # Перенести вниз ячейки уровней, у которых начался новый оборот
+                for level in range(self.levels - 1, 0, -1):
+                    span = self.slots ** level
+                    if self.current % span:
+                        continue
+                    slot = (self.current // span) % self.slots
+                    bucket, self.wheels[level][slot] = self.wheels[level][slot], set()
+                    for key in bucket:
+                        self.place(key, self.where.pop(key)[2])
+                slot = self.current % self.slots
+                bucket, self.wheels[0][slot] = self.wheels[0][slot], set()
+                for key in bucket:
+                    del self.where[key]
+                expired.extend(bucket)
+        return expired
+    
+    def __len__(self) -> int:
+        return len(self.where)
+
+class ScheduledJob:
+    """Задача планировщика и ее метрики"""
+    def __init__(self, name: str, func, interval: Optional[float], jitter: float):
+        self.name = name
+        self.func = func
+        self.interval = interval  # None - однократная задача
+        self.jitter = jitter  # Доля интервала, на которую случайно сдвигается запуск
+        self.cancelled = False
+        self.running = False
+        self.runs = 0
+        self.errors = 0
+        self.overlaps = 0  # Пропущенные запуски: предыдущий еще выполнялся
+        self.total_time = 0.0
+        self.max_time = 0.0
+        
+    def next_delay(self) -> float:
+        return self.interval + random.uniform(0, self.interval * self.jitter)
+
+class Scheduler:
+    """Планировщик фоновых задач: периодических и однократных.
+
+    Один поток ждет ближайший срок в куче, задачи выполняют несколько
+    потоков-исполнителей, поэтому долгая запись на диск не задерживает
+    остальные задачи. Задача не запускается повторно, пока выполняется
+    предыдущий запуск (пропуск учитывается в метриках). shutdown() сразу
+    будит поток ожидания, ждущие запуска задачи отменяются.
+    """
+    def __init__(self, workers: int = 4):
+        self.condition = threading.Condition()
+        self.heap: List[Tuple[float, int, ScheduledJob]] = []
+        self.jobs: Dict[str, ScheduledJob] = {}
+        self.counter = 0
+        self.stopped = False
+        self.ready: queue.SimpleQueue = queue.SimpleQueue()
+        self.workers = workers
+        threading.Thread(target=self.run, name='scheduler', daemon=True).start()
+        for _ in range(workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+            
+    def every(self, name: str, interval: float, func, jitter: float = 0.1, delay: float = None) -> ScheduledJob:
+        """Выполнять func каждые interval секунд (первый раз - через delay)"""
+        job = ScheduledJob(name, func, interval, jitter)
+        self.add(job, job.next_delay() if delay is None else delay)
+        return job
+    
+    def once(self, name: str, delay: float, func) -> ScheduledJob:
+        job = ScheduledJob(name, func, None, 0)
+        self.add(job, delay)
+        return job
+        
+    def add(self, job: ScheduledJob, delay: float):
+        with self.condition:
+            previous = self.jobs.get(job.name)
+            if previous:
+                previous.cancelled = True
+            self.jobs[job.name] = job
+            self.push(job, time.monotonic() + delay)
+            
+    def push(self, job: ScheduledJob, when: float):
+        self.counter += 1
+        heapq.heappush(self.heap, (when, self.counter, job))
+        if self.heap[0][2] is job:
+            self.condition.notify()
+            
+    def cancel(self, name: str):
+        with self.condition:
+            job = self.jobs.pop(name, None)
+            if job:
+                job.cancelled = True
+                
+    def run(self):
+        with self.condition:
+            while not self.stopped:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                when, _, job = self.heap[0]
+                now = time.monotonic()
+                if when > now:
+                    self.condition.wait(when - now)
+                    continue
+                heapq.heappop(self.heap)
+                if job.cancelled:
+                    continue
+                if job.running:
+                    job.overlaps += 1
+                else:
+                    job.running = True
+                    self.ready.put(job)
+                if job.interval:
+                    # Следующий срок отсчитывается от назначенного, чтобы запуски не смещались
+                    self.push(job, max(when + job.next_delay(), now))
+                elif self.jobs.get(job.name) is job:
+                    del self.jobs[job.name]
+                    
+    def worker(self):
+        while True:
+            job = self.ready.get()
+            if job is None or self.stopped:
+                return
+            started = time.perf_counter()
+            try:
+                job.func()
+            except Exception as e:
+                job.errors += 1
+                logging.getLogger('ChatServer').error("Ошибка фоновой задачи %s: %s", job.name, e)
+            finally:
+                elapsed = time.perf_counter() - started
+                job.runs += 1
+                job.total_time += elapsed
+                job.max_time = max(job.max_time, elapsed)
+                job.running = False
+                
+    def metrics(self) -> str:
+        """Строка с метриками задач для /stats"""
+        with self.condition:
+            jobs = list(self.jobs.values())
+        return ", ".join(
+            f"{job.name} {job.runs} раз (ср. {job.total_time / job.runs * 1000 if job.runs else 0:.1f} мс, "
+            f"макс. {job.max_time * 1000:.1f} мс, пропущено {job.overlaps}, ошибок {job.errors})"
+            for job in jobs
+        ) or "нет"
+                
+    def counts(self, field: str) -> Dict[str, int]:
+        """Значение счетчика задач (runs, errors, overlaps) по именам задач"""
+        with self.condition:
+            return {job.name: getattr(job, field) for job in self.jobs.values()}
+                
+    def shutdown(self):
+        """Остановить планировщик; выполняющиеся задачи завершаются сами"""
+        with self.condition:
+            self.stopped = True
+            self.heap.clear()
+            self.condition.notify_all()
+        for _ in range(self.workers):
+            self.ready.put(None)
+
+class Session:
+    """Сессия вошедшего пользователя: одно подключение"""
+    __slots__ = ('username', 'conn', 'fd', 'user', 'address', 'room_id', 'connected_at')
+    
+    def __init__(self, username: str, conn, user: 'User', address):
+        self.username = username
+        self.conn = conn
+        self.fd = conn.fileno() if hasattr(conn, 'fileno') else -1
+        self.user = user
+        self.address = address
+        self.room_id: Optional[str] = None
+        self.connected_at = time.time()
+
+class ConnectionRegistry:
+    """Реестр сессий вошедших пользователей.
+
+    Единственное место, где хранятся связи пользователя, подключения,
+    дескриптора, комнаты и адреса. Каждая связь проиндексирована, поиск
+    в любом направлении - O(1). Индексы меняются вместе под одной
+    блокировкой; чтение одного индекса блокировки не требует.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_user: Dict[str, Session] = {}
+        self.by_conn: Dict[object, Session] = {}
+        self.by_fd: Dict[int, Session] = {}
+        self.rooms: Dict[str, set] = {}  # room_id: имена локальных участников
+        
+    def register(self, username: str, conn, user: 'User', address) -> Optional[Session]:
+        """Зарегистрировать сессию; вернуть вытесненную сессию того же пользователя"""
+        session = Session(username, conn, user, address)
+        with self.lock:
+            previous = self.by_user.get(username)
+            if previous:
+                self.drop(previous)
+            self.by_user[username] = session
+            self.by_conn[conn] = session
+            if session.fd >= 0:
+                self.by_fd[session.fd] = session
+        return previous
+        
+    def unregister(self, conn) -> Optional[Session]:
+        """Удалить сессию подключения. None - сессия уже вытеснена повторным входом"""
+        with self.lock:
+            session = self.by_conn.get(conn)
+            if session:
+                self.drop(session)
+        return session
+        
+    def drop(self, session: Session):
+        """Удалить сессию из всех индексов (под lock); session.room_id сохраняется"""
+        if self.by_user.get(session.username) is session:
+            del self.by_user[session.username]
+        self.by_conn.pop(session.conn, None)
+        if self.by_fd.get(session.fd) is session:
+            del self.by_fd[session.fd]
+        self.forget_room(session)
+        
+    def forget_room(self, session: Session):
+        members = self.rooms.get(session.room_id)
+        if members is not None:
+            members.discard(session.username)
+            if not members:
+                del self.rooms[session.room_id]
+                
+    def set_room(self, username: str, room_id: Optional[str]) -> Optional[str]:
+        """Перевести пользователя в комнату (None - ни в какую), вернуть предыдущую"""
+        with self.lock:
+            session = self.by_user.get(username)
+            if not session:
+                return None
+            previous = session.room_id
+            self.forget_room(session)
+            session.room_id = room_id
+            if room_id:
+                self.rooms.setdefault(room_id, set()).add(username)
+            return previous
+            
+    def leave_room(self, username: str, room_id: str) -> bool:
+        """Убрать пользователя из комнаты, только если он все еще в ней"""
+        with self.lock:
+            session = self.by_user.get(username)
+            if not session or session.room_id != room_id:
+                return False
+            self.forget_room(session)
+            session.room_id = None
+            return True
+        
+    def get(self, username: str) -> Optional[Session]:
+        return self.by_user.get(username)
+    
+    def for_conn(self, conn) -> Optional[Session]:
+        return self.by_conn.get(conn)
+    
+    def for_fd(self, fd: int) -> Optional[Session]:
+        return self.by_fd.get(fd)
+        
+    def conn_of(self, username: str):
+        session = self.by_user.get(username)
+        return session.conn if session else None
+    
+    def room_of(self, username: str) -> Optional[str]:
+        session = self.by_user.get(username)
+        return session.room_id if session else None
+    
+    def members(self, room_id: str) -> List[str]:
+        """Участники комнаты, подключенные к этому процессу"""
+        with self.lock:
+            return list(self.rooms.get(room_id, ()))
+        
+    def all(self) -> List[Session]:
+        with self.lock:
+            return list(self.by_user.values())
+        
+    def __contains__(self, username: str) -> bool:
+        return username in self.by_user
+    
+    def __len__(self) -> int:
+        return len(self.by_user)
+
+# Формат хеша пароля: "scrypt$N$r$p$соль$хеш" (hex). Старые хеши - несоленый
+# SHA-256 без префикса; они принимаются и заменяются при следующем входе.
+def scrypt_maxmem(n: int, r: int, p: int) -> int:
+    """Лимит памяти для scrypt с запасом: без него OpenSSL разрешает только 32 МБ,
+    и уже N = 2**15 при r = 8 завершается ошибкой"""
+    return 128 * r * n * p + 1024 * 1024
+
+def check_scrypt_params(n: int, r: int, p: int):
+    """Проверить параметры scrypt при запуске, а не при первой регистрации"""
+    if n < 2 or n & (n - 1):
+        raise ValueError(f"PASSWORD_SCRYPT_N должен быть степенью двойки больше 1: {n}")
+    if r < 1 or p < 1:
+        raise ValueError(f"PASSWORD_SCRYPT_R и PASSWORD_SCRYPT_P должны быть положительными: {r}, {p}")
+    if r * p >= 2 ** 30:
+        raise ValueError(f"Слишком большое произведение PASSWORD_SCRYPT_R * PASSWORD_SCRYPT_P: {r * p}")
+
+def hash_password(password: str) -> str:
+    """Вычислить соленый хеш пароля с текущими параметрами scrypt"""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=PASSWORD_SCRYPT_N,
+                            r=PASSWORD_SCRYPT_R, p=PASSWORD_SCRYPT_P,
+                            maxmem=scrypt_maxmem(PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P))
+    return f"scrypt${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+def verify_password(stored_hash: str, password: str) -> Tuple[bool, Optional[str]]:
+    """Проверить пароль. Возвращает (верен ли, новый хеш если сохраненный устарел)"""
+    if stored_hash.startswith('scrypt$'):
+        _, n, r, p, salt, expected = stored_hash.split('$')
+        n, r, p = int(n), int(r), int(p)
+        digest = hashlib.scrypt(password.encode('utf-8'), salt=bytes.fromhex(salt),
+                                n=n, r=r, p=p, maxmem=scrypt_maxmem(n, r, p))
+        valid = hmac.compare_digest(digest.hex(), expected)
+        outdated = (n, r, p) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    else:
+        legacy = hashlib.sha256(password.encode('utf-8')).hexdigest()
+        valid = hmac.compare_digest(legacy, stored_hash)
+        outdated = True
+    if valid and outdated:
+        return True, hash_password(password)
+    return valid, None
+
+def ignore_interrupts():
+    """Процессы пула завершает родитель, Ctrl+C их не касается"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class HasherBusy(Exception):
+    """Очередь пула хеширования заполнена"""
+    pass
+
+class PasswordHasher:
+    """Пул процессов для хеширования паролей.
+
+    Хеширование занимает десятки миллисекунд процессорного времени, поэтому оно
+    выполняется в отдельных процессах, а обработчик подключения только ждет
+    результат. Очередь ограничена: при всплеске входов лишние попытки сразу
+    получают отказ, а не копятся в памяти.
+    """
+    def __init__(self, workers: int, queue_size: int):
+        check_scrypt_params(PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, workers),
+            # spawn: не копировать в дочерние процессы потоки и блокировки сервера
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=ignore_interrupts
+        )
+        
+    def submit(self, fn, *args) -> concurrent.futures.Future:
+        with self.lock:
+            if self.queued >= self.queue_size:
+                raise HasherBusy()
+            self.queued += 1
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.task_done(None)
+            raise
+        future.add_done_callback(self.task_done)
+        return future
+        
+    def task_done(self, future):
+        with self.lock:
+            self.queued -= 1
+            
+    def hash(self, password: str) -> concurrent.futures.Future:
+        return self.submit(hash_password, password)
+        
+    def verify(self, stored_hash: str, password: str) -> concurrent.futures.Future:
+        return self.submit(verify_password, stored_hash, password)
+        
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class MessageRecord:
+    """Сообщение истории в памяти.
+
+    Одно числовое время вместо двух строк с датой, имена отправителей и
+    комнат интернированы - все сообщения одного пользователя ссылаются на
+    одну строку. Словари нужного формата строятся только для диска и шины.
+    """
+    __slots__ = ('created', 'sender', 'room_id', 'text')
+    
+    def __init__(self, text: str, sender: str = None, room_id: str = None, created: float = None):
+        self.created = time.time() if created is None else created
+        self.sender = sys.intern(sender) if sender else None
+        self.room_id = sys.intern(room_id) if room_id else None
+        self.text = text
+        
+    @property
+    def timestamp(self) -> str:
+        """Время для отображения (ЧЧ:ММ:СС)"""
+        return time.strftime("%H:%M:%S", time.localtime(self.created))
+    
+    @property
+    def date(self) -> str:
+        return datetime.datetime.fromtimestamp(self.created).isoformat()
+    
+    @staticmethod
+    def parse_time(value) -> float:
+        """Время из ISO строки сохраненной записи"""
+        try:
+            return datetime.datetime.fromisoformat(value).timestamp()
+        except (TypeError, ValueError):
+            return time.time()
+    
+    def to_dict(self) -> Dict:
+        """Сообщение комнаты в формате журнала и шины событий"""
+        return {'timestamp': self.timestamp, 'sender': self.sender, 'message': self.text, 'date': self.date}
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'MessageRecord':
+        return cls(data.get('message', ''), data.get('sender'), created=cls.parse_time(data.get('date')))
+
+class MessageRing:
+    """Кольцевой буфер последних сообщений емкостью capacity.
+
+    Добавление O(1): при заполнении самая старая запись перезаписывается,
+    без копирования списка при обрезке. Список растет по мере добавления,
+    поэтому пустая комната или пользователь без сообщений почти не занимают
+    памяти.
+    """
+    __slots__ = ('items', 'start', 'capacity')
+    
+    def __init__(self, capacity: int, records=()):
+        self.items: List[MessageRecord] = []
+        self.start = 0
+        self.capacity = capacity
+        for record in records:
+            self.append(record)
+            
+    @property
+    def size(self) -> int:
+        return len(self.items)
+            
+    def append(self, record: MessageRecord):
+        items = self.items
+        if len(items) < self.capacity:
+            # Буфер еще не заполнен: начало остается на нулевой позиции
+            items.append(record)
+        else:
+            items[self.start] = record
+            self.start = (self.start + 1) % self.capacity
+            
+    def last(self, count: int):
+        """Последние count записей от старых к новым, без копирования буфера"""
+        count = min(count, self.size)
+        capacity = len(self.items)
+        first = self.start + self.size - count
+        for index in range(first, first + count):
+            yield self.items[index % capacity]
+            
+    def lines(self, count: int) -> List[str]:
+        """Последние count сообщений в виде строк для отправки"""
+        return [
+            f"[{record.timestamp}] {record.sender}: {record.text}" if record.sender
+            else f"[{record.timestamp}] {record.text}"
+            for record in self.last(count)
+        ]
+            
+    def __iter__(self):
+        return self.last(self.size)
+    
+    def __len__(self) -> int:
+        return self.size
+
+class ColumnarHistory:
+    """Колоночное хранилище последних сообщений комнаты (ROOM_HISTORY_STORE = 'columnar').
+
+    Время, порядковые номера и отправители хранятся в массивах array,
+    которые растут до емкости capacity (отправитель - номер в таблице имен), тексты
+    упакованы в один буфер UTF-8 со смещениями. Вместо нескольких объектов
+    Python на сообщение остается только его текст в общем буфере.
+    Вытесненные тексты удаляются из начала буфера, когда их объем превышает
+    объем живых, поэтому добавление остается O(1) в среднем.
+
+    Интерфейс совпадает с MessageRing. Все обращения - из потока-владельца комнаты.
+    """
+    def __init__(self, capacity: int, records=()):
+        self.capacity = capacity
+        self.created = array.array('d')
+        self.seqs = array.array('Q')
+        self.senders = array.array('i')
+        self.offsets = array.array('Q')  # Смещение текста от начала истории
+        self.lengths = array.array('I')
+        self.body = bytearray()
+        self.base = 0  # Смещение первого байта body
+        self.names: List[str] = []
+        self.name_ids: Dict[str, int] = {}
+        self.start = 0
+        self.size = 0
+        self.next_seq = 1
+        for record in records:
+            self.append(record)
+            
+    def sender_id(self, sender: Optional[str]) -> int:
+        if not sender:
+            return -1
+        sender_id = self.name_ids.get(sender)
+        if sender_id is None:
+            sender_id = self.name_ids[sender] = len(self.names)
+            self.names.append(sys.intern(sender))
+        return sender_id
+            
+    def append(self, record: MessageRecord):
+        payload = record.text.encode('utf-8')
+        sender_id = self.sender_id(record.sender)
+        offset = self.base + len(self.body)
+        if self.size < self.capacity:
+            # Массивы растут, пока история не заполнена
+            self.created.append(record.created)
+            self.seqs.append(self.next_seq)
+            self.senders.append(sender_id)
+            self.offsets.append(offset)
+            self.lengths.append(len(payload))
+            self.size += 1
+        else:
+            slot = self.start
+            self.start = (self.start + 1) % self.capacity
+            self.created[slot] = record.created
+            self.seqs[slot] = self.next_seq
+            self.senders[slot] = sender_id
+            self.offsets[slot] = offset
+            self.lengths[slot] = len(payload)
+        self.next_seq += 1
+        self.body += payload
+        
+        # Удалить из буфера тексты вытесненных сообщений
+        dead = self.offsets[self.start] - self.base
+        if dead > len(self.body) - dead:
+            del self.body[:dead]
+            self.base += dead
+            
+    def slots(self, count: int):
+        count = min(count, self.size)
+        first = self.start + self.size - count
+        return [index % self.capacity for index in range(first, first + count)]
+            
+    def entries(self, count: int) -> List[Tuple[int, float, Optional[str], bytes]]:
+        """Последние count сообщений: (номер, время, отправитель, текст UTF-8).
+        Тексты копируются сразу: пока существует memoryview буфера, bytearray
+        нельзя изменить размер, и добавление упало бы с BufferError."""
+        entries = []
+        with memoryview(self.body) as body:
+            for slot in self.slots(count):
+                sender_id = self.senders[slot]
+                start = self.offsets[slot] - self.base
+                entries.append((self.seqs[slot], self.created[slot],
+                                self.names[sender_id] if sender_id >= 0 else None,
+                                bytes(body[start:start + self.lengths[slot]])))
+        return entries
+            
+    def last(self, count: int):
+        for _, created, sender, text in self.entries(count):
+            yield MessageRecord(str(text, 'utf-8'), sender, created=created)
+            
+    def lines(self, count: int) -> List[bytes]:
+        """Последние count сообщений, закодированные для отправки без повторного кодирования текста"""
+        lines = []
+        for _, created, sender, text in self.entries(count):
+            prefix = f"[{time.strftime('%H:%M:%S', time.localtime(created))}] "
+            if sender:
+                prefix += f"{sender}: "
+            lines.append(prefix.encode('utf-8') + text)
+        return lines
+    
+    def __iter__(self):
+        return self.last(self.size)
+    
+    def __len__(self) -> int:
+        return self.size
+
+HISTORY_STORES = {
+    'ring': MessageRing,
+    'columnar': ColumnarHistory,
+}
+
+def room_history(records=()):
+    """Хранилище последних сообщений комнаты выбранного в ROOM_HISTORY_STORE типа"""
+    return HISTORY_STORES[ROOM_HISTORY_STORE](ROOM_HISTORY_SIZE, records)
+
 class User:
     """Класс для представления пользователя с аутентификацией"""
     def __init__(self, username: str, password_hash: str, created_at: str = None, 
-                 last_login: str = None, message_history: List = None, 
+                 last_login: str = None, message_history: List[MessageRecord] = None, 
                  room_history: List = None, settings: Dict = None):
         self.username = username
         self.password_hash = password_hash
         self.created_at = created_at or datetime.datetime.now().isoformat()
         self.last_login = last_login
-        self.message_history = message_history or []
+        self.message_history = MessageRing(USER_HISTORY_SIZE, message_history or ())
         self.room_history = room_history or []
         self.settings = settings or {}
         self.is_online = False
         self.current_room = None
         
-    def check_password(self, password: str) -> bool:
-        """Проверить пароль пользователя"""
-        return self.password_hash == self.hash_password(password)
-    
-    @staticmethod
-    def hash_password(password: str) -> str:
-        """Хеширование пароля"""
-        return hashlib.sha256(password.encode('utf-8')).hexdigest()
-    
-    def add_message_to_history(self, room_id: str, message: str, timestamp: str = None):
-        """Добавить сообщение в историю пользователя"""
-        if timestamp is None:
-            timestamp = datetime.datetime.now().isoformat()
-        
-        self.message_history.append({
-            'room_id': room_id,
-            'message': message,
-            'timestamp': timestamp
-        })
-        
-        # Ограничить историю последними 1000 сообщениями
-        if len(self.message_history) > 1000:
-            self.message_history = self.message_history[-1000:]
+    def add_message_to_history(self, room_id: str, message: str, created: float = None):
+        """Добавить сообщение в историю пользователя (хранятся последние USER_HISTORY_SIZE)"""
+        self.message_history.append(MessageRecord(message, room_id=room_id, created=created))
     
     def add_room_to_history(self, room_id: str, room_name: str):
         """Добавить комнату в историю посещений"""
@@ -93,7 +1584,10 @@ class User:
             'password_hash': self.password_hash,
             'created_at': self.created_at,
             'last_login': self.last_login,
-            'message_history': self.message_history,
+            'message_history': [
+                {'room_id': entry.room_id, 'message': entry.text, 'timestamp': entry.date}
+                for entry in self.message_history
+            ],
             'room_history': self.room_history,
             'settings': self.settings
         }
@@ -106,111 +1600,1689 @@ class User:
             password_hash=data['password_hash'],
             created_at=data.get('created_at'),
             last_login=data.get('last_login'),
-            message_history=data.get('message_history', []),
+            message_history=[
+                MessageRecord(entry.get('message', ''), room_id=entry.get('room_id'),
+                              created=MessageRecord.parse_time(entry.get('timestamp')))
+                for entry in data.get('message_history', [])
+            ],
             room_history=data.get('room_history', []),
             settings=data.get('settings', {})
         )
 
+def row_bytes(row) -> int:
+    """Объем данных строки для метрик записи"""
+    return sum(len(str(value).encode('utf-8')) for value in row if value is not None)
+
+class WriteBehind:
+    """Отложенная запись изменений на диск.
+
+    Измененные записи помечаются грязными и записываются пачкой в одной
+    транзакции раз в interval секунд или сразу, как только их накопится
+    max_pending. Повторные изменения одной записи до сброса объединяются,
+    поэтому объем записи зависит от частоты изменений, а не от размера данных.
+    """
+    def __init__(self, name: str, write_batch, interval: float, max_pending: int):
+        self.name = name
+        self.write_batch = write_batch  # callable(dirty: Dict, appends: List) -> записано байт
+        self.interval = interval
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # Сбросы выполняются по одному
+        self.dirty: Dict = {}  # ключ -> последняя версия записи
+        self.appends: List = []  # строки, которые только добавляются
+        self.writing: Optional[Tuple[Dict, List]] = None  # пачка, которая записывается сейчас
+        self.oldest: Optional[float] = None  # time.monotonic() самого раннего несброшенного изменения
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.metrics = {'flushes': 0, 'records': 0, 'coalesced': 0, 'bytes': 0,
+                        'errors': 0, 'last_lag': 0.0, 'max_lag': 0.0}
+        threading.Thread(target=self.flush_worker, daemon=True).start()
+        
+    def mark(self, key, record):
+        """Пометить запись измененной; предыдущая несброшенная версия заменяется"""
+        with self.lock:
+            if key in self.dirty:
+                self.metrics['coalesced'] += 1
+            self.dirty[key] = record
+            self.note_change()
+            
+    def append(self, row):
+        with self.lock:
+            self.appends.append(row)
+            self.note_change()
+            
+    def note_change(self):
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if len(self.dirty) + len(self.appends) >= self.max_pending:
+            self.wakeup.set()
+            
+    def pending(self) -> int:
+        return len(self.dirty) + len(self.appends)
+        
+    def has_pending(self, key_matches, row_matches) -> bool:
+        """Есть ли несброшенные или записываемые сейчас изменения, подходящие
+        под key_matches(ключ) или row_matches(добавляемая строка)"""
+        with self.lock:
+            batches = [(self.dirty, self.appends)]
+            if self.writing:
+                batches.append(self.writing)
+            return any(any(map(key_matches, dirty)) or any(map(row_matches, appends))
+                       for dirty, appends in batches)
+        
+    def flush(self):
+        """Записать все накопленные изменения"""
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty and not self.appends:
+                    return
+                dirty, appends, oldest = self.dirty, self.appends, self.oldest
+                self.dirty, self.appends, self.oldest = {}, [], None
+                self.writing = (dirty, appends)
+            started = time.perf_counter()
+            try:
+                written = self.write_batch(dirty, appends)
+            except Exception:
+                # Вернуть пачку в очередь, более новые версии записей важнее
+                with self.lock:
+                    for key, record in dirty.items():
+                        self.dirty.setdefault(key, record)
+                    self.appends[:0] = appends
+                    self.oldest = min(oldest, self.oldest or oldest)
+                    self.writing = None
+                    self.metrics['errors'] += 1
+                raise
+            SAVE_DURATION.observe(time.perf_counter() - started)
+            lag = time.monotonic() - oldest
+            with self.lock:
+                self.writing = None
+                self.metrics['flushes'] += 1
+                self.metrics['records'] += len(dirty) + len(appends)
+                self.metrics['bytes'] += written
+                self.metrics['last_lag'] = lag
+                self.metrics['max_lag'] = max(self.metrics['max_lag'], lag)
+                
+    def flush_worker(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.getLogger('ChatServer').error("Ошибка записи (%s): %s", self.name, e)
+                
+    def close(self):
+        """Остановить фоновый сброс и записать остаток"""
+        self.stopped = True
+        self.wakeup.set()
+        self.flush()
+
+class SQLiteStore:
+    """База SQLite в режиме WAL с отложенной записью изменений.
+
+    Базу открывают все воркеры, записывает только основной (writable).
+    """
+    SCHEMA = ""
+    
+    def __init__(self, path: str, writable: bool = True):
+        self.path = path
+        self.writable = writable
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Транзакции открываются явно, поэтому автокоммит
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA + """
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self.writes: Optional[WriteBehind] = None
+        if writable:
+            self.writes = WriteBehind(os.path.basename(path), self.write_batch,
+                                      FLUSH_INTERVAL, FLUSH_MAX_PENDING)
+            
+    def write_batch(self, dirty: Dict, appends: List) -> int:
+        raise NotImplementedError
+        
+    def migrate_json(self, json_file: str) -> int:
+        """Однократно перенести данные из старого JSON файла, вернуть число записей.
+        
+        Выполняется в одной транзакции BEGIN IMMEDIATE: если воркеры стартуют
+        одновременно, перенос сделает первый, остальные увидят отметку в meta.
+        """
+        if not os.path.exists(json_file):
+            return 0
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                if self.db.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                    self.db.execute("ROLLBACK")
+                    return 0
+                with open(json_file, 'r', encoding='utf-8') as f:
+                    count = self.import_json(json.load(f))
+                self.db.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)",
+                                (datetime.datetime.now().isoformat(),))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        # Файл больше не используется, но остается как резервная копия
+        os.replace(json_file, f"{json_file}.migrated")
+        return count
+        
+    def import_json(self, data: Dict) -> int:
+        raise NotImplementedError
+        
+    def transaction(self, statements):
+        """Выполнить (sql, параметры) одной транзакцией"""
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    self.db.execute(sql, params)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+                
+    def flush(self):
+        if self.writes:
+            self.writes.flush()
+            
+    def backup(self, target_path: str):
+        """Скопировать базу в target_path. Копия читается отдельным соединением:
+        в режиме WAL запись в базу во время копирования не блокируется."""
+        source = sqlite3.connect(self.path, timeout=30)
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+            
+    def write_metrics(self) -> str:
+        """Строка с метриками отложенной записи для /stats"""
+        if not self.writes:
+            return "запись выполняет основной воркер"
+        metrics = self.writes.metrics
+        return (f"ожидают {self.writes.pending()}, записей {metrics['records']} "
+                f"(объединено {metrics['coalesced']}), {metrics['bytes']} байт за {metrics['flushes']} сбросов, "
+                f"задержка {metrics['last_lag']:.2f} с (макс. {metrics['max_lag']:.2f} с), ошибок {metrics['errors']}")
+            
+    def close(self):
+        if self.writes:
+            self.writes.close()
+        with self.lock:
+            self.db.close()
+
+class UserStore(SQLiteStore):
+    """Хранилище пользователей.
+
+    Изменения записываются построчно: вход, сообщение или посещение комнаты -
+    это одна строка в очередной пачке, а не перезапись всех пользователей.
+    В памяти держатся только пользователи с открытыми сессиями и USER_CACHE_SIZE
+    недавно отключившихся, остальные читаются из базы по имени при входе.
+    Для чтения поддерживает интерфейс словаря username -> User.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password_hash TEXT NOT NULL,
+            created_at TEXT,
+            last_login TEXT,
+            settings TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS user_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            room_id TEXT,
+            message TEXT,
+            timestamp TEXT
+        );
+        CREATE INDEX IF NOT EXISTS user_messages_by_user ON user_messages (username, id);
+        CREATE TABLE IF NOT EXISTS user_rooms (
+            username TEXT NOT NULL,
+            room_id TEXT NOT NULL,
+            room_name TEXT,
+            last_visit TEXT,
+            PRIMARY KEY (username, room_id)
+        );
+    """
+    MESSAGE_HISTORY_LIMIT = 1000
+    ROOM_HISTORY_LIMIT = 50
+    INSERT_USER = "INSERT OR REPLACE INTO users (username, password_hash, created_at, last_login, settings) VALUES (?, ?, ?, ?, ?)"
+    INSERT_MESSAGE = "INSERT INTO user_messages (username, room_id, message, timestamp) VALUES (?, ?, ?, ?)"
+    INSERT_ROOM = "INSERT OR REPLACE INTO user_rooms (username, room_id, room_name, last_visit) VALUES (?, ?, ?, ?)"
+    # Оставить в базе столько же истории, сколько в памяти
+    TRIM_MESSAGES = """DELETE FROM user_messages WHERE username = ? AND id <= (
+                          SELECT id FROM user_messages WHERE username = ?
+                          ORDER BY id DESC LIMIT 1 OFFSET ?)"""
+    TRIM_ROOMS = """DELETE FROM user_rooms WHERE username = ? AND room_id NOT IN (
+                       SELECT room_id FROM user_rooms WHERE username = ?
+                       ORDER BY last_visit DESC LIMIT ?)"""
+    
+    def __init__(self, path: str, writable: bool = True):
+        self.cache_lock = threading.Lock()
+        self.online: Dict[str, User] = {}  # Пользователи с открытыми сессиями, не вытесняются
+        self.pins: Dict[str, int] = {}  # Число открытых сессий пользователя
+        self.cache: collections.OrderedDict = collections.OrderedDict()  # Отключившиеся, от давних к недавним
+        self.count = 0
+        super().__init__(path, writable)
+        
+    def __contains__(self, username: str) -> bool:
+        if self.cached(username):
+            return True
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is not None
+        
+    def __getitem__(self, username: str) -> User:
+        user = self.get(username)
+        if user is None:
+            raise KeyError(username)
+        return user
+        
+    def __len__(self) -> int:
+        return self.count
+        
+    def cached(self, username: str) -> Optional[User]:
+        """Пользователь, если он уже в памяти (без обращения к базе)"""
+        with self.cache_lock:
+            user = self.online.get(username)
+            if user is None:
+                user = self.cache.get(username)
+                if user:
+                    self.cache.move_to_end(username)
+            return user
+        
+    def get(self, username: str, default=None) -> Optional[User]:
+        """Пользователь из памяти или, при промахе, из базы по первичному ключу"""
+        user = self.cached(username)
+        if user:
+            return user
+        # Сбросить изменения, только если среди несброшенных есть изменения этого
+        # пользователя: иначе каждый промах кэша был бы отдельной транзакцией
+        if self.writes and self.writes.has_pending(lambda key: key[1] == username,
+                                                   lambda row: row[0] == username):
+            self.flush()
+        user = self.fetch(username)
+        if user is None:
+            return default
+        with self.cache_lock:
+            # Другой поток мог загрузить его раньше
+            existing = self.online.get(username) or self.cache.get(username)
+            if existing:
+                return existing
+            self.remember(user)
+        return user
+        
+    def remember(self, user: User):
+        """Поместить отключенного пользователя в LRU (под cache_lock)"""
+        self.cache[user.username] = user
+        self.cache.move_to_end(user.username)
+        while len(self.cache) > USER_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        
+    def fetch(self, username: str) -> Optional[User]:
+        """Прочитать пользователя с историей из базы"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT password_hash, created_at, last_login, settings FROM users WHERE username = ?",
+                (username,)).fetchone()
+            if row is None:
+                return None
+            password_hash, created_at, last_login, settings = row
+            user = User(username, password_hash, created_at, last_login, settings=json.loads(settings))
+            user.message_history = MessageRing(USER_HISTORY_SIZE, (
+                MessageRecord(message, room_id=room_id, created=MessageRecord.parse_time(timestamp))
+                for room_id, message, timestamp in self.db.execute(
+                    "SELECT room_id, message, timestamp FROM user_messages WHERE username = ? ORDER BY id",
+                    (username,))
+            ))
+            user.room_history = [
+                {'room_id': room_id, 'room_name': room_name, 'last_visit': last_visit}
+                for room_id, room_name, last_visit in self.db.execute(
+                    "SELECT room_id, room_name, last_visit FROM user_rooms WHERE username = ? ORDER BY last_visit DESC",
+                    (username,))
+            ]
+        return user
+        
+    def acquire(self, username: str) -> User:
+        """Загрузить пользователя и закрепить в памяти на время сессии"""
+        user = self[username]
+        with self.cache_lock:
+            user = self.online.get(username) or self.cache.pop(username, None) or user
+            self.online[username] = user
+            self.pins[username] = self.pins.get(username, 0) + 1
+        user.is_online = True
+        return user
+        
+    def release(self, username: str):
+        """Сессия закрыта: после последней пользователь переходит в LRU"""
+        with self.cache_lock:
+            count = self.pins.get(username, 0) - 1
+            if count > 0:
+                self.pins[username] = count
+                return
+            self.pins.pop(username, None)
+            user = self.online.pop(username, None)
+            if user:
+                user.is_online = False
+                self.remember(user)
+        
+    @staticmethod
+    def user_row(user: User) -> tuple:
+        return (user.username, user.password_hash, user.created_at, user.last_login,
+                json.dumps(user.settings, ensure_ascii=False))
+        
+    def import_json(self, data: Dict) -> int:
+        users_data = data.get('users', {})
+        for user_data in users_data.values():
+            user = User.from_dict(user_data)
+            self.db.execute(self.INSERT_USER, self.user_row(user))
+            self.db.executemany(self.INSERT_MESSAGE, [
+                (user.username, entry.get('room_id'), entry.get('message'), entry.get('timestamp'))
+                for entry in user_data.get('message_history', [])[-self.MESSAGE_HISTORY_LIMIT:]
+            ])
+            self.db.executemany(self.INSERT_ROOM, [
+                (user.username, entry['room_id'], entry.get('room_name'), entry.get('last_visit'))
+                for entry in user.room_history[:self.ROOM_HISTORY_LIMIT]
+            ])
+        return len(users_data)
+        
+    def load(self):
+        """Подсчитать пользователей; сами записи загружаются по требованию"""
+        with self.lock:
+            self.count = self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            
+    def add(self, user: User):
+        """Добавить нового пользователя"""
+        with self.cache_lock:
+            self.remember(user)
+            self.count += 1
+        if self.writes:
+            self.writes.mark(('user', user.username), user)
+                
+    def save_login(self, user: User):
+        """Сохранить время входа и (возможно обновленный) хеш пароля"""
+        if self.writes:
+            self.writes.mark(('user', user.username), user)
+                
+    def record_message(self, username: str, room_id: str, message: str):
+        """Добавить сообщение в историю пользователя; не загруженного пользователя не загружает"""
+        created = time.time()
+        timestamp = datetime.datetime.fromtimestamp(created).isoformat()
+        user = self.cached(username)
+        if user:
+            user.add_message_to_history(room_id, message, created)
+        if self.writes:
+            self.writes.append((username, room_id, message, timestamp))
+            
+    def record_room_visit(self, username: str, room_id: str, room_name: str):
+        """Добавить комнату в историю посещений пользователя"""
+        user = self.cached(username)
+        if user:
+            user.add_room_to_history(room_id, room_name)
+        if self.writes:
+            self.writes.mark(('visit', username, room_id), (room_name, datetime.datetime.now().isoformat()))
+            
+    def write_batch(self, dirty: Dict, appends: List) -> int:
+        statements = []
+        trim_messages = set()
+        trim_rooms = set()
+        for key, record in dirty.items():
+            if key[0] == 'user':
+                statements.append((self.INSERT_USER, self.user_row(record)))
+            else:
+                _, username, room_id = key
+                statements.append((self.INSERT_ROOM, (username, room_id) + record))
+                trim_rooms.add(username)
+        for row in appends:
+            statements.append((self.INSERT_MESSAGE, row))
+            trim_messages.add(row[0])
+        written = sum(row_bytes(params) for _, params in statements)
+        statements.extend((self.TRIM_MESSAGES, (username, username, self.MESSAGE_HISTORY_LIMIT)) for username in trim_messages)
+        statements.extend((self.TRIM_ROOMS, (username, username, self.ROOM_HISTORY_LIMIT)) for username in trim_rooms)
+        self.transaction(statements)
+        return written
+
+class RoomStore(SQLiteStore):
+    """Хранилище комнат: одна строка на комнату.
+
+    Комната помечается измененной при новом сообщении, смене пароля или
+    создании и записывается при очередном сбросе, сколько бы сообщений в ней
+    ни появилось за интервал.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rooms (
+            room_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            admin TEXT NOT NULL,
+            password TEXT,
+            created_at TEXT,
+            last_activity TEXT,
+            messages TEXT NOT NULL DEFAULT '[]'
+        );
+    """
+    INSERT_ROOM = "INSERT OR REPLACE INTO rooms (room_id, name, admin, password, created_at, last_activity, messages) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    
+    @staticmethod
+    def room_row(data: Dict) -> tuple:
+        return (data['room_id'], data['name'], data['admin'], data.get('password'),
+                data.get('created_at'), data.get('last_activity'),
+                json.dumps(data.get('messages', []), ensure_ascii=False))
+    
+    def import_json(self, data: Dict) -> int:
+        rooms = data.get('rooms', [])
+        self.db.executemany(self.INSERT_ROOM, [self.room_row(room_data) for room_data in rooms])
+        return len(rooms)
+        
+    def load_stubs(self) -> List[Dict]:
+        """Все сохраненные комнаты без истории сообщений"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT room_id, name, admin, password, created_at, last_activity FROM rooms").fetchall()
+        return [
+            {'room_id': room_id, 'name': name, 'admin': admin, 'password': password,
+             'created_at': created_at, 'last_activity': last_activity}
+            for room_id, name, admin, password, created_at, last_activity in rows
+        ]
+        
+    def load_messages(self, room_id: str) -> List[dict]:
+        """Сохраненные последние сообщения комнаты"""
+        with self.lock:
+            row = self.db.execute("SELECT messages FROM rooms WHERE room_id = ?", (room_id,)).fetchone()
+        return json.loads(row[0]) if row else []
+        
+    def mark(self, room: 'ChatRoom', row: Dict = None):
+        """row - готовый снимок комнаты (to_dict); без него снимок делается при сбросе"""
+        if self.writes:
+            self.writes.mark(room.room_id, room if row is None else row)
+            
+    def delete(self, room_id: str):
+        """Удалить комнату; заменяет несброшенные изменения той же комнаты"""
+        if self.writes:
+            self.writes.mark(room_id, None)
+            
+    def write_batch(self, dirty: Dict, appends: List) -> int:
+        # Снимок комнаты делается при сбросе, а не при каждом изменении
+        statements = [
+            (self.INSERT_ROOM, self.room_row(room if isinstance(room, dict) else room.to_dict())) if room
+            else ("DELETE FROM rooms WHERE room_id = ?", (room_id,))
+            for room_id, room in dirty.items()
+        ]
+        self.transaction(statements)
+        return sum(row_bytes(params) for _, params in statements)
+
+class RoomLog:
+    """Журнал сообщений одной комнаты: только добавление, разбит на сегменты.
+
+    Сегмент <первый seq>.log состоит из записей [длина uint32, seq uint64,
+    время double] + JSON сообщения. Рядом лежит разреженный индекс
+    <первый seq>.idx: запись (seq, время, смещение) для первого сообщения
+    сегмента и далее через каждые MESSAGE_INDEX_INTERVAL сообщений. Чтение
+    идет через mmap: бинарный поиск по индексу и короткий просмотр от
+    найденного смещения, поэтому страница истории читается за O(размер
+    страницы) при любой длине журнала.
+    """
+    RECORD = struct.Struct('!IQd')
+    INDEX = struct.Struct('!QdQ')
+    
+    def __init__(self, directory: str, writable: bool, owner: 'MessageLog' = None):
+        self.directory = directory
+        self.writable = writable
+        self.owner = owner
+        self.lock = threading.Lock()
+        self.opened = False
+        self.segments: List[int] = []  # первые seq сегментов по возрастанию
+        self.segment_times: Dict[int, float] = {}  # первый seq сегмента: время его первого сообщения
+        self.next_seq = 1
+        self.log_file = None
+        self.index_file = None
+        self.segment_size = 0
+        self.since_index = 0
+        self.removed = False  # Комната удалена: запись больше не принимается
+        self.search = RoomSearchIndex(self)
+        
+    def segment_path(self, first_seq: int, suffix: str) -> str:
+        return os.path.join(self.directory, f"{first_seq:016d}{suffix}")
+        
+    def list_segments(self) -> List[int]:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-4]) for name in names if name.endswith('.log'))
+        
+    def open(self):
+        """Найти конец журнала; у записывающего процесса - отрезать недописанную запись"""
+        if self.opened and self.writable:
+            return
+        self.segments = self.list_segments()
+        self.next_seq = 1
+        if self.segments:
+            first_seq = self.segments[-1]
+            end_offset, last_seq = self.scan_tail(first_seq)
+            self.next_seq = (last_seq or first_seq - 1) + 1
+            if self.writable:
+                self.open_segment(first_seq, end_offset)
+        self.opened = True
+        
+    def scan_tail(self, first_seq: int) -> Tuple[int, Optional[int]]:
+        """Смещение конца последней целой записи сегмента и ее seq"""
+        entries = self.read_index(first_seq)
+        offset = entries[-1][2] if entries else 0
+        last_seq = None
+        with open(self.segment_path(first_seq, '.log'), 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        position = 0
+        while position + self.RECORD.size <= len(data):
+            length, seq, _ = self.RECORD.unpack_from(data, position)
+            if position + self.RECORD.size + length > len(data):
+                break
+            last_seq = seq
+            position += self.RECORD.size + length
+        return offset + position, last_seq
+        
+    def open_segment(self, first_seq: int, size: int = 0):
+        """Открыть сегмент для дописывания"""
+        os.makedirs(self.directory, exist_ok=True)
+        if self.log_file:
+            self.log_file.close()
+            self.index_file.close()
+        self.log_file = open(self.segment_path(first_seq, '.log'), 'ab', buffering=0)
+        self.log_file.truncate(size)
+        self.index_file = open(self.segment_path(first_seq, '.idx'), 'ab', buffering=0)
+        # Убрать записи индекса, указывающие на отрезанный хвост
+        entries = [entry for entry in self.read_index(first_seq) if entry[2] < size]
+        self.index_file.truncate(len(entries) * self.INDEX.size)
+        self.segment_size = size
+        self.since_index = self.next_seq - entries[-1][0] if entries else MESSAGE_INDEX_INTERVAL
+        if first_seq not in self.segments:
+            self.segments.append(first_seq)
+            
+    def read_index(self, first_seq: int, count: int = -1) -> List[Tuple[int, float, int]]:
+        """Записи индекса сегмента (первые count или все)"""
+        try:
+            with open(self.segment_path(first_seq, '.idx'), 'rb') as f:
+                data = f.read(count * self.INDEX.size if count > 0 else -1)
+        except FileNotFoundError:
+            return []
+        count = len(data) // self.INDEX.size
+        return [self.INDEX.unpack_from(data, i * self.INDEX.size) for i in range(count)]
+        
+    def append(self, record: dict, timestamp: float = None) -> int:
+        """Дописать сообщение, вернуть его номер"""
+        if not self.writable:
+            return 0
+        if timestamp is None:
+            timestamp = MessageRecord.parse_time(record.get('date'))
+        payload = json.dumps(record, ensure_ascii=False).encode('utf-8')
+        with self.lock:
+            if self.removed:
+                # Запоздалое сообщение удаленной комнаты не должно создать каталог заново
+                return 0
+            self.open()
+            seq = self.next_seq
+            if not self.log_file or self.segment_size >= MESSAGE_SEGMENT_BYTES:
+                self.open_segment(seq)
+            if self.since_index >= MESSAGE_INDEX_INTERVAL:
+                self.index_file.write(self.INDEX.pack(seq, timestamp, self.segment_size))
+                self.since_index = 0
+                if not self.segment_size:
+                    self.segment_times[seq] = timestamp
+            self.log_file.write(self.RECORD.pack(len(payload), seq, timestamp) + payload)
+            self.segment_size += self.RECORD.size + len(payload)
+            self.since_index += 1
+            self.next_seq = seq + 1
+        if self.owner:
+            self.owner.touch(self)
+        return seq
+            
+    def snapshot(self) -> Tuple[List[int], int]:
+        """Список сегментов и номер следующего сообщения"""
+        with self.lock:
+            self.open()
+            return list(self.segments), self.next_seq
+            
+    def last_seq(self) -> int:
+        return self.snapshot()[1] - 1
+        
+    def index_offset(self, first_seq: int, value, key: int = 0) -> int:
+        """Смещение последней записи индекса, у которой seq (key=0) или время (key=1) не больше value"""
+        try:
+            f = open(self.segment_path(first_seq, '.idx'), 'rb')
+        except FileNotFoundError:
+            return 0
+        with f:
+            count = os.fstat(f.fileno()).st_size // self.INDEX.size
+            if not count:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+                low, high = 0, count
+                while low < high:
+                    middle = (low + high) // 2
+                    if self.INDEX.unpack_from(index, middle * self.INDEX.size)[key] <= value:
+                        low = middle + 1
+                    else:
+                        high = middle
+                if low == 0:
+                    return 0
+                return self.INDEX.unpack_from(index, (low - 1) * self.INDEX.size)[2]
+                
+    def iter_segment(self, first_seq: int, offset: int):
+        """Записи сегмента начиная с offset: (seq, время, JSON сообщения)"""
+        with open(self.segment_path(first_seq, '.log'), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log:
+                position = offset
+                while position + self.RECORD.size <= size:
+                    length, seq, timestamp = self.RECORD.unpack_from(log, position)
+                    end = position + self.RECORD.size + length
+                    if end > size:
+                        break
+                    yield seq, timestamp, log[position + self.RECORD.size:end]
+                    position = end
+        
+    def iter_range(self, start_seq: int, end_seq: int):
+        """Записи с номерами [start_seq, end_seq): (seq, JSON сообщения)"""
+        segments, next_seq = self.snapshot()
+        end_seq = min(end_seq, next_seq)
+        position = max(0, bisect.bisect_right(segments, start_seq) - 1)
+        for first_seq in segments[position:]:
+            if first_seq >= end_seq:
+                break
+            offset = self.index_offset(first_seq, start_seq) if start_seq > first_seq else 0
+            for seq, _, payload in self.iter_segment(first_seq, offset):
+                if seq >= end_seq:
+                    return
+                if seq >= start_seq:
+                    yield seq, payload
+        
+    def read(self, start_seq: int, end_seq: int) -> List[dict]:
+        """Сообщения с номерами [start_seq, end_seq)"""
+        return [json.loads(payload) for _, payload in self.iter_range(start_seq, end_seq)]
+        
+    def read_seqs(self, seqs) -> Dict[int, dict]:
+        """Сообщения с указанными номерами по одному снимку журнала: каждый
+        сегмент и его индекс открываются один раз на все номера"""
+        segments, next_seq = self.snapshot()
+        wanted = sorted(seq for seq in set(seqs) if 0 < seq < next_seq)
+        records = {}
+        position = 0
+        while position < len(wanted):
+            index = max(0, bisect.bisect_right(segments, wanted[position]) - 1)
+            end_seq = segments[index + 1] if index + 1 < len(segments) else next_seq
+            group_end = max(position + 1, bisect.bisect_left(wanted, end_seq, position))
+            group = wanted[position:group_end]
+            position = group_end
+            entries = self.read_index(segments[index])
+            index_seqs = [entry[0] for entry in entries]
+            with open(self.segment_path(segments[index], '.log'), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if not size:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log:
+                    for seq in group:
+                        entry = bisect.bisect_right(index_seqs, seq) - 1
+                        offset = entries[entry][2] if entry >= 0 else 0
+                        while offset + self.RECORD.size <= size:
+                            length, found, _ = self.RECORD.unpack_from(log, offset)
+                            end = offset + self.RECORD.size + length
+                            if end > size or found > seq:
+                                break
+                            if found == seq:
+                                records[seq] = json.loads(log[offset + self.RECORD.size:end])
+                                break
+                            offset = end
+        return records
+        
+    def page_before(self, end_seq: int, count: int) -> Tuple[List[dict], int]:
+        """count сообщений перед end_seq и номер первого из них"""
+        start_seq = max(1, end_seq - count)
+        return self.read(start_seq, end_seq), start_seq
+        
+    def segment_time(self, first_seq: int, complete: bool) -> float:
+        """Время первого сообщения сегмента из первой записи его индекса.
+        Для завершенных сегментов оно не меняется и читается с диска один раз;
+        у последнего сегмента первая запись может быть отрезана при открытии"""
+        at = self.segment_times.get(first_seq)
+        if at is None:
+            entries = self.read_index(first_seq, 1)
+            at = entries[0][1] if entries else float('-inf')
+            if complete:
+                self.segment_times[first_seq] = at
+        return at
+        
+    def seq_at_time(self, timestamp: float) -> int:
+        """Номер первого сообщения не раньше timestamp"""
+        segments, next_seq = self.snapshot()
+        # Последний сегмент, начавшийся не позже timestamp: бисекция по времени начала сегментов
+        low, high = 1, len(segments)
+        while low < high:
+            middle = (low + high) // 2
+            if self.segment_time(segments[middle], middle < len(segments) - 1) > timestamp:
+                high = middle
+            else:
+                low = middle + 1
+        for first_seq in segments[max(0, low - 1):]:
+            offset = self.index_offset(first_seq, timestamp, key=1)
+            for seq, at, _ in self.iter_segment(first_seq, offset):
+                if at >= timestamp:
+                    return seq
+        return next_seq
+            
+    def close(self):
+        """Закрыть файлы; следующая запись откроет журнал заново"""
+        with self.lock:
+            if self.log_file:
+                self.log_file.close()
+                self.index_file.close()
+                self.log_file = None
+                self.index_file = None
+            self.opened = False
+
+WORD_PATTERN = re.compile(r'\w+')
+SENDER_TERM = '\x01'  # Префикс терминов-отправителей в поисковом индексе, в словах не встречается
+
+def tokenize(text: str) -> List[str]:
+    """Слова текста для поиска: нормализация NFKC, без учета регистра, ё = е"""
+    text = unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+    return WORD_PATTERN.findall(text)
+
+def message_body(record: dict) -> str:
+    """Текст сообщения без префикса "отправитель: " """
+    text = record.get('message', '')
+    sender = record.get('sender')
+    if sender and text.startswith(sender + ': '):
+        return text[len(sender) + 2:]
+    return text
+
+def contains_phrase(words: List[str], phrase: List[str]) -> bool:
+    size = len(phrase)
+    return any(words[i:i + size] == phrase for i in range(len(words) - size + 1))
+
+def intersect_newest(lists: List[array.array], before: int):
+    """Номера, которые есть во всех отсортированных списках, от больших к
+    меньшим и только меньше before: проход по самому короткому списку с
+    бинарным поиском в остальных"""
+    if not lists or not all(lists):
+        return
+    smallest, *others = sorted(lists, key=len)
+    for position in range(bisect.bisect_left(smallest, before) - 1, -1, -1):
+        seq = smallest[position]
+        for other in others:
+            found = bisect.bisect_left(other, seq)
+            if found == len(other) or other[found] != seq:
+                break
+        else:
+            yield seq
+
+class SearchSegment:
+    """Неизменяемый сегмент поискового индекса <первый seq>-<последний seq>.sidx.
+
+    Заголовок, таблица терминов (смещение и длина термина, смещение и длина
+    его списка), термины в UTF-8 по возрастанию байтов и списки номеров
+    сообщений - uint32 от первого seq сегмента по возрастанию. Термин ищется
+    бинарным поиском по таблице через mmap, с диска читается только список
+    найденного термина.
+    """
+    HEADER = struct.Struct('<4sQQII')  # метка, первый и последний seq, число терминов, байт терминов
+    ENTRY = struct.Struct('<IHII')
+    MAGIC = b'CSI1'
+    
+    def __init__(self, path: str, first_seq: int, last_seq: int):
+        self.path = path
+        self.first_seq = first_seq
+        self.last_seq = last_seq
+        
+    @classmethod
+    def write(cls, path: str, first_seq: int, last_seq: int, postings: Dict[str, array.array]) -> 'SearchSegment':
+        table = bytearray()
+        terms = bytearray()
+        lists = array.array('I')
+        for term, seqs in sorted((term.encode('utf-8'), seqs) for term, seqs in postings.items()):
+            table += cls.ENTRY.pack(len(terms), len(term), len(lists), len(seqs))
+            terms += term
+            lists.extend(seq - first_seq for seq in seqs)
+        if sys.byteorder == 'big':
+            lists.byteswap()
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, first_seq, last_seq, len(postings), len(terms)))
+            f.write(table)
+            f.write(terms)
+            f.write(lists.tobytes())
+        os.replace(temp_path, path)
+        return cls(path, first_seq, last_seq)
+        
+    def postings(self, keys: List[Tuple[str, bool]]) -> List[array.array]:
+        """Списки номеров сообщений (от first_seq) для ключей (термин, это префикс)"""
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            _, _, _, count, terms_size = self.HEADER.unpack_from(data)
+            terms_start = self.HEADER.size + count * self.ENTRY.size
+            lists_start = terms_start + terms_size
+            
+            def entry(index: int):
+                term_offset, length, list_offset, list_length = self.ENTRY.unpack_from(
+                    data, self.HEADER.size + index * self.ENTRY.size)
+                return data[terms_start + term_offset:terms_start + term_offset + length], list_offset, list_length
+            
+            result = []
+            for term, prefix in keys:
+                key = term.encode('utf-8')
+                low, high = 0, count
+                while low < high:
+                    middle = (low + high) // 2
+                    if entry(middle)[0] < key:
+                        low = middle + 1
+                    else:
+                        high = middle
+                seqs = array.array('I')
+                matched = 0
+                while low < count:
+                    found, list_offset, list_length = entry(low)
+                    if found != key and not (prefix and found.startswith(key)):
+                        break
+                    seqs.frombytes(data[lists_start + list_offset * 4:lists_start + (list_offset + list_length) * 4])
+                    matched += 1
+                    low += 1
+                if sys.byteorder == 'big':
+                    seqs.byteswap()
+                if matched > 1:
+                    seqs = array.array('I', sorted(set(seqs)))
+                result.append(seqs)
+        return result
+
+class RoomSearchIndex:
+    """Инвертированный индекс журнала комнаты для /search.
+
+    Термины - слова сообщения (tokenize) и отправитель. Новые сообщения
+    дочитываются из журнала в списки в памяти (catch_up), которые при
+    SEARCH_SEGMENT_MESSAGES сообщениях записываются неизменяемым сегментом
+    рядом с сегментами журнала. Сегменты пишет только процесс, который пишет
+    журнал; остальные воркеры читают его сегменты и держат в памяти только
+    непроиндексированный хвост. Поиск идет от новых сообщений к старым и
+    останавливается, набрав нужное число совпадений.
+    """
+    
+    def __init__(self, log: 'RoomLog'):
+        self.log = log
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.segments: List[SearchSegment] = []
+        self.reset_pending(0)
+        
+    def reset_pending(self, indexed_seq: int):
+        self.pending: Dict[str, array.array] = {}
+        self.pending_first = indexed_seq + 1
+        self.indexed_seq = indexed_seq
+        
+    def refresh(self):
+        """Перечитать список сегментов; сегменты, записанные другим процессом,
+        заменяют проиндексированное в памяти"""
+        segments = []
+        try:
+            names = os.listdir(self.log.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if name.endswith('.sidx'):
+                first_seq, last_seq = map(int, name[:-5].split('-'))
+                segments.append(SearchSegment(os.path.join(self.log.directory, name), first_seq, last_seq))
+        segments.sort(key=lambda segment: segment.first_seq)
+        self.segments = segments
+        if segments and segments[-1].last_seq >= self.pending_first:
+            self.reset_pending(max(segments[-1].last_seq, 0))
+        self.loaded = True
+        
+    def add(self, seq: int, record: dict):
+        terms = set(tokenize(message_body(record)))
+        sender = record.get('sender')
+        if sender:
+            terms.add(SENDER_TERM + sender.casefold())
+        for term in terms:
+            seqs = self.pending.get(term)
+            if seqs is None:
+                seqs = self.pending[term] = array.array('Q')
+            seqs.append(seq)
+        self.indexed_seq = seq
+        
+    def catch_up(self):
+        """Проиндексировать сообщения журнала, которых еще нет в индексе"""
+        with self.lock:
+            if self.log.removed:
+                return
+            if not self.loaded or not self.log.writable:
+                self.refresh()
+            next_seq = self.log.snapshot()[1]
+            while self.indexed_seq + 1 < next_seq:
+                # Пишущий процесс дочитывает до границы сегмента; читающий сегменты не пишет,
+                # и его pending_first не двигается - шаг считается от проиндексированного
+                start_seq = self.pending_first if self.log.writable else self.indexed_seq + 1
+                end_seq = min(next_seq, start_seq + SEARCH_SEGMENT_MESSAGES)
+                for seq, payload in self.log.iter_range(self.indexed_seq + 1, end_seq):
+                    self.add(seq, json.loads(payload))
+                self.indexed_seq = end_seq - 1
+                if self.log.writable and end_seq - self.pending_first >= SEARCH_SEGMENT_MESSAGES:
+                    self.flush()
+                    
+    def flush(self):
+        """Записать проиндексированное в памяти новым сегментом"""
+        path = os.path.join(self.log.directory, f"{self.pending_first:016d}-{self.indexed_seq:016d}.sidx")
+        self.segments.append(SearchSegment.write(path, self.pending_first, self.indexed_seq, self.pending))
+        self.reset_pending(self.indexed_seq)
+        
+    def pending_postings(self, term: str, prefix: bool) -> array.array:
+        if not prefix:
+            return array.array('Q', self.pending.get(term, ()))
+        seqs = set()
+        for key, values in self.pending.items():
+            if key.startswith(term):
+                seqs.update(values)
+        return array.array('Q', sorted(seqs))
+        
+    def candidates(self, keys: List[Tuple[str, bool]], before: int = None):
+        """Номера сообщений, содержащих все ключи (термин, это префикс), от
+        новых к старым; before - только более старые, чем это сообщение"""
+        self.catch_up()
+        before = before or sys.maxsize
+        with self.lock:
+            pending = [self.pending_postings(term, prefix) for term, prefix in keys]
+            segments = list(self.segments)
+        yield from intersect_newest(pending, before)
+        for segment in reversed(segments):
+            if segment.first_seq < before:
+                for seq in intersect_newest(segment.postings(keys), before - segment.first_seq):
+                    yield segment.first_seq + seq
+                
+    @staticmethod
+    def parse_query(query: str) -> Tuple[List[Tuple[str, bool]], List[List[str]]]:
+        """Ключи индекса и фразы запроса: слова, "фраза", префикс*, from:имя (или @имя)"""
+        keys = []
+        phrases = []
+        for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+            if word.startswith(('from:', '@')):
+                sender = word.split(':', 1)[1] if word.startswith('from:') else word[1:]
+                if sender:
+                    keys.append((SENDER_TERM + sender.casefold(), False))
+                continue
+            words = tokenize(phrase or word)
+            if not phrase and len(words) == 1 and word.endswith('*') and len(words[0]) >= 2:
+                keys.append((words[0], True))
+                continue
+            keys.extend((term, False) for term in words)
+            if len(words) > 1:
+                phrases.append(words)
+        return keys, phrases
+
+class MessageLog:
+    """Журналы сообщений всех комнат, по каталогу на комнату.
+
+    Открытыми для записи держатся только MAX_OPEN недавно писавших журналов,
+    остальные закрываются и открываются заново при следующем сообщении.
+    Журналы с новыми сообщениями запоминаются, и index_pending дописывает
+    их поисковые индексы в фоне.
+    """
+    MAX_OPEN = 256
+    
+    def __init__(self, directory: str, writable: bool):
+        self.directory = directory
+        self.writable = writable
+        self.lock = threading.Lock()
+        self.logs: Dict[str, RoomLog] = {}
+        self.open_logs: collections.OrderedDict = collections.OrderedDict()  # id -> журнал, от давних записей к недавним
+        self.unindexed: Dict[int, RoomLog] = {}  # журналы с сообщениями, которых еще нет в поисковом индексе
+        
+    def room(self, room_id: str) -> RoomLog:
+        with self.lock:
+            log = self.logs.get(room_id)
+            if log is None:
+                log = self.logs[room_id] = RoomLog(os.path.join(self.directory, room_id), self.writable, self)
+            return log
+            
+    def touch(self, log: RoomLog):
+        """Отметить запись в журнал; вызывается без блокировки журнала"""
+        with self.lock:
+            self.open_logs[id(log)] = log
+            self.open_logs.move_to_end(id(log))
+            self.unindexed[id(log)] = log
+            while len(self.open_logs) > self.MAX_OPEN:
+                _, oldest = self.open_logs.popitem(last=False)
+                oldest.close()
+                
+    def remove(self, room_id: str):
+        """Забыть журнал удаленной комнаты; пишущий процесс удаляет и его файлы
+        вместе с сегментами поискового индекса"""
+        with self.lock:
+            log = self.logs.pop(room_id, None)
+            if log:
+                self.open_logs.pop(id(log), None)
+                self.unindexed.pop(id(log), None)
+        if log:
+            # Дождаться дописывания индекса, если оно идет в фоне
+            with log.search.lock, log.lock:
+                log.removed = True
+            log.close()
+        if self.writable:
+            shutil.rmtree(os.path.join(self.directory, room_id), ignore_errors=True)
+            
+    def index_pending(self):
+        """Дописать поисковые индексы журналов, в которые писали с прошлого раза"""
+        with self.lock:
+            logs, self.unindexed = list(self.unindexed.values()), {}
+        for log in logs:
+            log.search.catch_up()
+            
+    def close(self):
+        with self.lock:
+            for log in self.logs.values():
+                log.close()
+            self.open_logs.clear()
+
+class ActorExecutor:
+    """Поток-владелец состояния закрепленных за ним комнат.
+
+    Действия выполняются строго по очереди в одном потоке, поэтому состояние
+    комнаты никогда не изменяется из нескольких потоков одновременно.
+    """
+    def __init__(self, name: str):
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+        
+    def in_own_thread(self) -> bool:
+        return threading.current_thread() is self.thread
+        
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+        
+    def run(self):
+        while True:
+            future, fn, args, kwargs = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+class RoomExecutors:
+    """Набор исполнителей комнат: комната закреплена за исполнителем по room_id"""
+    def __init__(self, count: int):
+        self.executors = [ActorExecutor(f"room-actor-{index}") for index in range(count)]
+        
+    def for_room(self, room_id: str) -> ActorExecutor:
+        return self.executors[zlib.crc32(room_id.encode('utf-8')) % len(self.executors)]
+
+def log_action_error(future: concurrent.futures.Future):
+    """Залогировать ошибку действия, результат которого никто не ждет"""
+    error = future.exception()
+    if error:
+        logging.getLogger('ChatServer').error("Ошибка действия комнаты: %s", error)
+
+def room_action(wait: bool = True):
+    """Выполнить метод комнаты в потоке-владельце комнаты.
+
+    Вызов из потока-владельца (или для комнаты без исполнителя, как в asyncio
+    режиме) выполняется сразу. Из других потоков действие ставится в очередь
+    исполнителя: wait=True дожидается результата, wait=False возвращает
+    управление сразу, сохраняя порядок действий.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            executor = self.executor
+            if executor is None or executor.in_own_thread():
+                return method(self, *args, **kwargs)
+            future = executor.submit(method, self, *args, **kwargs)
+            if wait:
+                return future.result()
+            future.add_done_callback(log_action_error)
+        return wrapper
+    return decorator
+
 class ChatRoom:
+    """Комната чата. Участники и история изменяются только в потоке-владельце
+    комнаты (executor), методы с @room_action безопасно вызывать из любого потока."""
     def __init__(self, room_id: str, name: str, admin: str, password: str = None):
         self.room_id = room_id
         self.name = name
         self.admin = admin
         self.password = password
         self.users: Dict[str, dict] = {}
-        self.messages: List[dict] = []
+        self.remote_users: Dict[str, int] = {}  # username: worker_id (участники в других процессах)
+        self.messages = room_history()
         self.created_at = datetime.datetime.now().isoformat()
         self.last_activity = datetime.datetime.now()
+        self.on_broadcast = None  # callback(room, record) для рассылки в другие процессы
+        self.on_change = None  # callback(room) при изменении сохраняемых данных
+        self.on_listing = None  # callback(room_id, участников или None, время активности) для каталога комнат
+        self.log: Optional[RoomLog] = None  # Полная история сообщений на диске
+        self.loader = None  # callback(room) -> сохраненные сообщения, пока они не загружены
+        self.fanout: Optional[FanoutPool] = None
+        self.shards: List[Dict[str, object]] = []  # Участники, распределенные по потокам рассылки
+        self.executor: Optional[ActorExecutor] = None
+        
+    @room_action()
+    def attach_fanout(self, pool: FanoutPool):
+        """Использовать пул потоков для рассылки, когда комната станет большой"""
+        self.fanout = pool
+        self.shards = [{} for _ in range(pool.size)]
+        for username, user_info in self.users.items():
+            self.shards[pool.shard_of(user_info['socket'])][username] = user_info['socket']
         
+    @room_action()
     def add_user(self, username: str, user_socket, address):
+        self.remove_user(username)
         self.users[username] = {
             'socket': user_socket, 
             'address': address,
             'joined_at': datetime.datetime.now().isoformat()
         }
+        if self.fanout:
+            self.shards[self.fanout.shard_of(user_socket)][username] = user_socket
         self.last_activity = datetime.datetime.now()
+        self.listing_changed()
         
+    @room_action()
     def remove_user(self, username: str):
         if username in self.users:
-            del self.users[username]
+            user_info = self.users.pop(username)
+            if self.fanout:
+                self.shards[self.fanout.shard_of(user_info['socket'])].pop(username, None)
             self.last_activity = datetime.datetime.now()
+            self.listing_changed()
             
-    def broadcast_message(self, message: str, sender: str = None):
-        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-        formatted_message = f"[{timestamp}] {message}"
-        
-        # Сохранить сообщение в истории
-        self.messages.append({
-            'timestamp': timestamp,
-            'sender': sender,
-            'message': message,
-            'date': datetime.datetime.now().isoformat()
-        })
+    def listing_changed(self):
+        """Сообщить каталогу комнат новое число участников"""
+        if self.on_listing:
+            members = len(self.users) + sum(1 for username in self.remote_users if username not in self.users)
+            self.on_listing(self.room_id, members, time.time())
+    
+    @room_action()
+    def member_names(self) -> List[str]:
+        """Все участники комнаты, включая подключенных к другим процессам"""
+        return list(self.users) + [u for u in self.remote_users if u not in self.users]
+    
+    @room_action()
+    def has_member(self, username: str) -> bool:
+        return username in self.users or username in self.remote_users
+    
+    @room_action()
+    def has_local_member(self, username: str) -> bool:
+        """Подключен ли участник к этому процессу"""
+        return username in self.users
+    
+    @room_action(wait=False)
+    def set_remote_member(self, username: str, worker_id: Optional[int]):
+        """Отметить участника из другого процесса (worker_id=None - покинул комнату)"""
+        if worker_id is None:
+            self.remote_users.pop(username, None)
+        else:
+            self.remote_users[username] = worker_id
+        self.listing_changed()
+    
+    def load_messages(self):
+        """Загрузить сохраненную историю при первом обращении к ней"""
+        if self.loader:
+            loader, self.loader = self.loader, None
+            messages = room_history(map(MessageRecord.from_dict, loader(self)))
+            for record in self.messages:
+                messages.append(record)
+            self.messages = messages
+    
+    @room_action()
+    def ensure_loaded(self):
+        self.load_messages()
+    
+    @room_action()
+    def recent_lines(self, count: int) -> List:
+        """Последние count сообщений истории, готовые к отправке (str или UTF-8)"""
+        self.load_messages()
+        return self.messages.lines(count)
+            
+    @room_action(wait=False)
+    def broadcast_message(self, message: str, sender: str = None, received: float = None):
+        """received - time.perf_counter() получения сообщения от клиента (для метрик)"""
+        record = self.record_message(message, sender)
+        self.deliver(f"[{record.timestamp}] {message}", received)
         
-        # Ограничить количество сохраняемых сообщений
-        if len(self.messages) > 1000:
-            self.messages = self.messages[-500:]  # Оставить последние 500
+        # Передать сообщение участникам в других процессах
+        if self.on_broadcast:
+            self.on_broadcast(self, record)
+    
+    def record_message(self, message: str, sender: str = None, created: float = None) -> MessageRecord:
+        """Сохранить сообщение в истории комнаты (в памяти последние ROOM_HISTORY_SIZE)"""
+        self.load_messages()
+        record = MessageRecord(message, sender, created=created)
+        self.messages.append(record)
+        if self.log:
+            self.log.append(record.to_dict(), record.created)
+        if self.on_change:
+            self.on_change(self)
+        if self.on_listing:
+            self.on_listing(self.room_id, None, record.created)
+        return record
+    
+    @room_action(wait=False)
+    def receive_remote(self, data: dict):
+        """Сохранить и разослать сообщение, пришедшее из другого процесса"""
+        record = self.record_message(data['message'], data.get('sender'), MessageRecord.parse_time(data.get('date')))
+        self.deliver(f"[{record.timestamp}] {record.text}")
+    
+    @room_action(wait=False)
+    def deliver(self, formatted_message: str, received: float = None):
+        """Отправить готовое сообщение всем локальным участникам комнаты"""
+        started = time.perf_counter()
+        if self.fanout and len(self.users) >= FANOUT_THRESHOLD:
+            # Большая комната: закодировать один раз и разделить рассылку между потоками пула
+            encoded = {
+                protocol: encode_message(formatted_message, protocol)
+                for protocol in (PROTOCOL_LEGACY, PROTOCOL_FRAMED)
+            }
+            self.fanout.submit([list(shard.values()) for shard in self.shards], encoded, received)
+            self.last_activity = datetime.datetime.now()
+            return
         
-        # Отправить всем пользователям в комнате
+        # Кодировать сообщение один раз для каждой версии протокола
+        encoded: Dict[int, bytes] = {}
         disconnected_users = []
         for username, user_info in self.users.items():
+            conn = user_info['socket']
             try:
-                user_info['socket'].send(formatted_message.encode('utf-8'))
+                data = encoded.get(conn.protocol)
+                if data is None:
+                    data = encoded[conn.protocol] = encode_message(formatted_message, conn.protocol)
+                conn.send(data, QUEUED_CHAT)
             except Exception as e:
-                logging.warning(f"Ошибка отправки сообщения пользователю {username}: {e}")
+                logging.getLogger('ChatServer').warning("Ошибка отправки сообщения пользователю %s: %s", username, e)
                 disconnected_users.append(username)
                 
+        finished = time.perf_counter()
+        FANOUT_DURATION.observe(finished - started)
+        if received is not None:
+            FANOUT_LATENCY.observe(finished - received)
+            
         # Удалить отключенных пользователей
         for username in disconnected_users:
             self.remove_user(username)
             
         self.last_activity = datetime.datetime.now()
             
+    @room_action()
     def to_dict(self):
+        self.load_messages()
         return {
             'room_id': self.room_id,
             'name': self.name,
             'admin': self.admin,
             'password': self.password,
-            'messages': self.messages[-100:],  # Сохранять только последние 100 сообщений
+            'messages': [record.to_dict() for record in self.messages.last(100)],  # Сохранять только последние 100 сообщений
             'created_at': self.created_at,
             'last_activity': self.last_activity.isoformat(),
             'user_count': len(self.users)
         }
 
+class DirectoryEntry:
+    """Комната в каталоге: только то, что показывает /list"""
+    __slots__ = ('room_id', 'name', 'key', 'admin', 'protected', 'members', 'activity')
+    
+    def __init__(self, room_id: str, name: str, admin: str, protected: bool, members: int, activity: float):
+        self.room_id = room_id
+        self.name = name
+        self.key = name.lower()
+        self.admin = admin
+        self.protected = protected
+        self.members = members
+        self.activity = activity
+
+class RoomDirectory:
+    """Каталог комнат для /list: отсортированные индексы вместо обхода всех комнат.
+
+    Индексы - отсортированные списки ключей по названию (без учета регистра),
+    по числу участников и по времени активности. Они обновляются при создании
+    и удалении комнат, входе и выходе участников и смене пароля. Время
+    активности от сообщений переносится в индекс не чаще раза в
+    ACTIVITY_RESOLUTION секунд на комнату. Страница без фильтра и страница с
+    фильтром по началу названия в порядке названий выбираются бисекцией за
+    O(log n + размер страницы); фильтр с другим порядком сортирует только
+    подходящие комнаты.
+    """
+    ORDERS = ('name', 'members', 'activity')
+    ACTIVITY_RESOLUTION = 60.0
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[str, DirectoryEntry] = {}
+        self.by_name: List[Tuple[str, str]] = []  # (название, room_id)
+        self.by_members: List[Tuple[int, str]] = []  # (-участников, room_id)
+        self.by_activity: List[Tuple[float, str]] = []  # (-время активности, room_id)
+        
+    @staticmethod
+    def entry_for(room: 'ChatRoom') -> DirectoryEntry:
+        return DirectoryEntry(room.room_id, room.name, room.admin, bool(room.password), 0,
+                              room.last_activity.timestamp())
+        
+    @staticmethod
+    def insert(index: List, key: tuple):
+        bisect.insort(index, key)
+        
+    @staticmethod
+    def discard(index: List, key: tuple):
+        position = bisect.bisect_left(index, key)
+        if position < len(index) and index[position] == key:
+            del index[position]
+            
+    def load(self, rooms):
+        """Построить каталог заново (при запуске) одной сортировкой"""
+        with self.lock:
+            self.entries = {room.room_id: self.entry_for(room) for room in rooms}
+            entries = self.entries.values()
+            self.by_name = sorted((entry.key, entry.room_id) for entry in entries)
+            self.by_members = sorted((-entry.members, entry.room_id) for entry in entries)
+            self.by_activity = sorted((-entry.activity, entry.room_id) for entry in entries)
+            
+    def add(self, room: 'ChatRoom'):
+        entry = self.entry_for(room)
+        with self.lock:
+            self.remove_locked(room.room_id)
+            self.entries[entry.room_id] = entry
+            self.insert(self.by_name, (entry.key, entry.room_id))
+            self.insert(self.by_members, (-entry.members, entry.room_id))
+            self.insert(self.by_activity, (-entry.activity, entry.room_id))
+            
+    def remove(self, room_id: str):
+        with self.lock:
+            self.remove_locked(room_id)
+            
+    def remove_locked(self, room_id: str):
+        entry = self.entries.pop(room_id, None)
+        if entry:
+            self.discard(self.by_name, (entry.key, room_id))
+            self.discard(self.by_members, (-entry.members, room_id))
+            self.discard(self.by_activity, (-entry.activity, room_id))
+            
+    def update(self, room_id: str, members: Optional[int], activity: float):
+        """Новое число участников (None - не изменилось) и время активности"""
+        with self.lock:
+            entry = self.entries.get(room_id)
+            if entry is None:
+                return
+            if members is not None and members != entry.members:
+                self.discard(self.by_members, (-entry.members, room_id))
+                entry.members = members
+                self.insert(self.by_members, (-members, room_id))
+            elif activity - entry.activity < self.ACTIVITY_RESOLUTION:
+                return
+            if activity > entry.activity:
+                self.discard(self.by_activity, (-entry.activity, room_id))
+                entry.activity = activity
+                self.insert(self.by_activity, (-activity, room_id))
+                
+    def set_protected(self, room_id: str, protected: bool):
+        with self.lock:
+            entry = self.entries.get(room_id)
+            if entry:
+                entry.protected = protected
+                
+    def page(self, number: int, size: int, prefix: str = '', order: str = 'name') -> Tuple[List[DirectoryEntry], int]:
+        """Страница number (с 1) комнат, название которых начинается с prefix,
+        и общее число таких комнат"""
+        start = (number - 1) * size
+        prefix = prefix.lower()
+        with self.lock:
+            if not prefix:
+                index = {'name': self.by_name, 'members': self.by_members, 'activity': self.by_activity}[order]
+                return [self.entries[room_id] for _, room_id in index[start:start + size]], len(index)
+            low = bisect.bisect_left(self.by_name, (prefix,))
+            high = bisect.bisect_left(self.by_name, (prefix + '\U0010ffff',))
+            if order == 'name':
+                keys = self.by_name[low + start:min(high, low + start + size)]
+                return [self.entries[room_id] for _, room_id in keys], high - low
+            matches = [self.entries[room_id] for _, room_id in self.by_name[low:high]]
+        if order == 'members':
+            sort_key = lambda entry: (-entry.members, entry.room_id)
+        else:
+            sort_key = lambda entry: (-entry.activity, entry.room_id)
+        return heapq.nsmallest(start + size, matches, key=sort_key)[start:], len(matches)
+
+class EventBus:
+    """Клиент локальной шины событий между процессами-воркерами.
+
+    События - JSON объекты, по одному на строку, передаются через Unix сокет
+    в EventBusHub, который пересылает их всем остальным воркерам.
+    """
+    def __init__(self, path: str, worker_id: int):
+        self.path = path
+        self.worker_id = worker_id
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.send_lock = threading.Lock()
+        self.handler = None
+        
+    def start(self, handler):
+        """Запустить поток чтения событий от других воркеров"""
+        self.handler = handler
+        threading.Thread(target=self.reader_worker, daemon=True).start()
+        
+    def publish(self, event: Dict):
+        """Отправить событие всем остальным воркерам"""
+        event['worker'] = self.worker_id
+        line = json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n'
+        try:
+            with self.send_lock:
+                self.sock.sendall(line)
+        except OSError as e:
+            logging.getLogger('ChatServer').error("Ошибка отправки события в шину: %s", e)
+            
+    def reader_worker(self):
+        """Читать события из шины и передавать их обработчику"""
+        for line in self.sock.makefile('rb'):
+            try:
+                self.handler(json.loads(line))
+            except Exception as e:
+                logging.getLogger('ChatServer').error("Ошибка обработки события шины: %s", e)
+                
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class EventBusHub:
+    """Концентратор шины событий в главном процессе.
+
+    Принимает подключения воркеров по Unix сокету и пересылает каждую
+    строку-событие всем воркерам, кроме отправителя.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(64)
+        self.connections: List[socket.socket] = []
+        self.lock = threading.Lock()
+        
+    def start(self):
+        threading.Thread(target=self.accept_worker, daemon=True).start()
+        
+    def accept_worker(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                break
+            with self.lock:
+                self.connections.append(conn)
+            threading.Thread(target=self.relay_worker, args=(conn,), daemon=True).start()
+            
+    def relay_worker(self, conn: socket.socket):
+        """Переслать события от одного воркера всем остальным"""
+        for line in conn.makefile('rb'):
+            with self.lock:
+                targets = [c for c in self.connections if c is not conn]
+            for target in targets:
+                try:
+                    target.sendall(line)
+                except OSError:
+                    pass
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+                
+    def close_listener(self):
+        """Закрыть слушающий сокет (в дочернем процессе после fork)"""
+        self.listener.close()
+        
+    def close(self):
+        self.close_listener()
+        with self.lock:
+            for conn in self.connections:
+                try:
+                    conn.close()
+                except OSError:
+                    pass
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке.
+
+    Стандартный prepare() собирает сообщение до постановки в очередь, чтобы
+    запись можно было передать в другой процесс. Здесь очередь внутри процесса,
+    поэтому запись передается как есть: сообщение из шаблона и аргументов
+    (строки, числа, адреса) собирается уже в потоке записи журнала.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class JSONLinesFormatter(logging.Formatter):
+    """Журнал действий в формате JSON lines: время, уровень, действие и поля записи"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'action': getattr(record, 'action', None),
+        }
+        if isinstance(record.args, dict):
+            entry.update(record.args)
+        else:
+            entry['message'] = record.getMessage()
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=str)
+
 class ChatServer:
-    def __init__(self, host=HOST, port=PORT):
+    def __init__(self, host=HOST, port=PORT, worker_id: int = 0, bus: Optional[EventBus] = None):
         self.host = host
         self.port = port
+        self.worker_id = worker_id
+        self.bus = bus
+        self.is_primary = worker_id == 0  # Только основной воркер записывает данные на диск
         self.rooms: Dict[str, ChatRoom] = {}
-        self.user_rooms: Dict[str, str] = {}
-        self.user_sockets: Dict[str, socket.socket] = {}
-        self.socket_users: Dict[socket.socket, str] = {}
-        self.data_file = DATA_FILE
-        self.users_file = "/opt/terminal-chat/data/users.json"  # Прямое определение для совместимости
-        self.users: Dict[str, User] = {}  # Словарь всех зарегистрированных пользователей
-        self.online_users: Dict[str, User] = {}  # Словарь онлайн пользователей
+        self.room_directory = RoomDirectory()  # Индексы для /list
+        self.sessions = ConnectionRegistry()  # Вошедшие пользователи и их подключения
+        self.data_file = DATA_FILE  # Старый формат, только для переноса в базу
+        self.room_store: Optional[RoomStore] = None
+        self.message_log = MessageLog(MESSAGE_LOG_DIR, writable=self.is_primary)
+        self.users_file = USERS_FILE  # Старый формат, только для переноса в базу
+        self.users: Optional[UserStore] = None  # Все зарегистрированные пользователи
         self.running = False
         self.server_socket = None
+        self.fanout_pool = self.create_fanout_pool()
+        self.room_executors = self.create_room_executors()
+        self.outbound_policy = OutboundPolicy(OUTBOUND_MAX_BYTES, OUTBOUND_MAX_FRAMES, SLOW_CONSUMER_POLICY)
+        self.admission = HandshakeAdmission(MAX_PENDING_HANDSHAKES, MAX_HANDSHAKES_PER_IP)
+        self.rate_limiter = RateLimiter({
+            'user': RATE_LIMIT_USER,
+            'ip': RATE_LIMIT_IP,
+            'room': RATE_LIMIT_ROOM,
+            'user_bytes': RATE_LIMIT_BYTES,
+            'ip_bytes': RATE_LIMIT_BYTES,
+        }, RATE_LIMIT_MAX_DELAY)
+        self.password_hasher = PasswordHasher(HASH_WORKERS, HASH_QUEUE_SIZE)
+        self.handshake_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.idle_wheel = TimingWheel(HEARTBEAT_TICK)  # Сроки бездействия подключений
+        self.heartbeat_counters = {'pings': 0, 'dead': 0, 'idle': 0}
+        self.scheduler: Optional[Scheduler] = None
+        self.metrics_server: Optional[http.server.ThreadingHTTPServer] = None
+        self.command_metrics = METRICS.register(CommandMetrics())
+        # Счетчики увеличивают все потоки обработчиков, поэтому они разделены между потоками
         self.stats = {
             'start_time': datetime.datetime.now(),
-            'total_connections': 0,
-            'active_connections': 0,
-            'messages_sent': 0,
-            'rooms_created': 0,
-            'registered_users': 0
+            'total_connections': METRICS.counter('chat_connections_total', 'Вошедших подключений'),
+            'messages_sent': METRICS.counter('chat_messages_total', 'Отправленных сообщений чата'),
+            'rooms_created': METRICS.counter('chat_rooms_created_total', 'Созданных комнат'),
         }
         
         self.setup_logging()
         self.setup_signal_handlers()
         self.load_data()
         self.load_users()
+        self.register_metrics()
         
-        # Запустить фоновые задачи
-        self.start_background_tasks()
+    def register_metrics(self):
+        """Показатели компонентов сервера, которые вычисляются при опросе метрик"""
+        METRICS.gauge('chat_active_connections', 'Вошедших подключений сейчас', lambda: len(self.sessions))
+        METRICS.gauge('chat_rooms', 'Комнат', lambda: len(self.rooms))
+        METRICS.gauge('chat_registered_users', 'Зарегистрированных пользователей', lambda: len(self.users))
+        METRICS.gauge('chat_pending_handshakes', 'Подключений на этапе аутентификации',
+                      lambda: self.admission.pending)
+        METRICS.gauge('chat_handshake_rejections_total', 'Отказы и таймауты на этапе аутентификации',
+                      lambda: dict(self.admission.counters), kind='counter', label='reason')
+        METRICS.gauge('chat_slow_consumer_total', 'Действия с медленными клиентами',
+                      lambda: dict(self.outbound_policy.counters), kind='counter', label='action')
+        METRICS.gauge('chat_throttled_total', 'Сообщения и команды, задержанные или отброшенные ограничением частоты',
+                      lambda: dict(self.rate_limiter.counters), kind='counter', label=('scope', 'action'))
+        METRICS.gauge('chat_idle_tracked', 'Подключений в колесе таймеров бездействия', lambda: len(self.idle_wheel))
+        METRICS.gauge('chat_heartbeat_total', 'Ping и отключения по бездействию',
+                      lambda: dict(self.heartbeat_counters), kind='counter', label='event')
+        METRICS.gauge('chat_write_pending', 'Изменений, ожидающих записи на диск',
+                      lambda: {store.path: store.writes.pending() for store in (self.room_store, self.users)
+                               if store.writes}, label='db')
+        METRICS.gauge('chat_job_runs_total', 'Запусков фоновых задач',
+                      lambda: self.scheduler.counts('runs') if self.scheduler else {}, kind='counter', label='job')
+        METRICS.gauge('chat_job_errors_total', 'Ошибок фоновых задач',
+                      lambda: self.scheduler.counts('errors') if self.scheduler else {}, kind='counter', label='job')
+        
+    def start_metrics_server(self):
+        """HTTP /metrics для Prometheus (каждый воркер на своем порту)"""
+        if not METRICS_PORT:
+            return
+        port = METRICS_PORT + self.worker_id
+        try:
+            self.metrics_server = http.server.ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+        except OSError as e:
+            self.logger.error("Не удалось открыть порт метрик %s:%s: %s", METRICS_HOST, port, e)
+            return
+        self.metrics_server.daemon_threads = True
+        threading.Thread(target=self.metrics_server.serve_forever, name='metrics', daemon=True).start()
+        self.logger.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, port)
+        
+    def create_fanout_pool(self) -> Optional[FanoutPool]:
+        """Пул параллельной рассылки для больших комнат"""
+        return FanoutPool(FANOUT_WORKERS) if FANOUT_WORKERS > 0 else None
+        
+    def create_room_executors(self) -> Optional[RoomExecutors]:
+        """Потоки-владельцы комнат"""
+        return RoomExecutors(max(1, ROOM_EXECUTORS))
         
     def setup_logging(self):
-        """Настроить систему логирования"""
+        """Настроить систему логирования.
+        
+        Потоки клиентов только ставят записи в очередь. Форматирование, запись в
+        файлы и их ротацию выполняют фоновые потоки QueueListener, поэтому
+        задержки диска не задерживают обработку сообщений.
+        """
         # Создать директорию для логов
         log_dir = Path(LOG_FILE).parent
         log_dir.mkdir(exist_ok=True)
@@ -232,12 +3304,11 @@ class ChatServer:
             encoding='utf-8'
         )
         file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
         
         # Консольный обработчик
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
+        self.log_listeners = [self.queue_handlers(self.logger, file_handler, console_handler)]
         
         # Отдельный логгер для действий пользователей
         self.action_logger = logging.getLogger('UserActions')
@@ -249,9 +3320,36 @@ class ChatServer:
             backupCount=3,
             encoding='utf-8'
         )
-        action_formatter = logging.Formatter('%(asctime)s - %(message)s')
+        if ACTION_LOG_FORMAT == 'json':
+            action_formatter = JSONLinesFormatter()
+        else:
+            action_formatter = logging.Formatter('%(asctime)s - %(action)s: %(message)s')
         action_handler.setFormatter(action_formatter)
-        self.action_logger.addHandler(action_handler)
+        self.log_listeners.append(self.queue_handlers(self.action_logger, action_handler))
+        # Дописать очереди и при выходе без shutdown (например, порт занят)
+        atexit.register(self.stop_logging)
+        
+    def queue_handlers(self, logger: logging.Logger, *handlers) -> logging.handlers.QueueListener:
+        """Направить записи логгера через очередь в обработчики фонового потока"""
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(DeferredQueueHandler(log_queue))
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        return listener
+        
+    def stop_logging(self):
+        """Записать оставшиеся в очередях записи и остановить потоки журналов"""
+        listeners, self.log_listeners = self.log_listeners, []
+        for listener in listeners:
+            listener.stop()
+        
+    def log_action(self, action: str, text: str, level: int = logging.INFO, **fields):
+        """Записать действие пользователя в журнал действий.
+        
+        text - шаблон с полями вида %(user)s. Строка собирается только в потоке
+        записи журнала, а в формате JSON lines записываются сами поля.
+        """
+        self.action_logger.log(level, text, fields, extra={'action': action})
         
     def setup_signal_handlers(self):
         """Настроить обработчики сигналов для graceful shutdown"""
@@ -260,236 +3358,218 @@ class ChatServer:
         
     def signal_handler(self, signum, frame):
         """Обработчик сигналов для корректного завершения"""
-        self.logger.info(f"Получен сигнал {signum}, завершение работы...")
+        self.logger.info("Получен сигнал %s, завершение работы...", signum)
         self.shutdown()
         
     def start_background_tasks(self):
-        """Запустить фоновые задачи"""
-        # Автосохранение данных
-        auto_save_thread = threading.Thread(
-            target=self.auto_save_worker,
-            daemon=True
-        )
-        auto_save_thread.start()
+        """Запустить фоновые задачи (после того как сервер начал работу)"""
+        self.start_metrics_server()
+        self.scheduler = Scheduler()
+        self.scheduler.every('heartbeat', HEARTBEAT_TICK, self.owner_job(self.tick_heartbeat), jitter=0)
+        self.scheduler.every('stats', STATS_INTERVAL, self.log_statistics)
+        if self.rate_limiter.limits:
+            self.scheduler.every('rate_limits', 60, self.rate_limiter.prune)
+        if not self.is_primary:
+            return
+        self.scheduler.every('autosave', AUTO_SAVE_INTERVAL, self.auto_save)
+        self.scheduler.every('search_index', SEARCH_INDEX_INTERVAL, self.message_log.index_pending)
+        if BACKUP_INTERVAL:
+            self.scheduler.every('backup', BACKUP_INTERVAL, self.backup_data)
+        if AUTO_DELETE_EMPTY_ROOMS:
+            self.scheduler.every('room_expiry', CLEANUP_INTERVAL, self.owner_job(self.expire_rooms))
+            
+    def owner_job(self, func):
+        """Задача, которая обращается к подключениям и комнатам (в asyncio режиме
+        выполняется в потоке event loop)"""
+        return func
         
-        # Очистка неактивных соединений
-        cleanup_thread = threading.Thread(
-            target=self.cleanup_worker,
-            daemon=True
-        )
-        cleanup_thread.start()
+    def auto_save(self):
+        self.save_data()
+        self.logger.debug("Автосохранение выполнено")
         
-        # Сбор статистики
-        stats_thread = threading.Thread(
-            target=self.stats_worker,
-            daemon=True
-        )
-        stats_thread.start()
+    def backup_data(self):
+        """Сохранить копии баз в BACKUP_DIR и удалить копии старше последних BACKUP_KEEP"""
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        for store in (self.room_store, self.users):
+            store.flush()
+            name = os.path.splitext(os.path.basename(store.path))[0]
+            store.backup(os.path.join(BACKUP_DIR, f"{name}-{stamp}.db"))
+            copies = sorted(path for path in os.listdir(BACKUP_DIR)
+                            if path.startswith(f"{name}-") and path.endswith('.db'))
+            for old in copies[:-BACKUP_KEEP]:
+                os.remove(os.path.join(BACKUP_DIR, old))
+        self.logger.info("Резервная копия баз сохранена в %s", BACKUP_DIR)
         
-    def auto_save_worker(self):
-        """Фоновое автосохранение данных"""
-        while self.running:
-            try:
-                time.sleep(AUTO_SAVE_INTERVAL)
-                if self.running:
-                    self.save_data()
-                    self.logger.debug("Автосохранение выполнено")
-            except Exception as e:
-                self.logger.error(f"Ошибка автосохранения: {e}")
-                
-    def cleanup_worker(self):
-        """Очистка отключенных соединений"""
-        while self.running:
-            try:
-                time.sleep(300)  # Каждые 5 минут
-                if self.running:
-                    self.cleanup_disconnected_users()
-            except Exception as e:
-                self.logger.error(f"Ошибка очистки: {e}")
+    def expire_rooms(self):
+        """Удалить комнаты без участников и без активности дольше EMPTY_ROOM_TTL"""
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=EMPTY_ROOM_TTL)
+        for room in list(self.rooms.values()):
+            if room.last_activity < cutoff and not room.member_names():
+                self.delete_room(room.room_id)
                 
-    def stats_worker(self):
-        """Сбор статистики"""
-        while self.running:
+    def delete_room(self, room_id: str):
+        room = self.rooms.pop(room_id, None)
+        if not room:
+            return
+        self.room_directory.remove(room_id)
+        self.room_store.delete(room_id)
+        self.message_log.remove(room_id)
+        self.publish({'type': 'room_deleted', 'room_id': room_id})
+        self.log_action('ROOM_DELETED', "комната '%(room_name)s' (ID: %(room_id)s) удалена как пустая",
+                        room_name=room.name, room_id=room_id)
+            
+    def tick_heartbeat(self):
+        """Один тик колеса: проверить только подключения с истекшим сроком"""
+        for conn in self.idle_wheel.advance(time.monotonic()):
             try:
-                time.sleep(60)  # Каждую минуту
-                if self.running:
-                    self.log_statistics()
+                self.check_idle(conn)
             except Exception as e:
-                self.logger.error(f"Ошибка сбора статистики: {e}")
-                
-    def cleanup_disconnected_users(self):
-        """Очистить отключенных пользователей"""
-        disconnected = []
-        for username, sock in self.user_sockets.items():
-            try:
-                # Попытаться отправить пустой пакет для проверки соединения
-                sock.send(b'')
-            except:
-                disconnected.append(username)
+                self.logger.error("Ошибка проверки соединения %s: %s", conn.address, e)
                 
-        for username in disconnected:
-            self.logger.info(f"Очистка отключенного пользователя: {username}")
-            self.cleanup_user(username)
+    def watch_idle(self, conn):
+        """Начать отслеживать бездействие вошедшего клиента"""
+        if conn.heartbeat:
+            self.idle_wheel.schedule(conn, conn.last_seen + PING_INTERVAL)
+        elif CLIENT_IDLE_TIMEOUT:
+            self.idle_wheel.schedule(conn, conn.last_seen + CLIENT_IDLE_TIMEOUT)
             
-    def cleanup_user(self, username: str):
-        """Очистить все ссылки на пользователя"""
-        try:
-            # Сохранить данные пользователя перед отключением
-            if username in self.users:
-                user = self.users[username]
-                user.is_online = False
-                self.save_users()
+    def check_idle(self, conn):
+        """Срок подключения истек. Данные клиента срок не переносят (это было бы
+        изменение колеса на каждое сообщение) - он проверяется здесь и
+        переносится, если с тех пор клиент что-то присылал."""
+        if conn.closing or conn.closed:
+            return
+        now = time.monotonic()
+        if conn.heartbeat:
+            if conn.last_seen + PING_INTERVAL > now:
+                conn.ping_sent = 0.0
+                self.idle_wheel.schedule(conn, conn.last_seen + PING_INTERVAL)
+                return
+            if not conn.ping_sent or conn.last_seen >= conn.ping_sent:
+                conn.ping_sent = now
+                conn.send(encode_message("", conn.protocol, FRAME_PING))
+                self.heartbeat_counters['pings'] += 1
+                self.idle_wheel.schedule(conn, now + PING_TIMEOUT)
+                return
+            self.heartbeat_counters['dead'] += 1
+            self.logger.info("Отключение %s: нет ответа на ping", conn.address)
+        else:
+            if conn.last_seen + CLIENT_IDLE_TIMEOUT > now:
+                self.idle_wheel.schedule(conn, conn.last_seen + CLIENT_IDLE_TIMEOUT)
+                return
+            self.heartbeat_counters['idle'] += 1
+            self.logger.info("Отключение %s: нет данных %s с", conn.address, CLIENT_IDLE_TIMEOUT)
+        # Обработчик клиента получит разрыв и выполнит cleanup_user
+        conn.abort()
             
-            # Удалить из онлайн пользователей
-            if username in self.online_users:
-                del self.online_users[username]
+    def cleanup_user(self, username: str, conn):
+        """Закрыть сессию подключения. Если пользователь уже вошел заново,
+        его новая сессия не затрагивается."""
+        try:
+            self.users.release(username)
+            self.idle_wheel.cancel(conn)
+            session = self.sessions.unregister(conn)
             
             # Удалить из комнаты
-            if username in self.user_rooms:
-                room_id = self.user_rooms[username]
-                if room_id in self.rooms:
-                    self.rooms[room_id].remove_user(username)
-                del self.user_rooms[username]
-                
-            # Удалить сокет
-            if username in self.user_sockets:
-                try:
-                    self.user_sockets[username].close()
-                except:
-                    pass
-                del self.user_sockets[username]
+            if session and session.room_id in self.rooms:
+                self.rooms[session.room_id].remove_user(username)
+                self.publish_membership(session.room_id, username, False)
                 
-            # Обновить обратную ссылку
-            sock_to_remove = None
-            for sock, user in self.socket_users.items():
-                if user == username:
-                    sock_to_remove = sock
-                    break
-            if sock_to_remove:
-                del self.socket_users[sock_to_remove]
-                
-            self.stats['active_connections'] = len(self.user_sockets)
+            # Закрыть сокет
+            try:
+                conn.close()
+            except:
+                pass
             
         except Exception as e:
-            self.logger.error(f"Ошибка очистки пользователя {username}: {e}")
+            self.logger.error("Ошибка очистки пользователя %s: %s", username, e)
             
     def log_statistics(self):
         """Логировать статистику сервера"""
         uptime = datetime.datetime.now() - self.stats['start_time']
         stats_msg = (
             f"Статистика: Время работы: {uptime}, "
-            f"Активных подключений: {self.stats['active_connections']}, "
-            f"Всего подключений: {self.stats['total_connections']}, "
-            f"Сообщений отправлено: {self.stats['messages_sent']}, "
-            f"Комнат создано: {self.stats['rooms_created']}, "
+            f"Активных подключений: {len(self.sessions)}, "
+            f"Всего подключений: {self.stats['total_connections'].value()}, "
+            f"Сообщений отправлено: {self.stats['messages_sent'].value()}, "
+            f"Комнат создано: {self.stats['rooms_created'].value()}, "
             f"Активных комнат: {len(self.rooms)}"
         )
         self.logger.info(stats_msg)
         
     def load_data(self):
-        """Загрузить сохраненные данные"""
-        if os.path.exists(self.data_file):
-            try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for room_data in data.get('rooms', []):
-                        room = ChatRoom(
-                            room_data['room_id'],
-                            room_data['name'],
-                            room_data['admin'],
-                            room_data.get('password')
-                        )
-                        room.messages = room_data.get('messages', [])
-                        room.created_at = room_data.get('created_at', datetime.datetime.now().isoformat())
-                        self.rooms[room.room_id] = room
-                        
-                self.logger.info(f"Загружено {len(self.rooms)} комнат из {self.data_file}")
-            except Exception as e:
-                self.logger.error(f"Ошибка загрузки данных: {e}")
-                # Создать резервную копию поврежденного файла
-                if os.path.exists(self.data_file):
-                    backup_name = f"{self.data_file}.backup.{int(time.time())}"
-                    os.rename(self.data_file, backup_name)
-                    self.logger.warning(f"Поврежденный файл перемещен в {backup_name}")
-                    
-    def save_data(self):
-        """Сохранить данные"""
+        """Открыть базу комнат и загрузить их без истории сообщений.
+        
+        История комнаты загружается при первом обращении (вход в комнату,
+        новое сообщение), поэтому время запуска не зависит от объема истории.
+        """
+        self.room_store = RoomStore(DATA_DB, writable=self.is_primary)
         try:
-            # Создать временный файл для атомарной записи
-            temp_file = f"{self.data_file}.tmp"
-            
-            data = {
-                'rooms': [room.to_dict() for room in self.rooms.values()],
-                'stats': {
-                    'total_connections': self.stats['total_connections'],
-                    'messages_sent': self.stats['messages_sent'],
-                    'rooms_created': self.stats['rooms_created'],
-                },
-                'last_updated': datetime.datetime.now().isoformat(),
-                'server_version': '1.0'
-            }
-            
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            migrated = self.room_store.migrate_json(self.data_file)
+            if migrated:
+                self.logger.info("Перенесено комнат из %s в %s: %s", self.data_file, DATA_DB, migrated)
+        except Exception as e:
+            self.logger.error("Ошибка переноса комнат из %s: %s", self.data_file, e)
+        try:
+            for room_data in self.room_store.load_stubs():
+                room = ChatRoom(
+                    room_data['room_id'],
+                    room_data['name'],
+                    room_data['admin'],
+                    room_data.get('password')
+                )
+                room.created_at = room_data.get('created_at') or datetime.datetime.now().isoformat()
+                if room_data.get('last_activity'):
+                    room.last_activity = datetime.datetime.fromisoformat(room_data['last_activity'])
+                room.loader = self.load_room_messages
+                self.prepare_room(room)
+                self.rooms[room.room_id] = room
+            self.room_directory.load(self.rooms.values())
                 
-            # Атомарно заменить основной файл
-            os.replace(temp_file, self.data_file)
-            
+            self.logger.info("Загружено %s комнат из %s", len(self.rooms), DATA_DB)
         except Exception as e:
-            self.logger.error(f"Ошибка сохранения данных: {e}")
-            # Удалить временный файл в случае ошибки
-            if os.path.exists(f"{self.data_file}.tmp"):
-                os.unlink(f"{self.data_file}.tmp")
+            self.logger.error("Ошибка загрузки данных: %s", e)
+            
+    def load_room_messages(self, room: ChatRoom) -> List[dict]:
+        """Загрузить сохраненные сообщения комнаты (вызывается в потоке-владельце)"""
+        messages = self.room_store.load_messages(room.room_id)
+        if self.is_primary and messages and not room.log.last_seq():
+            # Комната сохранена до появления журнала: начать его с известных сообщений
+            for record in messages:
+                room.log.append(record)
+        return messages
+                    
+    def save_data(self):
+        """Записать все накопленные изменения комнат и пользователей"""
+        for store in (self.room_store, self.users):
+            try:
+                if store:
+                    store.flush()
+            except Exception as e:
+                self.logger.error("Ошибка сохранения данных (%s): %s", store.path, e)
     
     def load_users(self):
-        """Загрузить пользователей из файла"""
+        """Открыть базу пользователей и загрузить их в память"""
+        self.users = UserStore(USERS_DB, writable=self.is_primary)
         try:
-            if os.path.exists(self.users_file):
-                with open(self.users_file, 'r', encoding='utf-8') as f:
-                    users_data = json.load(f)
-                
-                for username, user_data in users_data.get('users', {}).items():
-                    self.users[username] = User.from_dict(user_data)
-                
-                self.stats['registered_users'] = len(self.users)
-                self.logger.info(f"Загружено пользователей: {len(self.users)}")
-            else:
-                self.logger.info("Файл пользователей не найден, создаем новый")
-                self.save_users()
-                
+            migrated = self.users.migrate_json(self.users_file)
+            if migrated:
+                self.logger.info("Перенесено пользователей из %s в %s: %s", self.users_file, USERS_DB, migrated)
         except Exception as e:
-            self.logger.error(f"Ошибка загрузки пользователей: {e}")
-            self.users = {}
-    
-    def save_users(self):
-        """Сохранить пользователей в файл"""
+            self.logger.error("Ошибка переноса пользователей из %s: %s", self.users_file, e)
         try:
-            # Создать временный файл для атомарной записи
-            temp_file = f"{self.users_file}.tmp"
-            
-            data = {
-                'users': {username: user.to_dict() for username, user in self.users.items()},
-                'last_updated': datetime.datetime.now().isoformat(),
-                'total_users': len(self.users)
-            }
-            
-            # Убедиться что директория существует
-            os.makedirs(os.path.dirname(self.users_file), exist_ok=True)
-            
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-                
-            # Атомарно заменить основной файл
-            os.replace(temp_file, self.users_file)
-            
+            self.users.load()
+            self.logger.info("Зарегистрировано пользователей: %s", len(self.users))
         except Exception as e:
-            self.logger.error(f"Ошибка сохранения пользователей: {e}")
-            # Удалить временный файл в случае ошибки
-            if os.path.exists(f"{self.users_file}.tmp"):
-                os.unlink(f"{self.users_file}.tmp")
+            self.logger.error("Ошибка загрузки пользователей: %s", e)
     
-    def register_user(self, username: str, password: str) -> bool:
-        """Зарегистрировать нового пользователя"""
+    def register_user(self, username: str, password: str):
+        """Зарегистрировать нового пользователя.
+        
+        Генератор для auth_dialog: выдает Future хеширования в пуле процессов и
+        получает результат через send(). Возвращает True при успехе.
+        """
         username = username.strip().lower()
         
         # Проверка валидности имени пользователя
@@ -506,27 +3586,39 @@ class ChatServer:
             return False
         
         # Создать нового пользователя
-        password_hash = User.hash_password(password)
+        password_hash = yield self.password_hasher.hash(password)
+        if username in self.users:
+            # Имя заняли, пока вычислялся хеш
+            return False
         user = User(username, password_hash)
-        self.users[username] = user
-        
-        self.save_users()
-        self.stats['registered_users'] = len(self.users)
+        self.users.add(user)
+        self.publish({'type': 'user_registered', 'user': user.to_dict()})
         
-        self.action_logger.info(f"REGISTER: Новый пользователь зарегистрирован: {username}")
+        self.log_action('REGISTER', "Новый пользователь зарегистрирован: %(user)s", user=username)
         return True
     
-    def authenticate_user(self, username: str, password: str) -> bool:
-        """Аутентификация пользователя"""
+    def authenticate_user(self, username: str, password: str):
+        """Аутентификация пользователя.
+        
+        Генератор для auth_dialog, как и register_user. Хеш в старом формате
+        или с устаревшими параметрами заменяется новым после успешного входа.
+        """
         username = username.strip().lower()
         
         if username not in self.users:
             return False
         
         user = self.users[username]
-        if user.check_password(password):
+        valid, new_hash = yield self.password_hasher.verify(user.password_hash, password)
+        if valid:
+            event = {'type': 'user_login', 'username': username}
+            if new_hash:
+                user.password_hash = new_hash
+                event['password_hash'] = new_hash
             user.last_login = datetime.datetime.now().isoformat()
-            self.save_users()
+            event['last_login'] = user.last_login
+            self.users.save_login(user)
+            self.publish(event)
             return True
         
         return False
@@ -534,268 +3626,423 @@ class ChatServer:
     def login_user(self, username: str, user_socket: socket.socket) -> User:
         """Войти в систему (пользователь уже аутентифицирован)"""
         username = username.strip().lower()
-        user = self.users[username]
+        user = self.users.acquire(username)
+        previous = self.sessions.register(username, user_socket, user, getattr(user_socket, 'address', None))
         
         # Если пользователь уже онлайн, отключить предыдущее подключение
-        if username in self.online_users:
-            old_socket = self.user_sockets.get(username)
-            if old_socket:
-                try:
-                    old_socket.send("Ваш аккаунт был авторизован с другого устройства".encode('utf-8'))
-                    old_socket.close()
-                except:
-                    pass
-        
-        # Установить онлайн статус
-        user.is_online = True
-        self.online_users[username] = user
-        self.user_sockets[username] = user_socket
-        self.socket_users[user_socket] = username
+        if previous:
+            if previous.room_id in self.rooms:
+                self.rooms[previous.room_id].remove_user(username)
+                self.publish_membership(previous.room_id, username, False)
+            try:
+                previous.conn.send_text("Ваш аккаунт был авторизован с другого устройства")
+                previous.conn.close()
+            except:
+                pass
         
-        self.action_logger.info(f"LOGIN: Пользователь {username} вошел в систему")
+        self.log_action('LOGIN', "Пользователь %(user)s вошел в систему", user=username)
         return user
                 
     def create_room(self, room_name: str, admin: str, password: str = None) -> str:
         """Создать новую комнату"""
         room_id = str(uuid.uuid4())[:8]
         room = ChatRoom(room_id, room_name, admin, password)
+        self.prepare_room(room)
         self.rooms[room_id] = room
-        self.stats['rooms_created'] += 1
+        self.room_directory.add(room)
+        self.mark_room(room)
+        self.stats['rooms_created'].inc()
+        self.publish({
+            'type': 'room_created',
+            'room_id': room_id,
+            'name': room_name,
+            'admin': admin,
+            'password': password
+        })
         
-        self.action_logger.info(f"ROOM_CREATED: {admin} создал комнату '{room_name}' (ID: {room_id})")
-        self.logger.info(f"Создана комната '{room_name}' (ID: {room_id}) пользователем {admin}")
+        self.log_action('ROOM_CREATED', "%(user)s создал комнату '%(room_name)s' (ID: %(room_id)s)",
+                        user=admin, room_name=room_name, room_id=room_id)
+        self.logger.info("Создана комната '%s' (ID: %s) пользователем %s", room_name, room_id, admin)
         
         return room_id
         
     def join_room(self, username: str, room_id: str, password: str = None) -> bool:
         """Присоединиться к комнате"""
         if room_id not in self.rooms:
-            self.action_logger.warning(f"JOIN_FAILED: {username} попытался войти в несуществующую комнату {room_id}")
+            self.log_action('JOIN_FAILED', "%(user)s попытался войти в несуществующую комнату %(room_id)s",
+                            logging.WARNING, user=username, room_id=room_id, reason='not_found')
             return False
             
         room = self.rooms[room_id]
         
         # Проверить пароль
         if room.password and room.password != password:
-            self.action_logger.warning(f"JOIN_FAILED: {username} ввел неверный пароль для комнаты {room_id}")
+            self.log_action('JOIN_FAILED', "%(user)s ввел неверный пароль для комнаты %(room_id)s",
+                            logging.WARNING, user=username, room_id=room_id, reason='password')
             return False
             
         # Удалить из предыдущей комнаты
-        if username in self.user_rooms:
-            old_room_id = self.user_rooms[username]
+        user_socket = self.sessions.conn_of(username)
+        if not user_socket:
+            return False
+        old_room_id = self.sessions.room_of(username)
+        if old_room_id:
             if old_room_id in self.rooms:
                 self.rooms[old_room_id].remove_user(username)
+                self.publish_membership(old_room_id, username, False)
                 self.rooms[old_room_id].broadcast_message(f"{username} покинул комнату", "SYSTEM")
                 
         # Добавить в новую комнату
-        user_socket = self.user_sockets[username]
         address = getattr(user_socket, 'address', 'unknown')
         room.add_user(username, user_socket, address)
-        self.user_rooms[username] = room_id
+        self.sessions.set_room(username, room_id)
+        self.publish_membership(room_id, username, True)
         
         # Добавить комнату в историю пользователя
-        if username in self.users:
-            user = self.users[username]
-            user.add_room_to_history(room_id, room.name)
+        self.users.record_room_visit(username, room_id, room.name)
+        user = self.users.cached(username)
+        if user:
             user.current_room = room_id
         
-        # Отправить приветствие и историю
+        # Отправить приветствие и историю одной записью
         try:
-            user_socket.send(f"\n=== Добро пожаловать в комнату '{room.name}' (ID: {room_id}) ===".encode('utf-8'))
-            user_socket.send(f"Администратор: {room.admin}".encode('utf-8'))
-            user_socket.send(f"Пользователей в комнате: {len(room.users)}".encode('utf-8'))
-            
-            if room.messages:
-                user_socket.send("=== История сообщений ===".encode('utf-8'))
-                for msg in room.messages[-10:]:
-                    if msg.get('sender'):
-                        user_socket.send(f"[{msg['timestamp']}] {msg['sender']}: {msg['message']}".encode('utf-8'))
-                    else:
-                        user_socket.send(f"[{msg['timestamp']}] {msg['message']}".encode('utf-8'))
+            greeting = [
+                f"\n=== Добро пожаловать в комнату '{room.name}' (ID: {room_id}) ===",
+                f"Администратор: {room.admin}",
+                f"Пользователей в комнате: {len(room.member_names())}"
+            ]
+            
+            history = room.recent_lines(10)
+            if history:
+                greeting.append("=== История сообщений ===")
+                greeting.extend(history)
             
-            user_socket.send("=== Конец истории ===\n".encode('utf-8'))
+            greeting.append("=== Конец истории ===\n")
+            user_socket.send_texts(greeting)
             
         except Exception as e:
-            self.logger.error(f"Ошибка отправки приветствия пользователю {username}: {e}")
+            self.logger.error("Ошибка отправки приветствия пользователю %s: %s", username, e)
         
         # Уведомить других
         room.broadcast_message(f"{username} присоединился к комнате", "SYSTEM")
         
-        self.action_logger.info(f"JOIN_SUCCESS: {username} присоединился к комнате {room_id}")
-        self.logger.info(f"{username} присоединился к комнате '{room.name}' (ID: {room_id})")
+        self.log_action('JOIN_SUCCESS', "%(user)s присоединился к комнате %(room_id)s", user=username, room_id=room_id)
+        self.logger.info("%s присоединился к комнате '%s' (ID: %s)", username, room.name, room_id)
         
         return True
         
-    def handle_client(self, client_socket, address):
-        """Обработать подключение клиента с аутентификацией"""
-        username = None
+    def get_welcome_messages(self, user: User, username: str) -> List[str]:
+        """Персонализированное приветствие после входа"""
+        return [
+            f"=== ДОБРО ПОЖАЛОВАТЬ ОБРАТНО, {username.upper()}! ===",
+            f"Последний вход: {user.last_login or 'Первый раз'}",
+            f"Ваших сообщений: {len(user.message_history)}",
+            f"Посещенных комнат: {len(user.room_history)}",
+            "",
+            "=== КОМАНДЫ ЧАТА ===",
+            "Используйте /help для получения списка команд",
+            "Используйте /list для просмотра доступных комнат",
+            "Используйте /create <название> [пароль] для создания новой комнаты",
+            "Используйте /join <ID> [пароль] для входа в существующую комнату",
+            "Используйте /myrooms для просмотра ваших комнат",
+            "Используйте /history для просмотра истории сообщений"
+        ]
+
+    def throttle(self, username: str, message: str, conn) -> Optional[float]:
+        """Применить ограничения частоты к сообщению или команде клиента.
+        Вернуть задержку перед обработкой или None, если сообщение отброшено."""
+        ip = conn.address[0] if conn.address else ''
+        size = len(message.encode('utf-8'))
+        if message.startswith('/'):
+            cost = COMMAND_COSTS.get(message.split(None, 1)[0].lower(), 1)
+            costs = [('user', username, cost), ('ip', ip, cost)]
+        else:
+            costs = [('user', username, 1), ('ip', ip, 1)]
+            room_id = self.sessions.room_of(username)
+            if room_id:
+                costs.append(('room', room_id, 1))
+        costs += [('user_bytes', username, size), ('ip_bytes', ip, size)]
+        delay = self.rate_limiter.acquire(costs)
+        if delay is None:
+            now = time.monotonic()
+            if now - conn.throttle_notice >= 1.0:
+                conn.throttle_notice = now
+                conn.send_text("[SYSTEM] Слишком много сообщений: сообщение не обработано. Подождите немного.")
+        return delay
+        
+    def process_client_message(self, username: str, user: User, message: str, client_socket):
+        """Обработать одно входящее сообщение или команду аутентифицированного клиента"""
+        received = time.perf_counter()
+        if message.startswith('/'):
+            response = self.handle_command(username, message)
+            if response:
+                client_socket.send_text(response)
+            return
+
+        # Обычное сообщение
+        room_id = self.sessions.room_of(username)
+        if room_id:
+            if room_id in self.rooms:
+                room = self.rooms[room_id]
+                if ": " in message:
+                    sender, text = message.split(": ", 1)
+                    room.broadcast_message(f"{sender}: {text}", sender, received)
+                else:
+                    text = message
+                    room.broadcast_message(message, username, received)
+                
+                # Добавить в историю пользователя
+                self.users.record_message(username, room_id, text)
+                self.stats['messages_sent'].inc()
+                self.publish({'type': 'user_message', 'username': username, 'room_id': room_id, 'message': text})
+        else:
+            client_socket.send_text("Вы не находитесь ни в одной комнате. Используйте /join <ID> или /create <название>")
+
+    def reject_connection(self, client_socket: socket.socket, reason: str):
+        """Отказать в подключении, не блокируя поток приема"""
         try:
-            client_socket.settimeout(60)  # Таймаут для аутентификации
+            client_socket.setblocking(False)
+            client_socket.send(reason.encode('utf-8'))
+        except OSError:
+            pass
+        client_socket.close()
+        
+    def start_handshake_workers(self):
+        """Запустить фиксированный пул потоков этапа аутентификации"""
+        for _ in range(max(1, HANDSHAKE_WORKERS)):
+            threading.Thread(target=self.handshake_worker, daemon=True).start()
             
-            # Аутентификация пользователя
-            username = self.authenticate_client(client_socket, address)
-            if not username:
-                return
+    def handshake_worker(self):
+        """Поток этапа аутентификации: берет подключения из очереди по одному"""
+        while True:
+            client_socket, address, queued_at = self.handshake_queue.get()
+            try:
+                self.run_handshake(client_socket, address, queued_at)
+            except Exception as e:
+                self.logger.error("Ошибка аутентификации клиента %s: %s", address, e)
+            finally:
+                self.admission.release(address[0])
+                
+    def run_handshake(self, client_socket: socket.socket, address, queued_at: float):
+        """Провести диалог входа и передать вошедшего пользователя в поток сессии"""
+        if not self.running:
+            client_socket.close()
+            return
+        if time.monotonic() - queued_at > AUTH_TIMEOUT:
+            # Клиент слишком долго ждал в очереди и, скорее всего, уже переподключился
+            self.admission.count_timeout()
+            self.reject_connection(client_socket, "Сервер перегружен. Попробуйте позже.")
+            return
             
-            # Пользователь аутентифицирован, входим в систему
-            user = self.login_user(username, client_socket)
+        conn = ClientConnection(client_socket, address, self.outbound_policy)
+        conn.accepted_at = queued_at
+        username = self.authenticate_client(conn, address)
+        if not username:
+            conn.close()
+            return
             
-            self.stats['total_connections'] += 1
-            self.stats['active_connections'] += 1
+        threading.Thread(
+            target=self.handle_client,
+            args=(conn, address, username),
+            daemon=True
+        ).start()
+        
+    def handle_client(self, client_socket: ClientConnection, address, username: str):
+        """Обработать сессию аутентифицированного клиента"""
+        try:
+            user = self.login_user(username, client_socket)
+            LOGIN_DURATION.observe(time.monotonic() - client_socket.accepted_at)
+            self.stats['total_connections'].inc()
             
-            self.action_logger.info(f"CONNECT: {username} подключился с {address}")
-            self.logger.info(f"Пользователь {username} подключился с {address}")
+            self.log_action('CONNECT', "%(user)s подключился с %(address)s", user=username, address=address)
+            self.logger.info("Пользователь %s подключился с %s", username, address)
             
             # Отправить персонализированное приветствие
-            welcome_messages = [
-                f"=== ДОБРО ПОЖАЛОВАТЬ ОБРАТНО, {username.upper()}! ===",
-                f"Последний вход: {user.last_login or 'Первый раз'}",
-                f"Ваших сообщений: {len(user.message_history)}",
-                f"Посещенных комнат: {len(user.room_history)}",
-                "",
-                "=== КОМАНДЫ ЧАТА ===",
-                "Используйте /help для получения списка команд",
-                "Используйте /list для просмотра доступных комнат",
-                "Используйте /create <название> [пароль] для создания новой комнаты",
-                "Используйте /join <ID> [пароль] для входа в существующую комнату",
-                "Используйте /myrooms для просмотра ваших комнат",
-                "Используйте /history для просмотра истории сообщений"
-            ]
-            
-            for msg in welcome_messages:
-                client_socket.send(msg.encode('utf-8'))
+            client_socket.send_texts(self.get_welcome_messages(user, username))
             
             client_socket.settimeout(None)  # Убрать таймаут для обычной работы
+            self.watch_idle(client_socket)
             
             # Основной цикл обработки сообщений
             while self.running:
                 try:
-                    message = client_socket.recv(MAX_MESSAGE_LENGTH).decode('utf-8')
+                    message = client_socket.recv_message(MAX_MESSAGE_LENGTH)
                     if not message:
                         break
-                        
-                    if message.startswith('/'):
-                        response = self.handle_command(username, message)
-                        if response:
-                            client_socket.send(response.encode('utf-8'))
-                    else:
-                        # Обычное сообщение
-                        if username in self.user_rooms:
-                            room_id = self.user_rooms[username]
-                            if room_id in self.rooms:
-                                room = self.rooms[room_id]
-                                if ": " in message:
-                                    sender, text = message.split(": ", 1)
-                                    room.broadcast_message(f"{sender}: {text}", sender)
-                                    # Добавить в историю пользователя
-                                    user.add_message_to_history(room_id, text)
-                                    self.stats['messages_sent'] += 1
-                                else:
-                                    room.broadcast_message(message, username)
-                                    # Добавить в историю пользователя
-                                    user.add_message_to_history(room_id, message)
-                                    self.stats['messages_sent'] += 1
-                        else:
-                            client_socket.send("Вы не находитесь ни в одной комнате. Используйте /join <ID> или /create <название>".encode('utf-8'))
+                    delay = self.throttle(username, message, client_socket)
+                    if delay is None:
+                        continue
+                    if delay:
+                        # Пока поток ждет, данные клиента копятся в сокете - TCP замедляет отправителя
+                        time.sleep(delay)
+                    self.process_client_message(username, user, message, client_socket)
                             
                 except socket.timeout:
                     continue
                 except ConnectionResetError:
                     break
                 except Exception as e:
-                    self.logger.error(f"Ошибка обработки сообщения от {username}: {e}")
+                    self.logger.error("Ошибка обработки сообщения от %s: %s", username, e)
                     break
                     
         except Exception as e:
-            self.logger.error(f"Ошибка обработки клиента {address}: {e}")
-            self.logger.debug(f"Traceback: {traceback.format_exc()}")
+            self.logger.error("Ошибка обработки клиента %s: %s", address, e)
+            self.logger.debug("Traceback:", exc_info=True)
         finally:
             if username:
-                self.action_logger.info(f"DISCONNECT: {username} отключился")
-                self.logger.info(f"Пользователь {username} отключился")
-                self.cleanup_user(username)
+                self.log_action('DISCONNECT', "%(user)s отключился", user=username)
+                self.logger.info("Пользователь %s отключился", username)
+                self.cleanup_user(username, client_socket)
                 
             try:
                 client_socket.close()
             except:
                 pass
     
-    def authenticate_client(self, client_socket, address) -> Optional[str]:
-        """Аутентификация клиента"""
-        try:
-            # Отправить запрос на аутентификацию
-            auth_prompt = "AUTH_REQUIRED"
-            client_socket.send(auth_prompt.encode('utf-8'))
-            
-            # Получить логин
-            login_data = client_socket.recv(1024).decode('utf-8')
-            if not login_data.startswith("LOGIN:"):
-                client_socket.send("ERROR:Неверный формат логина".encode('utf-8'))
-                return None
+    def auth_dialog(self, address):
+        """Диалог аутентификации в виде генератора.
+
+        Генератор выдает очередной запрос клиенту и получает ответ через send().
+        Вместо запроса он может выдать Future хеширования пароля - тогда драйвер
+        ждет его результат, ничего не отправляя клиенту, и передает результат в send().
+        По завершении возвращает (username или None, финальное сообщение).
+        Один и тот же диалог используется и потоковым, и asyncio сервером.
+        """
+        # Запрос на аутентификацию и получение логина
+        login_data = yield "AUTH_REQUIRED"
+        if not login_data.startswith("LOGIN:"):
+            return None, "ERROR:Неверный формат логина"
+        
+        username = login_data[6:].strip().lower()
+        
+        # Проверить валидность имени пользователя
+        if not username or len(username) < 3 or len(username) > 20:
+            return None, "ERROR:Имя пользователя должно быть от 3 до 20 символов"
+        
+        # Проверить что пользователь существует
+        if username not in self.users:
+            # Новый пользователь - предложить регистрацию
+            response = yield "NEW_USER:Пользователь не найден. Создать новый аккаунт? (y/n)"
+            response = response.strip().lower()
+            if response != 'y' and response != 'yes':
+                return None, "ERROR:Регистрация отменена"
             
-            username = login_data[6:].strip().lower()
+            # Запросить пароль для нового аккаунта
+            password = yield "PASSWORD_NEW:Введите пароль для нового аккаунта:"
+            password = password.strip()
             
-            # Проверить валидность имени пользователя
-            if not username or len(username) < 3 or len(username) > 20:
-                client_socket.send("ERROR:Имя пользователя должно быть от 3 до 20 символов".encode('utf-8'))
-                return None
+            if len(password) < 6:
+                return None, "ERROR:Пароль должен быть не менее 6 символов"
             
-            # Проверить что пользователь существует
-            if username not in self.users:
-                # Новый пользователь - предложить регистрацию
-                client_socket.send("NEW_USER:Пользователь не найден. Создать новый аккаунт? (y/n)".encode('utf-8'))
-                
-                response = client_socket.recv(1024).decode('utf-8').strip().lower()
-                if response != 'y' and response != 'yes':
-                    client_socket.send("ERROR:Регистрация отменена".encode('utf-8'))
-                    return None
-                
-                # Запросить пароль для нового аккаунта
-                client_socket.send("PASSWORD_NEW:Введите пароль для нового аккаунта:".encode('utf-8'))
-                password = client_socket.recv(1024).decode('utf-8').strip()
-                
-                if len(password) < 6:
-                    client_socket.send("ERROR:Пароль должен быть не менее 6 символов".encode('utf-8'))
-                    return None
-                
-                # Зарегистрировать пользователя
-                if self.register_user(username, password):
-                    client_socket.send("SUCCESS:Аккаунт создан! Добро пожаловать!".encode('utf-8'))
+            # Зарегистрировать пользователя
+            try:
+                registered = yield from self.register_user(username, password)
+            except HasherBusy:
+                return None, "ERROR:Сервер перегружен. Попробуйте позже."
+            if registered:
+                return username, "SUCCESS:Аккаунт создан! Добро пожаловать!"
+            return None, "ERROR:Не удалось создать аккаунт"
+        
+        # Существующий пользователь - запросить пароль
+        password = yield "PASSWORD:Введите пароль:"
+        password = password.strip()
+        
+        try:
+            authenticated = yield from self.authenticate_user(username, password)
+        except HasherBusy:
+            return None, "ERROR:Сервер перегружен. Попробуйте позже."
+        if authenticated:
+            return username, "SUCCESS:Авторизация успешна!"
+        
+        self.log_action('AUTH_FAILED', "%(user)s с %(address)s", logging.WARNING, user=username, address=address)
+        return None, "ERROR:Неверный пароль"
+    
+    def authenticate_client(self, client_socket, address) -> Optional[str]:
+        """Аутентификация клиента с ограничением времени на каждый шаг диалога"""
+        try:
+            dialog = self.auth_dialog(address)
+            reply = None
+            while True:
+                try:
+                    prompt = dialog.send(reply)
+                except StopIteration as done:
+                    username, final_message = done.value
+                    client_socket.send_text(final_message, FRAME_AUTH)
                     return username
-                else:
-                    client_socket.send("ERROR:Не удалось создать аккаунт".encode('utf-8'))
-                    return None
-            else:
-                # Существующий пользователь - запросить пароль
-                client_socket.send("PASSWORD:Введите пароль:".encode('utf-8'))
-                password = client_socket.recv(1024).decode('utf-8').strip()
                 
-                if self.authenticate_user(username, password):
-                    client_socket.send("SUCCESS:Авторизация успешна!".encode('utf-8'))
-                    return username
-                else:
-                    client_socket.send("ERROR:Неверный пароль".encode('utf-8'))
-                    self.action_logger.warning(f"AUTH_FAILED: {username} с {address}")
+                if isinstance(prompt, concurrent.futures.Future):
+                    reply = prompt.result()
+                    continue
+                client_socket.send_text(prompt, FRAME_AUTH)
+                reply = client_socket.recv_message(1024, time.monotonic() + AUTH_TIMEOUT)
+                if reply is None:
                     return None
+                if prompt == "AUTH_REQUIRED":
+                    reply = negotiate_protocol(client_socket, reply)
                     
+        except socket.timeout:
+            self.admission.count_timeout()
+            self.logger.warning("Таймаут аутентификации клиента %s", address)
+            return None
         except Exception as e:
-            self.logger.error(f"Ошибка аутентификации клиента {address}: {e}")
+            self.logger.error("Ошибка аутентификации клиента %s: %s", address, e)
             return None
                 
+    # Команда -> имя метода-обработчика command_*(username, parts) -> ответ
+    COMMANDS = {
+        '/help': 'command_help',
+        '/stats': 'command_stats',
+        '/perf': 'command_perf',
+        '/myrooms': 'command_myrooms',
+        '/history': 'command_history',
+        '/chathistory': 'command_chathistory',
+        '/search': 'command_search',
+        '/profile': 'command_profile',
+        '/myprofile': 'command_profile',
+        '/list': 'command_list',
+        '/create': 'command_create',
+        '/join': 'command_join',
+        '/leave': 'command_leave',
+        '/users': 'command_users',
+        '/info': 'command_info',
+        '/password': 'command_password',
+        '/kick': 'command_kick',
+    }
+    
     def handle_command(self, username: str, command: str) -> str:
-        """Обработать команду (с тем же функционалом что и раньше)"""
+        """Выполнить команду по таблице COMMANDS и учесть ее стоимость:
+        число вызовов, ошибки, время выполнения и объем ответа"""
         parts = command.strip().split()
         cmd = parts[0].lower()
         
-        self.action_logger.info(f"COMMAND: {username} выполнил команду {cmd}")
+        self.log_action('COMMAND', "%(user)s выполнил команду %(command)s", user=username, command=cmd)
         
-        # Здесь тот же код обработки команд что и в оригинальном сервере
-        if cmd == '/help':
-            return """
+        handler = self.COMMANDS.get(cmd)
+        # Неизвестные команды учитываются вместе, чтобы клиенты не плодили метки метрик
+        stats = self.command_metrics.get(cmd if handler else UNKNOWN_COMMAND)
+        started = time.perf_counter()
+        try:
+            if handler:
+                response = getattr(self, handler)(username, parts)
+            else:
+                response = f"Неизвестная команда: {cmd}. Используйте /help для справки."
+        except Exception:
+            stats.errors.inc()
+            raise
+        finally:
+            stats.duration.observe(time.perf_counter() - started)
+            stats.calls.inc()
+        if response:
+            stats.response_bytes.inc(len(response.encode('utf-8')))
+        return response
+    
+    def command_help(self, username: str, parts: List[str]) -> str:
+        """Справка по командам"""
+        return """
 === КОМАНДЫ ЧАТА ===
 📋 Основные команды:
 /help - показать эту справку
-/list - список всех комнат
+/list [страница] [начало названия] [-u|-a] - список комнат (-u по участникам, -a по активности)
 /users - пользователи в текущей комнате
 /exit - выйти из чата
 
@@ -809,7 +4056,8 @@ class ChatServer:
 /profile, /myprofile - ваш профиль
 /myrooms - ваши комнаты
 /history - ваша история сообщений
-/chathistory - история текущей комнаты
+/chathistory [страница|дата] - история текущей комнаты (дата: ГГГГ-ММ-ДД)
+/search <слова> ["фраза"] [слово*] [from:имя] - поиск по истории текущей комнаты
 
 �👨‍💼 Админские команды (только для создателя комнаты):
 /kick <пользователь> - исключить пользователя
@@ -817,95 +4065,224 @@ class ChatServer:
 
 📊 Информация:
 /stats - статистика сервера
+/perf [N] - самые дорогие команды (администраторы сервера)
 
 💡 Примеры:
 /create Общение 123 - создать комнату с паролем
 /join abc123 456 - войти в комнату с паролем
 /create Открытая - создать комнату без пароля
 """
-        
-        elif cmd == '/stats':
-            uptime = datetime.datetime.now() - self.stats['start_time']
-            return f"""
+    
+    def command_stats(self, username: str, parts: List[str]) -> str:
+        """Статистика сервера"""
+        uptime = datetime.datetime.now() - self.stats['start_time']
+        slow = self.outbound_policy.counters
+        handshakes = self.admission.counters
+        heartbeat = self.heartbeat_counters
+        latency = lambda histogram: f"{histogram.quantile(0.5) * 1000:.2f}/{histogram.quantile(0.99) * 1000:.2f}"
+        return f"""
 === СТАТИСТИКА СЕРВЕРА ===
 Время работы: {uptime}
-Активных подключений: {self.stats['active_connections']}
-Всего подключений: {self.stats['total_connections']}
-Сообщений отправлено: {self.stats['messages_sent']}
-Комнат создано: {self.stats['rooms_created']}
+Активных подключений: {len(self.sessions)}
+Всего подключений: {self.stats['total_connections'].value()}
+Сообщений отправлено: {self.stats['messages_sent'].value()}
+Комнат создано: {self.stats['rooms_created'].value()}
 Активных комнат: {len(self.rooms)}
-Зарегистрированных пользователей: {self.stats['registered_users']}
+Зарегистрированных пользователей: {len(self.users)}
+Медленные клиенты ({self.outbound_policy.policy}): отброшено {slow['dropped']}, пропущено {slow['skipped']}, отключено {slow['disconnected']}
+Ограничение частоты: задержано {self.format_throttled('delayed')}, отброшено {self.format_throttled('dropped')}
+Аутентификация: ожидают {self.admission.pending}, отклонено (перегрузка) {handshakes['rejected_busy']}, отклонено (лимит IP) {handshakes['rejected_ip']}, таймауты {handshakes['timeouts']}
+Контроль соединений: отслеживается {len(self.idle_wheel)}, ping отправлено {heartbeat['pings']}, отключено без ответа {heartbeat['dead']}, по бездействию {heartbeat['idle']}
+Запись комнат: {self.room_store.write_metrics()}
+Запись пользователей: {self.users.write_metrics()}
+Фоновые задачи: {self.scheduler.metrics() if self.scheduler else 'не запущены'}
+Задержки p50/p99, мс: доставка {latency(FANOUT_LATENCY)}, рассылка {latency(FANOUT_DURATION)}, вход {latency(LOGIN_DURATION)}, запись {latency(SAVE_DURATION)}
 """
+    
+    def format_throttled(self, action: str) -> str:
+        counts = self.rate_limiter.totals(action)
+        details = ", ".join(f"{scope} {count}" for scope, count in counts.items() if count)
+        return f"{sum(counts.values())}" + (f" ({details})" if details else "")
         
-        elif cmd == '/myrooms':
-            user = self.users.get(username)
-            if not user or not user.room_history:
-                return "У вас нет истории посещений комнат."
-            
-            result = "\n=== ВАШИ КОМНАТЫ ===\n"
-            for room_entry in user.room_history[:10]:  # Показать последние 10
-                room_id = room_entry['room_id']
-                room_name = room_entry['room_name']
-                last_visit = room_entry['last_visit']
-                status = "🟢 Активна" if room_id in self.rooms else "🔴 Закрыта"
-                result += f"{room_id}: {room_name} - {status}\n"
-                result += f"   Последний визит: {last_visit[:19]}\n\n"
-            return result
-            
-        elif cmd == '/history':
-            user = self.users.get(username)
-            if not user or not user.message_history:
-                return "У вас нет истории сообщений."
-            
-            result = "\n=== ВАША ИСТОРИЯ СООБЩЕНИЙ ===\n"
-            recent_messages = user.message_history[-20:]  # Последние 20 сообщений
-            
-            for msg_entry in recent_messages:
-                room_id = msg_entry['room_id']
-                message = msg_entry['message']
-                timestamp = msg_entry['timestamp'][:19]  # Убрать миллисекунды
-                
-                room_name = "Неизвестная комната"
-                if room_id in self.rooms:
-                    room_name = self.rooms[room_id].name
-                
-                result += f"[{timestamp}] {room_name}: {message}\n"
-            
-            return result
-            
-        elif cmd == '/chathistory':
-            if username not in self.user_rooms:
-                return "Вы не находитесь в комнате."
-            
-            room_id = self.user_rooms[username]
-            if room_id not in self.rooms:
-                return "Комната не найдена."
-            
-            room = self.rooms[room_id]
-            if not room.messages:
-                return "История сообщений пуста."
-            
-            result = f"\n=== ИСТОРИЯ КОМНАТЫ '{room.name}' ===\n"
-            recent_messages = room.messages[-30:]  # Последние 30 сообщений
-            
-            for msg in recent_messages:
-                timestamp = msg.get('timestamp', '')[:19]
-                sender = msg.get('sender', 'Система')
-                message = msg.get('message', '')
-                
-                if sender == 'SYSTEM':
-                    result += f"[{timestamp}] 🔔 {message}\n"
-                else:
-                    result += f"[{timestamp}] {sender}: {message}\n"
+    def command_perf(self, username: str, parts: List[str]) -> str:
+        """Команды с наибольшим суммарным временем выполнения (администраторы сервера)"""
+        if username not in SERVER_ADMINS:
+            return "Команда доступна только администраторам сервера."
+        limit = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10
+        lines = ["", "=== СТОИМОСТЬ КОМАНД (по суммарному времени) ===",
+                 f"{'Команда':<14} {'вызовов':>8} {'всего, мс':>10} {'ср., мс':>8} {'p99, мс':>8} {'ср. ответ, Б':>13} {'ошибок':>7}"]
+        for stats in self.command_metrics.top(limit):
+            calls = stats.calls.value()
+            _, total = stats.duration.snapshot()
+            lines.append(f"{stats.command:<14} {calls:>8} {total * 1000:>10.1f} {total * 1000 / calls:>8.2f} "
+                         f"{stats.duration.quantile(0.99) * 1000:>8.2f} {stats.response_bytes.value() // calls:>13} "
+                         f"{stats.errors.value():>7}")
+        lines.append("")
+        return "\n".join(lines)
+    
+    def command_myrooms(self, username: str, parts: List[str]) -> str:
+        """Последние посещенные комнаты"""
+        user = self.users.get(username)
+        if not user or not user.room_history:
+            return "У вас нет истории посещений комнат."
+        
+        result = "\n=== ВАШИ КОМНАТЫ ===\n"
+        for room_entry in user.room_history[:10]:  # Показать последние 10
+            room_id = room_entry['room_id']
+            room_name = room_entry['room_name']
+            last_visit = room_entry['last_visit']
+            status = "🟢 Активна" if room_id in self.rooms else "🔴 Закрыта"
+            result += f"{room_id}: {room_name} - {status}\n"
+            result += f"   Последний визит: {last_visit[:19]}\n\n"
+        return result
+    
+    def command_history(self, username: str, parts: List[str]) -> str:
+        """Последние сообщения пользователя"""
+        user = self.users.get(username)
+        if not user or not user.message_history:
+            return "У вас нет истории сообщений."
+        
+        result = "\n=== ВАША ИСТОРИЯ СООБЩЕНИЙ ===\n"
+        for msg_entry in user.message_history.last(20):  # Последние 20 сообщений
+            room_id = msg_entry.room_id
+            message = msg_entry.text
+            timestamp = msg_entry.date[:19]  # Убрать миллисекунды
             
-            return result
+            room_name = "Неизвестная комната"
+            if room_id in self.rooms:
+                room_name = self.rooms[room_id].name
             
-        elif cmd == '/profile' or cmd == '/myprofile':
-            user = self.users.get(username)
-            if not user:
-                return "Профиль не найден."
+            result += f"[{timestamp}] {room_name}: {message}\n"
+        
+        return result
+    
+    def command_chathistory(self, username: str, parts: List[str]) -> str:
+        """История текущей комнаты из журнала: страница от конца или с даты"""
+        room_id = self.sessions.room_of(username)
+        if not room_id:
+            return "Вы не находитесь в комнате."
+        
+        if room_id not in self.rooms:
+            return "Комната не найдена."
+        
+        room = self.rooms[room_id]
+        room.ensure_loaded()
+        last_seq = room.log.last_seq()
+        if not last_seq:
+            return "История сообщений пуста."
+        
+        page = None
+        if len(parts) > 1 and not parts[1].isdigit():
+            # Страница сообщений начиная с даты
+            try:
+                since = datetime.datetime.fromisoformat(parts[1]).timestamp()
+            except ValueError:
+                return "Использование: /chathistory [страница|ГГГГ-ММ-ДД]"
+            start_seq = room.log.seq_at_time(since)
+            recent_messages = room.log.read(start_seq, start_seq + HISTORY_PAGE_SIZE)
+            title = f"с {parts[1]}"
+        else:
+            # Страницы считаются от последнего сообщения назад
+            page = max(1, int(parts[1])) if len(parts) > 1 else 1
+            end_seq = last_seq + 1 - (page - 1) * HISTORY_PAGE_SIZE
+            if end_seq <= 1:
+                return "Более старых сообщений нет."
+            recent_messages, start_seq = room.log.page_before(end_seq, HISTORY_PAGE_SIZE)
+            title = f"страница {page}"
+        if not recent_messages:
+            return "Сообщений не найдено."
+        
+        lines = ["", f"=== ИСТОРИЯ КОМНАТЫ '{room.name}' ({title}, "
+                     f"сообщения {start_seq}-{start_seq + len(recent_messages) - 1} из {last_seq}) ==="]
+        
+        for msg in recent_messages:
+            timestamp = msg.get('timestamp', '')[:19]
+            sender = msg.get('sender', 'Система')
+            message = msg.get('message', '')
             
-            return f"""
+            if sender == 'SYSTEM':
+                lines.append(f"[{timestamp}] 🔔 {message}")
+            else:
+                lines.append(f"[{timestamp}] {sender}: {message}")
+        
+        if page and start_seq > 1:
+            lines.append(f"Более старые сообщения: /chathistory {page + 1}")
+        lines.append("")
+        return "\n".join(lines)
+    
+    def command_search(self, username: str, parts: List[str]) -> str:
+        """Поиск по истории текущей комнаты через поисковый индекс журнала"""
+        room_id = self.sessions.room_of(username)
+        if not room_id:
+            return "Вы не находитесь в комнате."
+        
+        if room_id not in self.rooms:
+            return "Комната не найдена."
+        
+        before = None
+        if len(parts) > 1 and parts[-1].startswith('before:') and parts[-1][7:].isdigit():
+            before = int(parts.pop()[7:])
+        query = " ".join(parts[1:])
+        keys, phrases = RoomSearchIndex.parse_query(query)
+        if not keys:
+            return 'Использование: /search <слова> ["фраза"] [слово*] [from:имя]'
+        
+        room = self.rooms[room_id]
+        room.ensure_loaded()
+        started = time.perf_counter()
+        found = []
+        candidates = room.log.search.candidates(keys, before)
+        # Фразы отсеивают часть кандидатов, поэтому их читается больше за раз
+        batch_size = SEARCH_RESULTS * 5 if phrases else SEARCH_RESULTS
+        examined = 0
+        last_examined = None
+        while len(found) < SEARCH_RESULTS and examined < SEARCH_MAX_CANDIDATES:
+            batch = list(itertools.islice(candidates, min(batch_size, SEARCH_MAX_CANDIDATES - examined)))
+            if not batch:
+                break
+            examined += len(batch)
+            records = room.log.read_seqs(batch)
+            for seq in batch:
+                last_examined = seq
+                record = records.get(seq)
+                if record is None:
+                    continue
+                if phrases:
+                    words = tokenize(message_body(record))
+                    if not all(contains_phrase(words, phrase) for phrase in phrases):
+                        continue
+                found.append((seq, record))
+                if len(found) >= SEARCH_RESULTS:
+                    break
+        elapsed = (time.perf_counter() - started) * 1000
+        exhausted = examined >= SEARCH_MAX_CANDIDATES and len(found) < SEARCH_RESULTS
+        if not found:
+            if exhausted:
+                return (f"В последних {examined} подходящих по словам сообщениях совпадений нет. "
+                        f"Продолжить: /search {query} before:{last_examined}")
+            return "Ничего не найдено."
+        
+        lines = ["", f"=== ПОИСК В КОМНАТЕ '{room.name}': {query} (совпадений: {len(found)}, {elapsed:.1f} мс) ==="]
+        for seq, msg in reversed(found):
+            date = msg.get('date', '')[:16].replace('T', ' ')
+            if msg.get('sender') == 'SYSTEM':
+                lines.append(f"#{seq} [{date}] 🔔 {msg.get('message', '')}")
+            else:
+                lines.append(f"#{seq} [{date}] {msg.get('message', '')}")
+        if len(found) >= SEARCH_RESULTS:
+            lines.append(f"Более старые совпадения: /search {query} before:{found[-1][0]}")
+        elif exhausted:
+            lines.append(f"Проверено {examined} сообщений, продолжить: /search {query} before:{last_examined}")
+        lines.append("")
+        return "\n".join(lines)
+    
+    def command_profile(self, username: str, parts: List[str]) -> str:
+        """Профиль пользователя"""
+        user = self.users.get(username)
+        if not user:
+            return "Профиль не найден."
+        
+        return f"""
 === ВАШ ПРОФИЛЬ ===
 Имя пользователя: {user.username}
 Дата регистрации: {user.created_at[:19]}
@@ -914,217 +4291,345 @@ class ChatServer:
 Комнат посещено: {len(user.room_history)}
 Статус: 🟢 Онлайн
 """
-        
-        # Остальные команды остаются теми же...
-        # (копируем из оригинального сервера)
-        elif cmd == '/list':
-            rooms = self.get_room_list()
-            if not rooms:
-                return "Нет доступных комнат."
-            
-            result = "\n=== СПИСОК КОМНАТ ===\n"
-            for room in rooms:
-                lock_icon = "🔒" if room['protected'] else "🔓"
-                result += f"{lock_icon} {room['id']}: {room['name']} (Админ: {room['admin']}, Пользователей: {room['users']})\n"
-            return result
-            
-        elif cmd == '/create':
-            if len(parts) < 2:
-                return "Использование: /create <название> [пароль]"
-            
-            # Проверка: пользователь не должен быть в комнате
-            if username in self.user_rooms:
-                current_room_id = self.user_rooms[username]
-                if current_room_id in self.rooms:
-                    current_room_name = self.rooms[current_room_id].name
-                    return f"Вы уже находитесь в комнате '{current_room_name}'. Сначала покиньте её командой /leave"
-            
-            room_name = parts[1]
-            password = parts[2] if len(parts) > 2 else None
-            room_id = self.create_room(room_name, username, password)
-            
-            self.join_room(username, room_id, password)
-            return f"Комната '{room_name}' создана! ID: {room_id}"
-            
-        elif cmd == '/join':
-            if len(parts) < 2:
-                return "Использование: /join <ID> [пароль]"
-            
-            room_id = parts[1]
-            password = parts[2] if len(parts) > 2 else None
-            
-            if self.join_room(username, room_id, password):
-                return f"Вы присоединились к комнате {room_id}"
+    
+    def command_list(self, username: str, parts: List[str]) -> str:
+        """Страница каталога комнат: /list [страница] [начало названия] [-u|-a]"""
+        page, prefix, flag = 1, '', ''
+        for arg in parts[1:]:
+            if arg.isdigit():
+                page = max(1, int(arg))
+            elif arg in ('-u', '-a'):
+                flag = arg
             else:
-                return "Не удалось присоединиться к комнате. Проверьте ID и пароль."
+                prefix = arg
+        order = {'-u': 'members', '-a': 'activity'}.get(flag, 'name')
+        entries, total = self.room_directory.page(page, ROOM_LIST_PAGE_SIZE, prefix, order)
+        if not total:
+            return f"Комнат, название которых начинается с '{prefix}', нет." if prefix else "Нет доступных комнат."
+        pages = (total + ROOM_LIST_PAGE_SIZE - 1) // ROOM_LIST_PAGE_SIZE
+        if not entries:
+            return f"Страницы {page} нет, всего страниц: {pages}."
         
-        elif cmd == '/leave':
-            if username not in self.user_rooms:
-                return "Вы не находитесь ни в одной комнате."
-            
-            room_id = self.user_rooms[username]
-            if room_id in self.rooms:
-                room = self.rooms[room_id]
-                room.remove_user(username)
-                room.broadcast_message(f"{username} покинул комнату", "SYSTEM")
-                
-                # Обновить пользователя
-                if username in self.users:
-                    self.users[username].current_room = None
-                
-                del self.user_rooms[username]
-                return f"Вы покинули комнату '{room.name}'"
-            else:
-                return "Комната не найдена."
+        lines = ["", f"=== СПИСОК КОМНАТ (страница {page} из {pages}, всего {total}) ==="]
+        for entry in entries:
+            lock_icon = "🔒" if entry.protected else "🔓"
+            lines.append(f"{lock_icon} {entry.room_id}: {entry.name} (Админ: {entry.admin}, Пользователей: {entry.members})")
+        if page < pages:
+            lines.append("Следующая страница: " + " ".join(filter(None, ['/list', str(page + 1), prefix, flag])))
+        lines.append("")
+        return "\n".join(lines)
+    
+    def command_create(self, username: str, parts: List[str]) -> str:
+        """Создать комнату и войти в нее"""
+        if len(parts) < 2:
+            return "Использование: /create <название> [пароль]"
         
-        elif cmd == '/users':
-            if username not in self.user_rooms:
-                return "Вы не находитесь ни в одной комнате."
-            
-            room_id = self.user_rooms[username]
-            if room_id not in self.rooms:
-                return "Комната не найдена."
-            
+        # Проверка: пользователь не должен быть в комнате
+        current_room_id = self.sessions.room_of(username)
+        if current_room_id:
+            if current_room_id in self.rooms:
+                current_room_name = self.rooms[current_room_id].name
+                return f"Вы уже находитесь в комнате '{current_room_name}'. Сначала покиньте её командой /leave"
+        
+        room_name = parts[1]
+        password = parts[2] if len(parts) > 2 else None
+        room_id = self.create_room(room_name, username, password)
+        
+        self.join_room(username, room_id, password)
+        return f"Комната '{room_name}' создана! ID: {room_id}"
+    
+    def command_join(self, username: str, parts: List[str]) -> str:
+        """Войти в комнату"""
+        if len(parts) < 2:
+            return "Использование: /join <ID> [пароль]"
+        
+        room_id = parts[1]
+        password = parts[2] if len(parts) > 2 else None
+        
+        if self.join_room(username, room_id, password):
+            return f"Вы присоединились к комнате {room_id}"
+        else:
+            return "Не удалось присоединиться к комнате. Проверьте ID и пароль."
+    
+    def command_leave(self, username: str, parts: List[str]) -> str:
+        """Покинуть текущую комнату"""
+        room_id = self.sessions.room_of(username)
+        if not room_id:
+            return "Вы не находитесь ни в одной комнате."
+        
+        if room_id in self.rooms:
             room = self.rooms[room_id]
-            if not room.users:
-                return "В комнате никого нет."
+            room.remove_user(username)
+            self.publish_membership(room_id, username, False)
+            room.broadcast_message(f"{username} покинул комнату", "SYSTEM")
             
-            result = f"\n=== ПОЛЬЗОВАТЕЛИ В КОМНАТЕ '{room.name}' ===\n"
-            for user_name in room.users:
-                if user_name == room.admin:
-                    result += f"👑 {user_name} (Администратор)\n"
-                else:
-                    result += f"👤 {user_name}\n"
+            # Обновить пользователя
+            user = self.users.cached(username)
+            if user:
+                user.current_room = None
             
-            result += f"\nВсего пользователей: {len(room.users)}"
-            return result
+            self.sessions.leave_room(username, room_id)
+            return f"Вы покинули комнату '{room.name}'"
+        else:
+            return "Комната не найдена."
+    
+    def command_users(self, username: str, parts: List[str]) -> str:
+        """Участники текущей комнаты"""
+        room_id = self.sessions.room_of(username)
+        if not room_id:
+            return "Вы не находитесь ни в одной комнате."
         
-        elif cmd == '/info':
-            if username not in self.user_rooms:
-                return "Вы не находитесь ни в одной комнате."
-            
-            room_id = self.user_rooms[username]
-            if room_id not in self.rooms:
-                return "Комната не найдена."
-            
-            room = self.rooms[room_id]
-            protected = "🔒 Защищена паролем" if room.password else "🔓 Открытая"
-            
-            result = f"""
+        if room_id not in self.rooms:
+            return "Комната не найдена."
+        
+        room = self.rooms[room_id]
+        members = room.member_names()
+        if not members:
+            return "В комнате никого нет."
+        
+        lines = ["", f"=== ПОЛЬЗОВАТЕЛИ В КОМНАТЕ '{room.name}' ==="]
+        for user_name in members:
+            if user_name == room.admin:
+                lines.append(f"👑 {user_name} (Администратор)")
+            else:
+                lines.append(f"👤 {user_name}")
+        
+        lines.append(f"\nВсего пользователей: {len(members)}")
+        return "\n".join(lines)
+    
+    def command_info(self, username: str, parts: List[str]) -> str:
+        """Информация о текущей комнате"""
+        room_id = self.sessions.room_of(username)
+        if not room_id:
+            return "Вы не находитесь ни в одной комнате."
+        
+        if room_id not in self.rooms:
+            return "Комната не найдена."
+        
+        room = self.rooms[room_id]
+        protected = "🔒 Защищена паролем" if room.password else "🔓 Открытая"
+        
+        result = f"""
 === ИНФОРМАЦИЯ О КОМНАТЕ ===
 Название: {room.name}
 ID: {room.room_id}
 Администратор: {room.admin}
 Защита: {protected}
-Пользователей: {len(room.users)}
+Пользователей: {len(room.member_names())}
 Создана: {room.created_at}
 Последняя активность: {room.last_activity.strftime('%Y-%m-%d %H:%M:%S')}
 """
-            return result
+        return result
+    
+    def command_password(self, username: str, parts: List[str]) -> str:
+        """Установить пароль комнаты (только администратор комнаты)"""
+        if len(parts) < 2:
+            return "Использование: /password <новый_пароль>"
         
-        elif cmd == '/password':
-            if len(parts) < 2:
-                return "Использование: /password <новый_пароль>"
-            
-            if username not in self.user_rooms:
-                return "Вы не находитесь ни в одной комнате."
-            
-            room_id = self.user_rooms[username]
-            if room_id not in self.rooms:
-                return "Комната не найдена."
-            
-            room = self.rooms[room_id]
-            
-            # Проверка прав администратора
-            if room.admin != username:
-                return "Только администратор комнаты может изменять пароль."
-            
-            new_password = parts[1]
-            old_protected = bool(room.password)
-            room.password = new_password
-            
-            if old_protected:
-                room.broadcast_message(f"Администратор {username} изменил пароль комнаты", "SYSTEM")
-                return f"Пароль комнаты изменён на: {new_password}"
-            else:
-                room.broadcast_message(f"Администратор {username} установил пароль для комнаты", "SYSTEM")
-                return f"Пароль комнаты установлен: {new_password}"
+        room_id = self.sessions.room_of(username)
+        if not room_id:
+            return "Вы не находитесь ни в одной комнате."
         
-        elif cmd == '/kick':
-            if len(parts) < 2:
-                return "Использование: /kick <пользователь>"
-            
-            if username not in self.user_rooms:
-                return "Вы не находитесь ни в одной комнате."
-            
-            room_id = self.user_rooms[username]
-            if room_id not in self.rooms:
-                return "Комната не найдена."
-            
-            room = self.rooms[room_id]
-            
-            # Проверка прав администратора
-            if room.admin != username:
-                return "Только администратор комнаты может исключать пользователей."
-            
-            target_user = parts[1].lower()
-            
-            if target_user == username:
-                return "Вы не можете исключить самого себя."
-            
-            if target_user not in room.users:
-                return f"Пользователь {target_user} не найден в комнате."
-            
-            # Исключить пользователя
-            room.remove_user(target_user)
-            if target_user in self.user_rooms:
-                del self.user_rooms[target_user]
-            
-            # Уведомления
+        if room_id not in self.rooms:
+            return "Комната не найдена."
+        
+        room = self.rooms[room_id]
+        
+        # Проверка прав администратора
+        if room.admin != username:
+            return "Только администратор комнаты может изменять пароль."
+        
+        new_password = parts[1]
+        old_protected = bool(room.password)
+        room.password = new_password
+        self.room_directory.set_protected(room_id, True)
+        self.mark_room(room)
+        self.publish({'type': 'room_password', 'room_id': room_id, 'password': new_password})
+        
+        if old_protected:
+            room.broadcast_message(f"Администратор {username} изменил пароль комнаты", "SYSTEM")
+            return f"Пароль комнаты изменён на: {new_password}"
+        else:
+            room.broadcast_message(f"Администратор {username} установил пароль для комнаты", "SYSTEM")
+            return f"Пароль комнаты установлен: {new_password}"
+    
+    def command_kick(self, username: str, parts: List[str]) -> str:
+        """Исключить участника (только администратор комнаты)"""
+        if len(parts) < 2:
+            return "Использование: /kick <пользователь>"
+        
+        room_id = self.sessions.room_of(username)
+        if not room_id:
+            return "Вы не находитесь ни в одной комнате."
+        
+        if room_id not in self.rooms:
+            return "Комната не найдена."
+        
+        room = self.rooms[room_id]
+        
+        # Проверка прав администратора
+        if room.admin != username:
+            return "Только администратор комнаты может исключать пользователей."
+        
+        target_user = parts[1].lower()
+        
+        if target_user == username:
+            return "Вы не можете исключить самого себя."
+        
+        if not room.has_member(target_user):
+            return f"Пользователь {target_user} не найден в комнате."
+        
+        # Участник подключен к другому воркеру - исключение выполнит его процесс
+        if not room.has_local_member(target_user):
+            room.set_remote_member(target_user, None)
+            self.publish({'type': 'room_kick', 'room_id': room_id, 'username': target_user, 'by': username})
             room.broadcast_message(f"Пользователь {target_user} был исключён администратором", "SYSTEM")
-            
-            # Отправить уведомление исключённому пользователю
-            if target_user in self.user_sockets:
-                try:
-                    self.user_sockets[target_user].send(f"Вы были исключены из комнаты '{room.name}' администратором {username}".encode('utf-8'))
-                except:
-                    pass
-            
             return f"Пользователь {target_user} исключён из комнаты."
-                
-        # ... остальные команды
         
-        else:
-            return f"Неизвестная команда: {cmd}. Используйте /help для справки."
-    
-    def get_room_list(self) -> List[dict]:
-        """Получить список комнат"""
-        room_list = []
-        for room in self.rooms.values():
-            room_info = {
-                'id': room.room_id,
-                'name': room.name,
-                'admin': room.admin,
-                'users': len(room.users),
-                'protected': bool(room.password),
-                'created': room.created_at
-            }
-            room_list.append(room_info)
-        return room_list
+        # Исключить пользователя
+        room.remove_user(target_user)
+        self.publish_membership(room_id, target_user, False)
+        self.sessions.leave_room(target_user, room_id)
+        
+        # Уведомления
+        room.broadcast_message(f"Пользователь {target_user} был исключён администратором", "SYSTEM")
+        
+        # Отправить уведомление исключённому пользователю
+        target_conn = self.sessions.conn_of(target_user)
+        if target_conn:
+            try:
+                target_conn.send_text(f"Вы были исключены из комнаты '{room.name}' администратором {username}")
+            except:
+                pass
+        
+        return f"Пользователь {target_user} исключён из комнаты."
+    
+    def prepare_room(self, room: ChatRoom):
+        """Назначить комнате поток-владелец, подключить шину событий и пул рассылки"""
+        if self.fanout_pool:
+            # До назначения потока-владельца, чтобы не ждать его для каждой комнаты
+            room.attach_fanout(self.fanout_pool)
+        if self.room_executors:
+            room.executor = self.room_executors.for_room(room.room_id)
+        if self.bus:
+            room.on_broadcast = self.on_room_broadcast
+        room.on_change = self.mark_room
+        room.on_listing = self.room_directory.update
+        room.log = self.message_log.room(room.room_id)
         
+    def mark_room(self, room: ChatRoom):
+        """Пометить комнату для записи; снимок при сбросе снимает ее поток-владелец"""
+        self.room_store.mark(room)
+    
+    def publish(self, event: Dict):
+        """Опубликовать событие для остальных воркеров"""
+        if self.bus:
+            self.bus.publish(event)
+    
+    def publish_membership(self, room_id: str, username: str, joined: bool):
+        self.publish({'type': 'room_member', 'room_id': room_id, 'username': username, 'joined': joined})
+    
+    def on_room_broadcast(self, room: ChatRoom, record: MessageRecord):
+        self.publish({'type': 'room_message', 'room_id': room.room_id, **record.to_dict()})
+    
+    def start_bus(self):
+        """Начать прием событий от других воркеров"""
+        if self.bus:
+            self.bus.start(self.apply_bus_event)
+    
+    def apply_bus_event(self, event: Dict):
+        """Применить событие, полученное от другого воркера"""
+        handler = getattr(self, f"on_bus_{event.get('type')}", None)
+        if handler:
+            handler(event)
+    
+    def on_bus_room_created(self, event: Dict):
+        if event['room_id'] not in self.rooms:
+            room = ChatRoom(event['room_id'], event['name'], event['admin'], event.get('password'))
+            self.prepare_room(room)
+            self.rooms[room.room_id] = room
+            self.room_directory.add(room)
+            self.mark_room(room)
+            self.stats['rooms_created'].inc()
+    
+    def on_bus_room_deleted(self, event: Dict):
+        self.rooms.pop(event['room_id'], None)
+        self.room_directory.remove(event['room_id'])
+        self.message_log.remove(event['room_id'])
+    
+    def on_bus_room_password(self, event: Dict):
+        room = self.rooms.get(event['room_id'])
+        if room:
+            room.password = event['password']
+            self.room_directory.set_protected(room.room_id, bool(room.password))
+            self.mark_room(room)
+    
+    def on_bus_room_message(self, event: Dict):
+        room = self.rooms.get(event['room_id'])
+        if room:
+            room.receive_remote(event)
+    
+    def on_bus_room_member(self, event: Dict):
+        room = self.rooms.get(event['room_id'])
+        username = event['username']
+        if not room:
+            return
+        if event['joined']:
+            room.set_remote_member(username, event['worker'])
+            self.users.record_room_visit(username, room.room_id, room.name)
+        else:
+            room.set_remote_member(username, None)
+    
+    def on_bus_room_kick(self, event: Dict):
+        room = self.rooms.get(event['room_id'])
+        target_user = event['username']
+        if not room or not room.has_local_member(target_user):
+            return
+        room.remove_user(target_user)
+        self.publish_membership(room.room_id, target_user, False)
+        self.sessions.leave_room(target_user, room.room_id)
+        target_conn = self.sessions.conn_of(target_user)
+        if target_conn:
+            try:
+                target_conn.send_text(f"Вы были исключены из комнаты '{room.name}' администратором {event['by']}")
+            except:
+                pass
+    
+    def on_bus_user_registered(self, event: Dict):
+        user = User.from_dict(event['user'])
+        if user.username not in self.users:
+            self.users.add(user)
+    
+    def on_bus_user_login(self, event: Dict):
+        user = self.users.get(event['username'])
+        if user:
+            user.last_login = event['last_login']
+            if 'password_hash' in event:
+                user.password_hash = event['password_hash']
+            self.users.save_login(user)
+    
+    def on_bus_user_message(self, event: Dict):
+        self.users.record_message(event['username'], event['room_id'], event['message'])
+    
     def start_server(self):
         """Запустить сервер"""
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.bus:
+            # Несколько воркеров слушают один порт, ядро распределяет подключения
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         
         try:
             self.server_socket.bind((self.host, self.port))
             self.server_socket.listen(MAX_CONNECTIONS)
             self.running = True
+            self.start_bus()
+            self.start_handshake_workers()
+            self.start_background_tasks()
             
-            self.logger.info(f"Сервер запущен на {self.host}:{self.port}")
-            self.logger.info(f"Максимум подключений: {MAX_CONNECTIONS}")
-            self.logger.info(f"Загружено комнат: {len(self.rooms)}")
+            self.logger.info("Сервер запущен на %s:%s", self.host, self.port)
+            self.logger.info("Максимум подключений: %s", MAX_CONNECTIONS)
+            self.logger.info("Загружено комнат: %s", len(self.rooms))
             
             while self.running:
                 try:
@@ -1136,18 +4641,20 @@ ID: {room.room_id}
                         break
                         
                     # Проверить лимит подключений
-                    if len(self.user_sockets) >= MAX_CONNECTIONS:
-                        client_socket.send("Сервер перегружен. Попробуйте позже.".encode('utf-8'))
-                        client_socket.close()
-                        self.logger.warning(f"Отклонено подключение от {address}: превышен лимит подключений")
+                    if len(self.sessions) >= MAX_CONNECTIONS:
+                        self.reject_connection(client_socket, "Сервер перегружен. Попробуйте позже.")
+                        self.logger.warning("Отклонено подключение от %s: превышен лимит подключений", address)
                         continue
                     
-                    client_thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket, address),
-                        daemon=True
-                    )
-                    client_thread.start()
+                    # Поток не создается: подключение ждет свободный поток этапа аутентификации
+                    reason = self.admission.admit(address[0])
+                    if reason:
+                        self.reject_connection(client_socket, reason)
+                        self.logger.debug("Отклонено подключение от %s: %s", address, reason)
+                        continue
+                    configure_keepalive(client_socket)
+                    client_socket.settimeout(AUTH_TIMEOUT)
+                    self.handshake_queue.put((client_socket, address, time.monotonic()))
                     
                 except socket.timeout:
                     continue
@@ -1157,10 +4664,10 @@ ID: {room.room_id}
                     break
                 except Exception as e:
                     if self.running:
-                        self.logger.error(f"Неожиданная ошибка сервера: {e}")
+                        self.logger.error("Неожиданная ошибка сервера: %s", e)
                         
         except Exception as e:
-            self.logger.error(f"Критическая ошибка сервера: {e}")
+            self.logger.error("Критическая ошибка сервера: %s", e)
         finally:
             self.shutdown()
             
@@ -1171,6 +4678,11 @@ ID: {room.room_id}
             
         self.logger.info("Начинается завершение работы сервера...")
         self.running = False
+        if self.scheduler:
+            self.scheduler.shutdown()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
         
         # Закрыть серверный сокет
         if self.server_socket:
@@ -1181,10 +4693,10 @@ ID: {room.room_id}
                 
         # Уведомить всех пользователей
         shutdown_msg = "Сервер завершает работу. Соединение будет разорвано."
-        for username, sock in list(self.user_sockets.items()):
+        for session in self.sessions.all():
             try:
-                sock.send(shutdown_msg.encode('utf-8'))
-                sock.close()
+                session.conn.send_text(shutdown_msg)
+                session.conn.close()
             except:
                 pass
                 
@@ -1193,38 +4705,406 @@ ID: {room.room_id}
             self.save_data()
             self.logger.info("Данные сохранены")
         except Exception as e:
-            self.logger.error(f"Ошибка сохранения данных при завершении: {e}")
+            self.logger.error("Ошибка сохранения данных при завершении: %s", e)
+        
+        if self.bus:
+            self.bus.close()
+        self.password_hasher.shutdown()
+        self.room_store.close()
+        self.users.close()
+        self.message_log.close()
             
         # Логировать финальную статистику
         uptime = datetime.datetime.now() - self.stats['start_time']
-        self.logger.info(f"Сервер проработал: {uptime}")
-        self.logger.info(f"Обслужено подключений: {self.stats['total_connections']}")
-        self.logger.info(f"Отправлено сообщений: {self.stats['messages_sent']}")
+        self.logger.info("Сервер проработал: %s", uptime)
+        self.logger.info("Обслужено подключений: %s", self.stats['total_connections'].value())
+        self.logger.info("Отправлено сообщений: %s", self.stats['messages_sent'].value())
         self.logger.info("Сервер остановлен")
+        self.stop_logging()
 
-if __name__ == "__main__":
-    import sys
+class AsyncClientConnection(BaseConnection):
+    """Подключение клиента в asyncio режиме поверх StreamReader/StreamWriter.
+
+    Очередь исходящих кадров опустошает отдельная задача-писатель подключения:
+    накопленные кадры уходят одним writelines(), а drain() ограничивает скорость
+    только этого подключения, не задерживая event loop и других клиентов.
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, address, policy: OutboundPolicy):
+        super().__init__(address, policy)
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+        self.writer_task = self.loop.create_task(self.writer_worker())
+
+    def wake_writer(self):
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            self.ready.set()
+        else:
+            # Отправка из другого потока (шина событий, пул рассылки)
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    def abort_transport(self):
+        self.writer.transport.abort()
+
+    def fileno(self) -> int:
+        sock = self.writer.get_extra_info('socket')
+        return sock.fileno() if sock else -1
+
+    async def writer_worker(self):
+        """Задача записи: отправляет накопленные кадры одним writelines()"""
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                batch = self.take_batch()
+                while batch:
+                    self.writer.writelines(batch)
+                    await self.writer.drain()
+                    batch = self.take_batch()
+                if self.closing and not self.pending:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self.writer.close()
+
+    async def recv_message(self, limit: int) -> Optional[str]:
+        """Получить следующее сообщение клиента, None при закрытии соединения"""
+        if self.protocol == PROTOCOL_LEGACY:
+            data = await self.reader.read(limit)
+            self.last_seen = time.monotonic()
+            return data.decode('utf-8') if data else None
+        
+        try:
+            while True:
+                header = await self.reader.readexactly(FRAME_HEADER.size)
+                length, frame_type = FRAME_HEADER.unpack(header)
+                if length > limit:
+                    raise ProtocolError(f"Кадр слишком большой: {length} байт")
+                payload = await self.reader.readexactly(length)
+                self.last_seen = time.monotonic()
+                if frame_type in (FRAME_TEXT, FRAME_AUTH):
+                    return payload.decode('utf-8')
+                self.control_frame(frame_type, payload.decode('utf-8'))
+        except asyncio.IncompleteReadError:
+            return None
+
+class AsyncChatServer(ChatServer):
+    """Сервер на asyncio: все подключения обслуживает один event loop.
+
+    Набор команд, аутентификация и сохранение данных те же, что и в ChatServer,
+    но вместо потока на каждое подключение используется корутина. Это позволяет
+    держать десятки тысяч неактивных соединений в одном процессе.
+    """
+    def __init__(self, host=HOST, port=PORT, worker_id: int = 0, bus: Optional[EventBus] = None):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stop_event: Optional[asyncio.Event] = None
+        self.handshake_slots: Optional[asyncio.Semaphore] = None
+        self.dirty_rooms: Dict[str, ChatRoom] = {}  # Комнаты, ждущие снимка в потоке event loop
+        super().__init__(host, port, worker_id, bus)
+
+    def start_server(self):
+        """Запустить сервер"""
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            self.logger.error("Критическая ошибка сервера: %s", e)
+        finally:
+            self.shutdown()
+
+    async def serve(self):
+        """Основной цикл asyncio сервера"""
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.handshake_slots = asyncio.Semaphore(max(1, HANDSHAKE_WORKERS))
+        self.server_socket = await asyncio.start_server(
+            self.handle_client_async,
+            self.host,
+            self.port,
+            backlog=MAX_CONNECTIONS,
+            reuse_address=True,
+            reuse_port=bool(self.bus)
+        )
+        self.running = True
+        self.start_bus()
+        self.start_background_tasks()
+        
+        self.logger.info("Сервер (asyncio) запущен на %s:%s", self.host, self.port)
+        self.logger.info("Максимум подключений: %s", MAX_CONNECTIONS)
+        self.logger.info("Загружено комнат: %s", len(self.rooms))
+        
+        async with self.server_socket:
+            await self.stop_event.wait()
+
+    def create_fanout_pool(self) -> Optional[FanoutPool]:
+        """В asyncio режиме отправка - это добавление в очередь подключения в потоке
+        event loop, а пробуждение писателей из других потоков стоило бы дороже самой
+        рассылки, поэтому пул не используется"""
+        return None
+
+    def create_room_executors(self) -> Optional[RoomExecutors]:
+        """Состоянием всех комнат владеет поток event loop"""
+        return None
+
+    def mark_room(self, room: ChatRoom):
+        """У комнат нет потоков-владельцев, их состоянием владеет event loop, поэтому
+        поток записи не может снять снимок сам. Снимки снимаются в event loop не
+        чаще раза в FLUSH_INTERVAL и передаются на запись готовыми строками."""
+        if self.loop is None:
+            # Загрузка данных до запуска event loop
+            self.room_store.mark(room, room.to_dict())
+            return
+        if not self.dirty_rooms:
+            self.loop.call_later(FLUSH_INTERVAL, self.snapshot_rooms)
+        self.dirty_rooms[room.room_id] = room
+        
+    def snapshot_rooms(self):
+        """Передать на запись снимки помеченных комнат (в потоке event loop)"""
+        rooms, self.dirty_rooms = self.dirty_rooms, {}
+        for room_id, room in rooms.items():
+            # Удаленная комната уже помечена к удалению, снимок ее бы вернул
+            if self.rooms.get(room_id) is room:
+                self.room_store.mark(room, room.to_dict())
+                
+    def owner_job(self, func):
+        """Подключениями и комнатами владеет event loop (в том числе разрыв
+        транспорта допустим только из его потока) - передать задачу ему.
+        Поток планировщика ждет ее завершения, поэтому защита от перекрытия
+        запусков, время выполнения и ошибки задачи учитываются как обычно."""
+        def job():
+            future = concurrent.futures.Future()
+            
+            def run():
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    future.set_result(func())
+                except BaseException as e:
+                    future.set_exception(e)
+                    
+            self.loop.call_soon_threadsafe(run)
+            while True:
+                try:
+                    return future.result(timeout=1.0)
+                except concurrent.futures.TimeoutError:
+                    # Остановленный event loop задачу уже не выполнит
+                    if not self.running and future.cancel():
+                        return
+        return job
+
+    def start_bus(self):
+        """События шины применяются в потоке event loop"""
+        if self.bus:
+            self.bus.start(lambda event: self.loop.call_soon_threadsafe(self.apply_bus_event, event))
+
+    def shutdown(self):
+        """Корректное завершение работы сервера"""
+        was_running = self.running
+        if was_running:
+            # Вызывается в потоке event loop (обработчик сигнала или выход из serve)
+            self.snapshot_rooms()
+        super().shutdown()
+        if was_running and self.loop and self.stop_event:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    async def handle_client_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Обработать подключение клиента (корутина на каждое подключение)"""
+        address = writer.get_extra_info('peername')
+        
+        # Проверить лимит подключений и допуск на этап аутентификации
+        if len(self.sessions) >= MAX_CONNECTIONS:
+            reason = "Сервер перегружен. Попробуйте позже."
+            self.logger.warning("Отклонено подключение от %s: превышен лимит подключений", address)
+        else:
+            reason = self.admission.admit(address[0])
+        if reason:
+            writer.write(reason.encode('utf-8'))
+            writer.close()
+            return
+        configure_keepalive(writer.get_extra_info('socket'))
+        accepted_at = time.monotonic()
+        
+        conn = None
+        username = None
+        try:
+            try:
+                username, conn = await self.run_handshake_async(reader, writer, address, accepted_at)
+            finally:
+                self.admission.release(address[0])
+            if not username:
+                return
+            
+            user = self.login_user(username, conn)
+            LOGIN_DURATION.observe(time.monotonic() - conn.accepted_at)
+            self.stats['total_connections'].inc()
+            
+            self.log_action('CONNECT', "%(user)s подключился с %(address)s", user=username, address=address)
+            self.logger.info("Пользователь %s подключился с %s", username, address)
+            
+            conn.send_texts(self.get_welcome_messages(user, username))
+            self.watch_idle(conn)
+            
+            # Основной цикл обработки сообщений
+            while self.running:
+                message = await conn.recv_message(MAX_MESSAGE_LENGTH)
+                if not message:
+                    break
+                delay = self.throttle(username, message, conn)
+                if delay is None:
+                    continue
+                if delay:
+                    await asyncio.sleep(delay)
+                self.process_client_message(username, user, message, conn)
+                
+        except ConnectionError:
+            pass
+        except Exception as e:
+            self.logger.error("Ошибка обработки клиента %s: %s", address, e)
+            self.logger.debug("Traceback:", exc_info=True)
+        finally:
+            if username:
+                self.log_action('DISCONNECT', "%(user)s отключился", user=username)
+                self.logger.info("Пользователь %s отключился", username)
+                self.cleanup_user(username, conn)
+            if conn:
+                conn.close()
+            else:
+                writer.close()
+
+    async def run_handshake_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, address,
+                                  accepted_at: float):
+        """Дождаться свободного места на этапе аутентификации и провести диалог входа"""
+        try:
+            await asyncio.wait_for(self.handshake_slots.acquire(), AUTH_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.admission.count_timeout()
+            writer.write("Сервер перегружен. Попробуйте позже.".encode('utf-8'))
+            return None, None
+        try:
+            conn = AsyncClientConnection(reader, writer, address, self.outbound_policy)
+            conn.accepted_at = accepted_at
+            return await self.authenticate_client_async(conn, address), conn
+        finally:
+            self.handshake_slots.release()
+
+    async def authenticate_client_async(self, conn: AsyncClientConnection, address) -> Optional[str]:
+        """Аутентификация клиента с таймаутом на каждый шаг диалога"""
+        try:
+            dialog = self.auth_dialog(address)
+            reply = None
+            while True:
+                try:
+                    prompt = dialog.send(reply)
+                except StopIteration as done:
+                    username, final_message = done.value
+                    conn.send_text(final_message, FRAME_AUTH)
+                    return username
+                
+                if isinstance(prompt, concurrent.futures.Future):
+                    reply = await asyncio.wrap_future(prompt)
+                    continue
+                conn.send_text(prompt, FRAME_AUTH)
+                reply = await asyncio.wait_for(conn.recv_message(1024), AUTH_TIMEOUT)
+                if reply is None:
+                    return None
+                if prompt == "AUTH_REQUIRED":
+                    reply = negotiate_protocol(conn, reply)
+                
+        except asyncio.TimeoutError:
+            self.admission.count_timeout()
+            self.logger.warning("Таймаут аутентификации клиента %s", address)
+            return None
+        except Exception as e:
+            self.logger.error("Ошибка аутентификации клиента %s: %s", address, e)
+            return None
+
+SERVER_CLASSES = {
+    'threaded': ChatServer,
+    'asyncio': AsyncChatServer,
+}
+
+def parse_args():
+    """Разобрать аргументы командной строки"""
+    parser = argparse.ArgumentParser(description="Production сервер терминального чата")
+    parser.add_argument('port', nargs='?', type=int, default=PORT, help="порт сервера")
+    parser.add_argument('host', nargs='?', default=HOST, help="адрес для прослушивания")
+    parser.add_argument('--mode', choices=sorted(SERVER_CLASSES), default=SERVER_MODE,
+                        help="режим работы: поток на подключение или asyncio event loop")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="количество процессов-воркеров на одном порту (SO_REUSEPORT)")
+    return parser.parse_args()
+
+def run_worker(args, worker_id: int):
+    """Запустить сервер в дочернем процессе-воркере"""
+    bus = EventBus(BUS_SOCKET, worker_id)
+    server = SERVER_CLASSES[args.mode](host=args.host, port=args.port, worker_id=worker_id, bus=bus)
+    try:
+        server.start_server()
+    finally:
+        server.shutdown()
+
+def run_workers(args):
+    """Запустить N воркеров на одном порту с общей шиной событий между ними"""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        print("SO_REUSEPORT не поддерживается на этой платформе")
+        sys.exit(1)
+    
+    hub = EventBusHub(BUS_SOCKET)
+    children: Dict[int, int] = {}
+    for worker_id in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            hub.close_listener()
+            exit_code = 0
+            try:
+                run_worker(args, worker_id)
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            os._exit(exit_code)
+        children[pid] = worker_id
+    
+    hub.start()
     
-    # Обработка аргументов командной строки
-    host = HOST
-    port = PORT
+    def stop_workers(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
     
-    if len(sys.argv) > 1:
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+    
+    # Дождаться завершения всех воркеров
+    while children:
         try:
-            port = int(sys.argv[1])
-        except ValueError:
-            print("Неверный номер порта")
-            sys.exit(1)
-            
-    if len(sys.argv) > 2:
-        host = sys.argv[2]
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        children.pop(pid, None)
+    
+    hub.close()
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    if args.workers > 1:
+        run_workers(args)
+        sys.exit(0)
     
     # Создать и запустить сервер
-    server = ChatServer(host=host, port=port)
+    server = SERVER_CLASSES[args.mode](host=args.host, port=args.port)
     try:
         server.start_server()
     except KeyboardInterrupt:
         print("\nПолучен сигнал прерывания...")
     finally:
         server.shutdown()
-        sys.exit(0)
\ No newline at end of file
+        sys.exit(0)
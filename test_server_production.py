@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Тесты компонентов server_production.py: журнал сообщений, поисковый индекс,
+ограничение частоты, каталог комнат, история в памяти и протокол v2
+"""
+
+import array
+import datetime
+import os
+import socket
+import threading
+
+import server_production as chat
+
+
+def write_messages(directory, count, writable=True):
+    """Журнал комнаты с count сообщениями от alice и bob"""
+    log = chat.MessageLog(str(directory), writable).room('room')
+    for number in range(1, count + 1):
+        sender = 'alice' if number % 2 else 'bob'
+        log.append(chat.MessageRecord(f"{sender}: сообщение {number}", sender).to_dict())
+    return log
+
+def search(log, query, before=None):
+    keys, _ = chat.RoomSearchIndex.parse_query(query)
+    return list(log.search.candidates(keys, before))
+
+def run_with_timeout(func, timeout=5):
+    """Выполнить func в потоке; зависание - ошибка теста, а не зависший прогон"""
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('value', func()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "операция не завершилась"
+    return result.get('value')
+
+
+def test_search_catch_up_on_read_only_log(tmp_path, monkeypatch):
+    """Читающий воркер индексирует журнал длиннее сегмента без сегментов основного"""
+    monkeypatch.setattr(chat, 'SEARCH_SEGMENT_MESSAGES', 100)
+    write_messages(tmp_path, 250)
+    reader = chat.MessageLog(str(tmp_path), False).room('room')
+    run_with_timeout(reader.search.catch_up)
+    assert reader.search.indexed_seq == 250
+    assert reader.search.segments == []
+    assert search(reader, 'сообщение 250') == [250]
+    assert len(search(reader, 'from:bob')) == 125
+
+def test_search_reader_uses_writer_segments(tmp_path, monkeypatch):
+    """Сегменты основного процесса заменяют проиндексированное читающим в памяти"""
+    monkeypatch.setattr(chat, 'SEARCH_SEGMENT_MESSAGES', 100)
+    writer = write_messages(tmp_path, 150)
+    reader = chat.MessageLog(str(tmp_path), False).room('room')
+    run_with_timeout(reader.search.catch_up)
+    for number in range(151, 251):
+        writer.append(chat.MessageRecord(f"alice: сообщение {number}", 'alice').to_dict())
+    run_with_timeout(writer.search.catch_up)
+    assert [(segment.first_seq, segment.last_seq) for segment in writer.search.segments] == [(1, 100), (101, 200)]
+    assert writer.search.pending_first == 201
+
+    run_with_timeout(reader.search.catch_up)
+    assert len(reader.search.segments) == 2
+    assert reader.search.pending_first == 201
+    assert search(reader, 'сообщение') == list(range(250, 0, -1))
+
+def test_search_segment_round_trip(tmp_path):
+    """Сегмент возвращает записанные списки, префикс объединяет термины"""
+    postings = {
+        'привет': array.array('I', [101, 105, 190]),
+        'пример': array.array('I', [102, 105]),
+        'мир': array.array('I', [150]),
+        chat.SENDER_TERM + 'alice': array.array('I', [101, 102]),
+    }
+    path = str(tmp_path / '101-200.sidx')
+    segment = chat.SearchSegment.write(path, 101, 200, postings)
+    keys = [('привет', False), ('при', True), ('мир', False), ('мирный', False),
+            (chat.SENDER_TERM + 'alice', False), ('п', False)]
+    assert [list(seqs) for seqs in segment.postings(keys)] == [[0, 4, 89], [0, 1, 4, 89], [49], [], [0, 1], []]
+    assert not os.path.exists(path + '.tmp')
+
+def test_search_query_parsing():
+    """Разбор запроса: слова, фразы, префиксы и отправитель"""
+    keys, phrases = chat.RoomSearchIndex.parse_query('Ёлка "Новый  год" прив* from:Alice @bob a* from:')
+    assert keys == [('елка', False), ('новый', False), ('год', False), ('прив', True),
+                    (chat.SENDER_TERM + 'alice', False), (chat.SENDER_TERM + 'bob', False), ('a', False)]
+    assert phrases == [['новый', 'год']]
+    assert chat.tokenize('ПРИВЕТ, Ёжик! ﬁle') == ['привет', 'ежик', 'file']
+
+def test_intersect_newest():
+    """Пересечение списков от новых к старым, только меньше before"""
+    lists = [array.array('I', [1, 3, 5, 7, 9]), array.array('I', [3, 4, 5, 9]), array.array('I', [2, 3, 5, 6, 9, 10])]
+    assert list(chat.intersect_newest(lists, 100)) == [9, 5, 3]
+    assert list(chat.intersect_newest(lists, 9)) == [5, 3]
+    assert list(chat.intersect_newest(lists + [array.array('I')], 100)) == []
+
+
+def fill_history(history, count, start=0):
+    for number in range(start, start + count):
+        history.append(chat.MessageRecord(f"сообщение {number}", f"user{number % 3}", created=1000.0 + number))
+    return history
+
+def test_columnar_history_wraparound():
+    """После заполнения вытесняются самые старые сообщения, порядок сохраняется"""
+    history = fill_history(chat.ColumnarHistory(5), 12)
+    assert len(history) == 5
+    assert [record.text for record in history] == [f"сообщение {number}" for number in range(7, 12)]
+    assert [record.sender for record in history.last(2)] == ['user1', 'user2']
+    assert [record.created for record in history.last(1)] == [1011.0]
+    assert [entry[0] for entry in history.entries(3)] == [10, 11, 12]
+
+def test_columnar_history_compaction():
+    """Тексты вытесненных сообщений удаляются из буфера, он не растет без границы"""
+    history = fill_history(chat.ColumnarHistory(4), 1000)
+    live = sum(len(f"сообщение {number}".encode('utf-8')) for number in range(996, 1000))
+    assert len(history.body) <= 2 * live + 64
+    assert history.base > 0
+    assert [record.text for record in history] == [f"сообщение {number}" for number in range(996, 1000)]
+
+def test_columnar_history_append_during_iteration():
+    """Незаконченный обход истории не блокирует добавление"""
+    history = fill_history(chat.ColumnarHistory(4), 10)
+    records = history.last(4)
+    next(records)
+    fill_history(history, 10, start=10)
+    assert [record.text for record in history.last(1)] == ["сообщение 19"]
+    assert history.lines(1)[0].endswith("user1: сообщение 19".encode('utf-8'))
+
+def test_history_storage_grows_lazily():
+    """Пустая история не резервирует емкость; после заполнения - кольцо"""
+    ring = chat.MessageRing(5)
+    columnar = chat.ColumnarHistory(5)
+    assert ring.items == [] and len(columnar.created) == 0
+    for history in (ring, columnar):
+        fill_history(history, 3)
+        assert len(history) == 3
+        fill_history(history, 9, start=3)
+        assert len(history) == 5
+        assert [record.text for record in history] == [f"сообщение {number}" for number in range(7, 12)]
+    assert len(ring.items) == 5 and len(columnar.created) == 5
+
+def test_password_hash_above_openssl_memory_default(monkeypatch):
+    """N = 2**15 требует больше 32 МБ памяти OpenSSL по умолчанию"""
+    monkeypatch.setattr(chat, 'PASSWORD_SCRYPT_N', 2 ** 15)
+    stored = chat.hash_password('секрет')
+    assert chat.verify_password(stored, 'секрет') == (True, None)
+    assert chat.verify_password(stored, 'другой') == (False, None)
+    monkeypatch.setattr(chat, 'PASSWORD_SCRYPT_N', 2 ** 14)
+    valid, new_hash = chat.verify_password(stored, 'секрет')
+    assert valid and new_hash.startswith('scrypt$16384$')
+
+def test_user_store_miss_flushes_only_own_changes(tmp_path, monkeypatch):
+    """Промах кэша сбрасывает изменения, только если среди них есть изменения этого пользователя"""
+    monkeypatch.setattr(chat, 'FLUSH_INTERVAL', 3600)
+    monkeypatch.setattr(chat, 'USER_CACHE_SIZE', 1)
+    store = chat.UserStore(str(tmp_path / 'users.db'))
+    try:
+        store.add(chat.User('alice', 'hash'))
+        store.flush()
+        store.add(chat.User('bob', 'hash'))  # вытесняет alice из кэша, bob не записан
+        flushes = store.writes.metrics['flushes']
+        assert store.get('alice').username == 'alice'
+        assert store.writes.metrics['flushes'] == flushes
+
+        store.record_message('bob', 'room', 'привет')
+        store.add(chat.User('carol', 'hash'))  # вытесняет bob
+        user = store.get('bob')
+        assert store.writes.metrics['flushes'] == flushes + 1
+        assert [record.text for record in user.message_history] == ['привет']
+    finally:
+        store.close()
+
+def test_message_log_remove_deletes_room_files(tmp_path):
+    """Удаление комнаты закрывает журнал, забывает его и удаляет каталог с индексом"""
+    messages = chat.MessageLog(str(tmp_path), True)
+    log = messages.room('room')
+    log.append(chat.MessageRecord("alice: привет", 'alice').to_dict())
+    log.search.catch_up()
+    messages.remove('room')
+    assert not (tmp_path / 'room').exists()
+    assert 'room' not in messages.logs and not messages.open_logs and not messages.unindexed
+    # Запоздалое сообщение не создает каталог заново
+    assert log.append(chat.MessageRecord("alice: поздно", 'alice').to_dict()) == 0
+    assert not (tmp_path / 'room').exists()
+
+def test_room_log_read_seqs_across_segments(tmp_path, monkeypatch):
+    """Выборочное чтение по номерам через несколько сегментов и точки индекса"""
+    monkeypatch.setattr(chat, 'MESSAGE_SEGMENT_BYTES', 2048)
+    monkeypatch.setattr(chat, 'MESSAGE_INDEX_INTERVAL', 4)
+    log = write_messages(tmp_path, 200)
+    assert len(log.snapshot()[0]) > 3
+    wanted = [1, 2, 63, 64, 65, 130, 199, 200, 500]
+    records = log.read_seqs(reversed(wanted))
+    assert sorted(records) == wanted[:-1]
+    assert all(records[seq]['message'].endswith(f"сообщение {seq}") for seq in records)
+
+def test_frames_split_and_joined():
+    """Кадры v2 собираются из произвольных кусков и разбираются из склеенного потока"""
+    stream = (chat.encode_message("привет", chat.PROTOCOL_FRAMED)
+              + chat.encode_message("пароль", chat.PROTOCOL_FRAMED, chat.FRAME_AUTH)
+              + chat.encode_messages(["раз", "два"], chat.PROTOCOL_FRAMED))
+    buffer = bytearray()
+    frames = []
+    for position in range(0, len(stream), 3):
+        buffer += stream[position:position + 3]
+        while True:
+            frame = chat.take_frame(buffer, 1024)
+            if frame is None:
+                break
+            frames.append(frame)
+    assert frames == [(chat.FRAME_TEXT, "привет"), (chat.FRAME_AUTH, "пароль"),
+                      (chat.FRAME_TEXT, "раз"), (chat.FRAME_TEXT, "два")]
+    assert buffer == bytearray()
+
+def test_frame_over_limit_rejected():
+    buffer = bytearray(chat.encode_message("x" * 100, chat.PROTOCOL_FRAMED))
+    try:
+        chat.take_frame(buffer, 10)
+    except chat.ProtocolError:
+        pass
+    else:
+        raise AssertionError("кадр больше лимита принят")
+
+def test_legacy_messages_joined_with_newlines():
+    assert chat.encode_messages(["раз", "два"], chat.PROTOCOL_LEGACY) == "раз\nдва".encode('utf-8')
+    assert chat.encode_messages(["раз", "два".encode('utf-8')], chat.PROTOCOL_LEGACY) == "раз\nдва".encode('utf-8')
+
+def queued_wire_bytes(protocol, texts):
+    """Поставить texts в очередь подключения до пробуждения писателя и вернуть
+    байты, которые писатель отправил одной записью"""
+    server_side, client_side = socket.socketpair()
+    conn = chat.ClientConnection(server_side, 'test', chat.OutboundPolicy(1 << 20, 1000, 'drop_oldest'))
+    conn.protocol = protocol
+    conn.wake_writer = lambda: None
+    for text in texts:
+        conn.send(chat.encode_message(text, protocol), chat.QUEUED_CHAT)
+    expected = len(chat.encode_messages(texts, protocol))
+    conn.wakeup.set()
+    client_side.settimeout(5)
+    data = b''
+    while len(data) < expected:
+        data += client_side.recv(65536)
+    conn.close()
+    conn.wakeup.set()
+    client_side.close()
+    return data
+
+def test_legacy_queued_sends_separated_on_wire():
+    """Пакет очереди текстового подключения не склеивает сообщения в одну строку"""
+    texts = [f"[12:00:0{number}] alice: msg {number}" for number in range(3)]
+    assert queued_wire_bytes(chat.PROTOCOL_LEGACY, texts) == '\n'.join(texts).encode('utf-8')
+    assert queued_wire_bytes(chat.PROTOCOL_FRAMED, texts) == chat.encode_messages(texts, chat.PROTOCOL_FRAMED)
+
+def test_room_log_rollover_and_reopen(tmp_path, monkeypatch):
+    """Журнал переходит на новые сегменты, читается через их границы и после
+    повторного открытия продолжает нумерацию"""
+    monkeypatch.setattr(chat, 'MESSAGE_SEGMENT_BYTES', 1024)
+    monkeypatch.setattr(chat, 'MESSAGE_INDEX_INTERVAL', 4)
+    log = write_messages(tmp_path, 100)
+    segments, next_seq = log.snapshot()
+    assert len(segments) > 3 and next_seq == 101
+    messages = [record['message'] for record in log.read(1, 101)]
+    assert messages == [f"{'alice' if number % 2 else 'bob'}: сообщение {number}" for number in range(1, 101)]
+    boundary = segments[2]
+    assert [record['message'][-3:] for record in log.read(boundary - 1, boundary + 1)] == [
+        f"{number:>3}" for number in (boundary - 1, boundary)]
+    page, start = log.page_before(101, 30)
+    assert start == 71 and len(page) == 30
+    log.close()
+
+    reopened = chat.MessageLog(str(tmp_path), True).room('room')
+    assert reopened.last_seq() == 100
+    assert reopened.append(chat.MessageRecord("alice: после", 'alice').to_dict()) == 101
+    assert reopened.read(100, 102)[1]['message'] == "alice: после"
+
+def test_room_log_drops_torn_tail_on_reopen(tmp_path):
+    """Недописанная при сбое запись отрезается, номер не пропускается"""
+    log = write_messages(tmp_path, 10)
+    log.close()
+    path = log.segment_path(log.segments[-1], '.log')
+    with open(path, 'ab') as f:
+        f.write(chat.RoomLog.RECORD.pack(100, 11, 0.0) + b'{"mess')
+    reopened = chat.MessageLog(str(tmp_path), True).room('room')
+    assert reopened.append(chat.MessageRecord("bob: снова", 'bob').to_dict()) == 11
+    assert [record['message'] for record in reopened.read(10, 12)] == ["bob: сообщение 10", "bob: снова"]
+
+def test_room_log_seq_at_time(tmp_path, monkeypatch):
+    """Поиск сообщения по времени через границы сегментов, до начала и после конца журнала"""
+    monkeypatch.setattr(chat, 'MESSAGE_SEGMENT_BYTES', 1024)
+    monkeypatch.setattr(chat, 'MESSAGE_INDEX_INTERVAL', 4)
+    log = chat.MessageLog(str(tmp_path), True).room('room')
+    for number in range(1, 51):
+        log.append(chat.MessageRecord(f"сообщение {number}", 'alice', created=1000.0 + number).to_dict(),
+                   1000.0 + number)
+    assert log.seq_at_time(1030.0) == 30
+    assert log.seq_at_time(0) == 1
+    assert log.seq_at_time(2000.0) == 51
+
+def test_room_log_seq_at_time_reads_few_segment_indexes(tmp_path, monkeypatch):
+    """Сегмент по времени выбирается бисекцией: читающий процесс открывает
+    индексы O(log числа сегментов) и кэширует время начала завершенных сегментов"""
+    monkeypatch.setattr(chat, 'MESSAGE_SEGMENT_BYTES', 256)
+    writer = chat.MessageLog(str(tmp_path), True).room('room')
+    for number in range(1, 401):
+        writer.append(chat.MessageRecord(f"сообщение {number}", 'alice', created=1000.0 + number).to_dict(),
+                      1000.0 + number)
+    reader = chat.MessageLog(str(tmp_path), False).room('room')
+    segments = len(reader.snapshot()[0])
+    assert segments > 100
+    reads = []
+    read_index = reader.read_index
+    monkeypatch.setattr(reader, 'read_index', lambda first_seq, count=-1: reads.append(first_seq) or read_index(first_seq, count))
+    assert reader.seq_at_time(1390.0) == 390
+    assert 0 < len(reads) <= segments.bit_length() + 1
+    reads.clear()
+    assert reader.seq_at_time(1390.0) == 390
+    assert len(reads) <= 1
+    assert writer.seq_at_time(1390.0) == 390
+    assert writer.seq_at_time(1000.5) == 1
+
+def test_timing_wheel_expires_on_deadline():
+    """Ключи истекают в тик своего срока, в том числе переносимые с верхних уровней"""
+    wheel = chat.TimingWheel(1.0, slots=4, levels=3)
+    start = wheel.current
+    wheel.schedule('near', start + 2)
+    wheel.schedule('far', start + 37)
+    wheel.schedule('moved', start + 3)
+    wheel.schedule('moved', start + 10)
+    wheel.schedule('cancelled', start + 5)
+    wheel.cancel('cancelled')
+    assert len(wheel) == 3
+    expired = {}
+    for tick in range(1, 41):
+        for key in wheel.advance(start + tick):
+            expired[key] = tick
+    assert expired == {'near': 2, 'moved': 10, 'far': 37}
+    assert len(wheel) == 0
+
+def test_timing_wheel_past_deadline_fires_next_tick():
+    """Уже прошедший срок срабатывает на ближайшем тике, а не теряется"""
+    wheel = chat.TimingWheel(1.0)
+    wheel.schedule('late', wheel.current - 5)
+    assert wheel.advance(wheel.current + 1) == ['late']
+
+def test_token_bucket_refill():
+    """Ведро пополняется со скоростью rate и не переполняется сверх burst"""
+    bucket = chat.TokenBucket(2.0, 4.0, 100.0)
+    bucket.tokens = 0.0
+    bucket.refill(101.0)
+    assert bucket.tokens == 2.0
+    assert bucket.wait_time(3.0) == 0.5
+    assert bucket.wait_time(1.0) == 0.0
+    bucket.refill(110.0)
+    assert bucket.tokens == 4.0
+
+def test_rate_limiter_delays_then_drops(monkeypatch):
+    """Нехватка токенов дает задержку, а слишком долгая - отброс без списания"""
+    clock = [1000.0]
+    monkeypatch.setattr(chat.time, 'monotonic', lambda: clock[0])
+    limiter = chat.RateLimiter({'user': (1.0, 2.0), 'ip': (10.0, 10.0), 'room': None}, max_delay=1.5)
+    costs = [('user', 'alice', 1), ('ip', '10.0.0.1', 1), ('room', '1', 1)]
+    assert limiter.acquire(costs) == 0.0
+    assert limiter.acquire(costs) == 0.0
+    # Ведро пусто: токен накопится через секунду, ведро уходит в долг
+    assert limiter.acquire(costs) == 1.0
+    assert limiter.acquire(costs) is None
+    assert limiter.totals('delayed')['user'] == 1
+    assert limiter.totals('dropped')['user'] == 1
+    # Отброшенное действие не списало токены
+    clock[0] += 1.0
+    assert limiter.acquire(costs) == 1.0
+    assert ('room', '1') not in limiter.buckets
+
+def test_rate_limiter_prune_drops_full_buckets(monkeypatch):
+    """prune удаляет только ведра, пополнившиеся до burst"""
+    clock = [1000.0]
+    monkeypatch.setattr(chat.time, 'monotonic', lambda: clock[0])
+    limiter = chat.RateLimiter({'user': (1.0, 2.0)}, max_delay=5)
+    limiter.acquire([('user', 'alice', 2)])
+    limiter.acquire([('user', 'bob', 1)])
+    clock[0] += 1.0
+    limiter.prune()
+    assert list(limiter.buckets) == [('user', 'alice')]
+
+def directory_room(room_id, name, activity, password=None):
+    room = chat.ChatRoom(room_id, name, 'admin', password)
+    room.last_activity = datetime.datetime.fromtimestamp(activity)
+    return room
+
+def room_ids(page):
+    entries, total = page
+    return [entry.room_id for entry in entries], total
+
+def test_room_directory_orders_and_pages():
+    """Страницы каталога в порядке названий, участников и активности"""
+    directory = chat.RoomDirectory()
+    directory.load([directory_room('1', 'beta', 1000), directory_room('2', 'Alpha', 3000),
+                    directory_room('3', 'gamma', 2000)])
+    directory.add(directory_room('4', 'alpine', 500))
+    directory.update('1', 5, 1000)
+    directory.update('4', 2, 500)
+    assert room_ids(directory.page(1, 2)) == (['2', '4'], 4)
+    assert room_ids(directory.page(2, 2)) == (['1', '3'], 4)
+    assert room_ids(directory.page(3, 2)) == ([], 4)
+    assert room_ids(directory.page(1, 3, order='members')) == (['1', '4', '2'], 4)
+    assert room_ids(directory.page(1, 4, order='activity')) == (['2', '3', '1', '4'], 4)
+    directory.remove('2')
+    assert room_ids(directory.page(1, 4, order='activity')) == (['3', '1', '4'], 3)
+
+def test_room_directory_prefix_filter():
+    """Фильтр по началу названия без учета регистра, в любом порядке"""
+    directory = chat.RoomDirectory()
+    directory.load([directory_room('1', 'Alpha', 100), directory_room('2', 'alpine', 300),
+                    directory_room('3', 'beta', 200), directory_room('4', 'ALPS', 200)])
+    directory.update('4', 3, 200)
+    assert room_ids(directory.page(1, 10, prefix='ALP')) == (['1', '2', '4'], 3)
+    assert room_ids(directory.page(2, 2, prefix='alp')) == (['4'], 3)
+    assert room_ids(directory.page(1, 2, prefix='alp', order='members')) == (['4', '1'], 3)
+    assert room_ids(directory.page(1, 10, prefix='alp', order='activity')) == (['2', '4', '1'], 3)
+    assert room_ids(directory.page(1, 10, prefix='z')) == ([], 0)
+
+def test_room_directory_activity_resolution():
+    """Активность переносится в индекс не чаще раза в ACTIVITY_RESOLUTION секунд"""
+    directory = chat.RoomDirectory()
+    directory.load([directory_room('1', 'a', 1000), directory_room('2', 'b', 1010)])
+    directory.update('1', None, 1030)
+    assert room_ids(directory.page(1, 2, order='activity')) == (['2', '1'], 2)
+    directory.update('1', None, 1000 + directory.ACTIVITY_RESOLUTION)
+    assert room_ids(directory.page(1, 2, order='activity')) == (['1', '2'], 2)
+    directory.set_protected('2', True)
+    assert directory.entries['2'].protected